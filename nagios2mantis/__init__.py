@@ -16,39 +16,281 @@
 # this program. If not, see <http://www.gnu.org/licenses/>.
 #
 
+import Queue
 import argparse
+import copy
+import errno
+import fcntl
+import hashlib
+import json
 import locale
 import logging
+import os
+import random
+import re
+import select
+import signal
 import sqlite3
-import yaml
+import sys
+import threading
+import time
 
+from collections import OrderedDict
+from contextlib import contextmanager
 from ConfigParser import RawConfigParser
 from datetime import datetime
 from datetime import timedelta
 
-from SOAPpy import WSDL, faultType
+# SOAPpy, yaml, urllib2, httplib and socket are imported where they are used:
+# loading them takes far longer than spooling a notification, which is all
+# most runs of nagios2mantis do.
 
 NAGIOS_STATES = ['UP', 'DOWN', 'CRITICAL', 'WARNING', 'OK', 'UNKNOWN',
                  'PENDING']
 
+# Mantis resolved and closed statuses: no note is added to these issues
+CLOSED_STATUSES = [80, 90]
+
+# Mantis status of the issues it opens
+NEW_STATUS = 10
+
+# Host notes only made of the Mantis project id do not need a YAML parser
+PROJECT_ID_NOTES = re.compile(r'\s*mantis_project_id\s*:\s*(\d+)\s*$')
+
+# [timestamp] SERVICE NOTIFICATION: contact;host;service;state;command;output
+# [timestamp] HOST NOTIFICATION: contact;host;state;command;output
+NAGIOS_NOTIFICATION = re.compile(
+    r'\[(\d+)\] (HOST|SERVICE) NOTIFICATION: (.*)$')
+
+
+class Template(unicode):
+    # str.format template parsed once, instead of at each row, its fields
+    # being checked when the configuration is loaded
+    def __new__(cls, template, fields):
+        self = unicode.__new__(cls, template)
+        self.parts = []
+        try:
+            for literal, field, spec, conversion in \
+                    self._formatter_parser():
+                if field is not None and field not in fields:
+                    raise ValueError('unknown field {%s}, expected %s' % (
+                        field, ', '.join('{%s}' % name for name in fields)))
+                if spec and '{' in spec:
+                    raise ValueError('nested field in {%s:%s}' % (field,
+                                                                  spec))
+                if conversion not in (None, 'r', 's'):
+                    raise ValueError('unknown conversion !%s' % conversion)
+                self.parts.append((literal, field, spec, conversion))
+        except ValueError as error:
+            raise ValueError('Invalid template %r: %s' % (template, error))
+        return self
+
+    def format(self, **values):
+        text = []
+        for literal, field, spec, conversion in self.parts:
+            text.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            if spec:
+                value = format(value, spec)
+            text.append(unicode(value))
+        return u''.join(text)
+
 
 class Config(RawConfigParser):
-    def __init__(self, configuration_file):
+    TEMPLATES = {
+        'issue_description': ('plugin_output',),
+        'note_description': ('state', 'plugin_output'),
+    }
+
+    def __init__(self, configuration_file, snapshot_file=None):
         RawConfigParser.__init__(self)
+
+        # The parsed and checked options are kept in snapshot_file, and used
+        # instead of the configuration file as long as it is not modified
+        stamp = None
+        if snapshot_file is not None:
+            stamp = self.stamp(configuration_file)
+            if stamp is not None and self.load_snapshot(snapshot_file, stamp):
+                return
         self.read(configuration_file)
 
         self.wsdl = self.get('Mantis', 'wsdl')
         self.username = self.get('Mantis', 'username')
         self.password = self.get('Mantis', 'password')
         self.project_id = self.get('Mantis', 'default_mantis_project_id')
-        self.issue_description = unicode(self.get(
-            'Mantis', 'issue_description'), 'UTF-8')
-        self.note_description = unicode(self.get(
-            'Mantis', 'note_description'), 'UTF-8')
+        for name, fields in self.TEMPLATES.items():
+            setattr(self, name, Template(unicode(self.get('Mantis', name),
+                                                 'UTF-8'), fields))
         self.category_name = unicode(self.get('Mantis', 'category_name'),
                                      'UTF-8')
+        self.transport = self.optional('Mantis', 'transport', 'soappy')
+        if self.transport not in ('soappy', 'keepalive'):
+            raise ValueError('Unknown transport %s' % self.transport)
+        self.pool_size = int(self.optional('Mantis', 'pool_size', 4))
+        self.connect_timeout = float(self.optional(
+            'Mantis', 'connect_timeout', 10))
+        self.read_timeout = float(self.optional('Mantis', 'read_timeout', 60))
         self.sqlite_file = self.get('Mantis2nagios', 'sqlite_file')
         self.inotify_file = self.get('Mantis2nagios', 'inotify_file')
+        self.serve_interval = float(self.optional(
+            'Mantis2nagios', 'serve_interval', 60))
+        self.poll_interval = float(self.optional(
+            'Mantis2nagios', 'poll_interval', 1))
+        self.workers = int(self.optional('Mantis2nagios', 'workers', 1))
+        self.prefetch_issues = self.optional_boolean(
+            'Mantis2nagios', 'prefetch_issues', False)
+        self.prefetch_page_size = int(self.optional(
+            'Mantis2nagios', 'prefetch_page_size', 100))
+        self.issue_status_ttl = float(self.optional(
+            'Mantis2nagios', 'issue_status_ttl', 0))
+        self.journal_mode = self.optional('Mantis2nagios', 'journal_mode',
+                                          None)
+        self.synchronous = self.optional('Mantis2nagios', 'synchronous', None)
+        self.commit_every = int(self.optional(
+            'Mantis2nagios', 'commit_every', 100))
+        self.page_size = int(self.optional('Mantis2nagios', 'page_size', 500))
+        self.lease_time = float(self.optional(
+            'Mantis2nagios', 'lease_time', 300))
+        self.wsdl_cache_dir = self.optional('Mantis2nagios', 'wsdl_cache_dir',
+                                            None)
+        self.wsdl_max_age = float(self.optional(
+            'Mantis2nagios', 'wsdl_max_age', 86400))
+        self.spool_socket = self.optional('Mantis2nagios', 'spool_socket',
+                                          None)
+        self.retry_backoff = float(self.optional(
+            'Mantis2nagios', 'retry_backoff', 60))
+        self.max_backoff = float(self.optional(
+            'Mantis2nagios', 'max_backoff', 3600))
+        self.breaker_threshold = int(self.optional(
+            'Mantis2nagios', 'breaker_threshold', 5))
+        self.max_attempts = int(self.optional(
+            'Mantis2nagios', 'max_attempts', 10))
+        self.rate_limit = float(self.optional(
+            'Mantis2nagios', 'rate_limit', 0))
+        self.rate_burst = float(self.optional(
+            'Mantis2nagios', 'rate_burst', max(1, self.rate_limit)))
+        self.adaptive_rate = self.optional_boolean(
+            'Mantis2nagios', 'adaptive_rate', False)
+        self.latency_target = float(self.optional(
+            'Mantis2nagios', 'latency_target', 5))
+        self.metrics_file = self.optional('Mantis2nagios', 'metrics_file',
+                                          None)
+        self.supersede = self.optional('Mantis2nagios', 'supersede', 'none')
+        if self.supersede not in DbSpool.SUPERSEDE:
+            raise ValueError('Unknown supersede policy %s' % self.supersede)
+        self.relation_max_age = float(self.optional(
+            'Mantis2nagios', 'relation_max_age', 30))
+        self.clean_batch_size = int(self.optional(
+            'Mantis2nagios', 'clean_batch_size', 1000))
+        self.verify_relations = self.optional_boolean(
+            'Mantis2nagios', 'verify_relations', False)
+        self.suppress_services = self.optional_boolean(
+            'Mantis2nagios', 'suppress_services', False)
+
+        # Other Mantis instances, in [Mantis:<name>] sections, are chosen
+        # with the mantis_instance key of the host notes
+        self.instance = None
+        self.instances = {}
+        for section in self.sections():
+            if not section.startswith('Mantis:'):
+                continue
+            self.instances[section[len('Mantis:'):]] = {
+                'wsdl': self.get(section, 'wsdl'),
+                'username': self.get(section, 'username'),
+                'password': self.get(section, 'password'),
+                'project_id': self.optional(
+                    section, 'default_mantis_project_id', self.project_id),
+                'workers': int(self.optional(section, 'workers',
+                                             self.workers)),
+            }
+
+        if stamp is not None:
+            self.save_snapshot(snapshot_file, stamp)
+
+    def stamp(self, configuration_file):
+        # Any change to the configuration file, or an upgrade of
+        # nagios2mantis, makes the snapshot stale
+        try:
+            stamp = []
+            for filename in (configuration_file, __file__):
+                stat = os.stat(filename)
+                stamp.extend([os.path.abspath(filename), stat.st_ino,
+                              stat.st_size, stat.st_mtime])
+            return stamp
+        except OSError:
+            return None
+
+    def load_snapshot(self, snapshot_file, stamp):
+        try:
+            with open(snapshot_file) as snapshot:
+                snapshot = json.load(snapshot)
+        except (IOError, ValueError):
+            return False
+        if not isinstance(snapshot, dict) or snapshot.get('stamp') != stamp:
+            return False
+        for name, value in snapshot['options'].items():
+            if name in self.TEMPLATES:
+                value = Template(value, self.TEMPLATES[name])
+            elif name != 'category_name':
+                value = encoded(value)
+            setattr(self, name, value)
+        return True
+
+    def save_snapshot(self, snapshot_file, stamp):
+        options = dict((name, value) for name, value in vars(self).items()
+                       if not name.startswith('_'))
+        try:
+            write_atomically(snapshot_file, json.dumps({
+                'stamp': stamp,
+                'options': options,
+            }), 0o600)
+        except (IOError, OSError) as error:
+            logging.debug('Configuration snapshot not saved: %s', error)
+
+    def for_instance(self, name):
+        # The configuration of another Mantis instance
+        config = copy.copy(self)
+        for option, value in self.instances[name].items():
+            setattr(config, option, value)
+        config.instance = name
+        config.instances = {}
+        return config
+
+    def route(self, project_id, instance):
+        # Returns the project and the Mantis instance the events of a host
+        # go to, given those found in its notes
+        if instance is not None and instance not in self.instances:
+            logging.warning('Unknown Mantis instance %s, using the default '
+                            'one', instance)
+            instance = None
+        if not project_id:
+            project_id = self.project_id if instance is None else \
+                self.instances[instance]['project_id']
+        return project_id, instance
+
+    def optional(self, section, option, default):
+        if self.has_option(section, option):
+            return self.get(section, option)
+        return default
+
+    def optional_boolean(self, section, option, default):
+        if self.has_option(section, option):
+            return self.getboolean(section, option)
+        return default
+
+
+def encoded(value):
+    # JSON strings back to the str RawConfigParser returns
+    if isinstance(value, unicode):
+        return value.encode('UTF-8')
+    if isinstance(value, dict):
+        return dict((encoded(key), encoded(item))
+                    for key, item in value.items())
+    return value
 
 
 def get_summary(hostname, state, service):
@@ -66,78 +308,1179 @@ def get_summary(hostname, state, service):
     )
 
 
+def spooled_row(hostname, state, service, plugin_output, project_id,
+                instance=None):
+    # Command line arguments are encoded according to the locale
+    encoding = locale.getpreferredencoding()
+    u = lambda s: s is not None and unicode(s, encoding) or None
+    return {
+        'hostname': u(hostname),
+        'state': u(state),
+        'service': u(service),
+        'plugin_output': u(plugin_output),
+        'project_id': project_id,
+        'instance': instance,
+    }
+
+
+def backoff(base, maximum, attempts):
+    # Exponential backoff after the given number of failed attempts, with
+    # jitter so that rows and processes do not all retry at the same time
+    delay = min(maximum, base * 2 ** (attempts - 1))
+    return timedelta(seconds=random.uniform(delay / 2, delay))
+
+
+def transport_errors():
+    # Exceptions raised when Mantis cannot be reached, as opposed to the
+    # faults Mantis answers with
+    import httplib
+    from SOAPpy.Errors import HTTPError
+
+    return (IOError, httplib.HTTPException, HTTPError)
+
+
+class Metrics(object):
+    # Counters, gauges and histograms rendered in the Prometheus text format.
+    # Samples are kept flat, by family, sample name and labels, so that the
+    # values of a run can be merged into those of the previous runs loaded
+    # back from a textfile, and counters keep growing across runs.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.types = {}
+        self.samples = OrderedDict()
+
+    def load(self, filename):
+        try:
+            with open(filename) as textfile:
+                lines = textfile.read().splitlines()
+        except IOError:
+            return
+        family = None
+        for line in lines:
+            if line.startswith('# TYPE '):
+                family, kind = line.split()[2:4]
+                self.types[family] = kind
+                continue
+            match = re.match(r'(\w+)(?:\{(.*)\})? (\S+)$', line)
+            if family is None or match is None:
+                continue
+            name, labels, value = match.groups()
+            labels = tuple(re.findall(r'(\w+)="([^"]*)"', labels or ''))
+            self.samples[family, name, labels] = float(value)
+
+    def add(self, family, kind, name, labels, value):
+        self.types[family] = kind
+        key = (family, name, tuple(sorted(labels.items())))
+        self.samples[key] = self.samples.get(key, 0) + value
+
+    def merge(self, other):
+        # Counters and histograms add up, gauges take the other value
+        for (family, name, labels), value in other.samples.items():
+            kind = other.types[family]
+            if kind == 'gauge':
+                self.types[family] = kind
+                self.samples[family, name, labels] = value
+            else:
+                self.add(family, kind, name, dict(labels), value)
+        return self
+
+    def take(self):
+        # Returns the samples gathered so far and starts over, so that each
+        # of them is merged into the textfile only once
+        taken = Metrics()
+        with self.lock:
+            taken.types, self.types = self.types, {}
+            taken.samples, self.samples = self.samples, OrderedDict()
+        return taken
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.add(name, 'counter', name, labels, value)
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.types[name] = 'gauge'
+            self.samples[name, name, tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            for bucket in self.BUCKETS + ('+Inf',):
+                bucket_labels = dict(labels, le=str(bucket))
+                self.add(name, 'histogram', name + '_bucket', bucket_labels,
+                         int(bucket == '+Inf' or value <= bucket))
+            self.add(name, 'histogram', name + '_sum', labels, value)
+            self.add(name, 'histogram', name + '_count', labels, 1)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def value(self, name, **labels):
+        for (family, sample, sample_labels), value in self.samples.items():
+            if sample == name and \
+                    sample_labels == tuple(sorted(labels.items())):
+                return value
+        return None
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for family in sorted(self.types):
+                lines.append('# TYPE %s %s' % (family, self.types[family]))
+                for (sample_family, name, labels), value in \
+                        self.samples.items():
+                    if sample_family != family:
+                        continue
+                    if labels:
+                        name += '{%s}' % ','.join(
+                            '%s="%s"' % label for label in labels)
+                    lines.append('%s %r' % (name, float(value)))
+        return ''.join(line + '\n' for line in lines)
+
+
+def folded(transitions):
+    # Mentions how many notifications a row superseded
+    if transitions > 1:
+        return u' (last of %d notifications)' % transitions
+    return u''
+
+
+def read_nagios_log(lines, encoding='utf-8'):
+    # Nagios logs a notification once per contact: only the first one of
+    # consecutive identical notifications is kept. Acknowledgements,
+    # downtimes and flapping notifications are not state changes.
+    previous = None
+    for line in lines:
+        match = NAGIOS_NOTIFICATION.match(line.decode(encoding, 'replace'))
+        if match is None:
+            continue
+        timestamp, kind, fields = match.groups()
+        if kind == 'SERVICE':
+            fields = fields.split(';', 5)[1:]
+        else:
+            fields = fields.split(';', 4)[1:]
+            fields.insert(1, None)
+        if len(fields) != 5 or fields[2] not in NAGIOS_STATES:
+            continue
+        hostname, service, state, command, plugin_output = fields
+        notification = (timestamp, hostname, service, state, plugin_output)
+        if notification == previous:
+            continue
+        previous = notification
+        yield {
+            'hostname': hostname,
+            'state': state,
+            'service': service,
+            'plugin_output': plugin_output.rstrip(u'\r\n'),
+            'host_notes': None,
+        }
+
+
+def read_csv(lines, encoding='utf-8'):
+    # CSV with a header line naming the hostname, state, service,
+    # plugin_output and, optionally, host_notes columns
+    import csv
+
+    for row in csv.DictReader(lines):
+        event = dict((column, (row.get(column) or '').decode(
+            encoding, 'replace') or None) for column in IMPORT_COLUMNS)
+        if event['state'] in NAGIOS_STATES:
+            yield event
+
+
+def read_jsonl(lines, encoding='utf-8'):
+    # One JSON object per line, with the same keys as the CSV columns
+    for line in lines:
+        if not line.strip():
+            continue
+        row = json.loads(line.decode(encoding, 'replace'))
+        event = dict((column, row.get(column) or None)
+                     for column in IMPORT_COLUMNS)
+        if event['state'] in NAGIOS_STATES:
+            yield event
+
+
+IMPORT_COLUMNS = ['hostname', 'state', 'service', 'plugin_output',
+                  'host_notes']
+IMPORT_FORMATS = OrderedDict([
+    ('nagios', read_nagios_log),
+    ('csv', read_csv),
+    ('jsonl', read_jsonl),
+])
+
+
+def coalesce(rows):
+    # Group spooled rows by (hostname, service), keeping them in id order
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault((row[1], row[3]), []).append(row)
+    return groups.values()
+
+
+def correlate(groups):
+    # The rows of the services of a host whose last row is DOWN are moved
+    # after the rows of the host, in its group
+    hosts = dict((rows[0][1], rows) for rows in groups
+                 if rows[0][3] is None and rows[-1][2] == 'DOWN')
+    correlated = []
+    for rows in groups:
+        if rows[0][3] is not None and rows[0][1] in hosts:
+            hosts[rows[0][1]].extend(rows)
+        else:
+            correlated.append(rows)
+    return correlated
+
+
+class WorkerPool(object):
+    def __init__(self, size):
+        self.tasks = Queue.Queue()
+        self.threads = []
+        for _ in range(size):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            func, args, done = task
+            try:
+                func(*args)
+            except:
+                logging.exception('A worker failed')
+            finally:
+                done()
+
+    def map(self, func, items):
+        # Returns an event set once func has been called on every item
+        event = threading.Event()
+        items = list(items)
+        remaining = [len(items)]
+        lock = threading.Lock()
+
+        def done():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    event.set()
+
+        if not items:
+            event.set()
+        for item in items:
+            self.tasks.put((func, (item,), done))
+        return event
+
+    def close(self):
+        # Waits for the queued tasks, then stops the threads
+        for thread in self.threads:
+            self.tasks.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+class SpoolWriter(object):
+    # Stands for a DbSpool in the worker threads: the calls are queued and
+    # run by serve() in the thread owning the SQLite connection
+    def __init__(self, db_spool):
+        self.db_spool = db_spool
+        self.calls = Queue.Queue()
+
+    def __getattr__(self, name):
+        method = getattr(self.db_spool, name)
+
+        def call(*args):
+            result = Queue.Queue(1)
+            self.calls.put((method, args, result))
+            value, exc_info = result.get()
+            if exc_info is not None:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            return value
+        return call
+
+    def serve(self, done):
+        while not done.is_set() or not self.calls.empty():
+            try:
+                method, args, result = self.calls.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            try:
+                result.put((method(*args), None))
+            except:
+                result.put((None, sys.exc_info()))
+
+
+class ConnectionPool(object):
+    # At most size HTTP connections, kept open between requests
+    def __init__(self, size, connect_timeout, read_timeout):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.slots = threading.Semaphore(size)
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, scheme, host):
+        # Returns a connection, and whether it was already used
+        import httplib
+
+        self.slots.acquire()
+        with self.lock:
+            idle = self.idle.get((scheme, host), [])
+            while idle:
+                connection = idle.pop()
+                # An idle connection is only readable once the server closed
+                # it
+                if not select.select([connection.sock], [], [], 0)[0]:
+                    return connection, True
+                connection.close()
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(
+                host, timeout=self.connect_timeout)
+        else:
+            connection = httplib.HTTPConnection(
+                host, timeout=self.connect_timeout)
+        try:
+            connection.connect()
+        except:
+            self.slots.release()
+            raise
+        connection.sock.settimeout(self.read_timeout)
+        return connection, False
+
+    def put(self, scheme, host, connection):
+        # Gives a connection back, or None if it was closed
+        if connection is not None:
+            with self.lock:
+                self.idle.setdefault((scheme, host), []).append(connection)
+        self.slots.release()
+
+
+class KeepAliveTransport(object):
+    # SOAPpy transport sending the requests over the persistent HTTP/1.1
+    # connections of a ConnectionPool, instead of a connection per call
+    def __init__(self, pool):
+        self.pool = pool
+
+    def call(self, addr, data, namespace, soapaction=None, encoding=None,
+             http_proxy=None, config=None, timeout=None):
+        import httplib
+        import socket
+        from SOAPpy.Client import SOAPAddress, SOAPUserAgent
+        from SOAPpy.Errors import HTTPError
+
+        if not isinstance(addr, SOAPAddress):
+            addr = SOAPAddress(addr)
+        headers = {
+            'User-agent': SOAPUserAgent(),
+            'Content-type': 'text/xml',
+            'SOAPAction': '"%s"' % (soapaction or ''),
+        }
+        if encoding is not None:
+            headers['Content-type'] += '; charset=%s' % encoding
+
+        while True:
+            connection, reused = self.pool.get(addr.proto, addr.host)
+            # The server may have closed a connection left idle meanwhile.
+            # Mantis calls are not safe to repeat: the request is only sent
+            # again when it cannot have reached the server, never after a
+            # timeout or once a byte of response was received.
+            unsent = False
+            try:
+                try:
+                    connection.request('POST', addr.path, data, headers)
+                except socket.error as error:
+                    unsent = not isinstance(error, socket.timeout) and \
+                        error.errno in (errno.ECONNRESET, errno.EPIPE)
+                    raise
+                try:
+                    response = connection.getresponse()
+                except httplib.BadStatusLine as error:
+                    # Closed without answering, rather than a bad answer
+                    unsent = not str(error.line).startswith('HTTP/')
+                    raise
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                self.pool.put(addr.proto, addr.host, None)
+                if reused and unsent:
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+                connection = None
+            self.pool.put(addr.proto, addr.host, connection)
+            break
+
+        content_type = response.getheader('Content-type', 'text/xml')
+        if response.status == 500 and not (
+                content_type.startswith('text/xml') and body):
+            raise HTTPError(response.status, response.reason)
+        if response.status not in (200, 500):
+            raise HTTPError(response.status, response.reason)
+        if namespace is None:
+            return body, None
+        return body, self.getNS(namespace, body)
+
+    def getNS(self, namespace, body):
+        # Same as HTTPTransport.getNS: the namespace may have been extended
+        if not isinstance(namespace, str):
+            return namespace
+        match = re.search(r'xmlns:\w+=[\'"](%s[^\'"]*)[\'"]' % namespace,
+                          body)
+        if match:
+            return match.group(1)
+        return namespace
+
+
+class MantisProxy(object):
+    # Calls the methods of a WSDL from their location, namespace and SOAP
+    # action only, without parsing the WSDL again
+    def __init__(self, methods, transport=None):
+        self.methods = methods
+        self.transport = transport
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        from SOAPpy import SOAPProxy
+        from SOAPpy.Client import HTTPTransport
+
+        location, namespace, soapaction = self.methods[name]
+        return getattr(SOAPProxy(location, namespace=namespace,
+                                 soapaction=soapaction,
+                                 transport=self.transport or HTTPTransport),
+                       name)
+
+
+class WsdlCache(object):
+    # Keeps a WSDL and the methods parsed from it in a directory. The cache
+    # is used as is for max_age seconds, then revalidated with the ETag and
+    # Last-Modified headers of the previous download.
+    def __init__(self, url, directory, max_age):
+        self.url = url
+        self.max_age = max_age
+        key = hashlib.sha1(url).hexdigest()
+        self.wsdl_file = os.path.join(directory, 'wsdl-%s.xml' % key)
+        self.metadata_file = os.path.join(directory, 'wsdl-%s.json' % key)
+
+    def proxy(self, transport=None):
+        metadata = self.load()
+        if metadata is None or \
+                time.time() - metadata['fetched'] > self.max_age:
+            metadata = self.refresh(metadata)
+        return MantisProxy(dict(
+            (str(name), tuple(str(value) for value in method))
+            for name, method in metadata['methods'].items()
+        ), transport)
+
+    def load(self):
+        try:
+            with open(self.metadata_file) as metadata_file:
+                return json.load(metadata_file)
+        except (IOError, ValueError):
+            return None
+
+    def save(self, metadata):
+        write_atomically(self.metadata_file, json.dumps(metadata))
+
+    def refresh(self, metadata):
+        import urllib2
+        from SOAPpy import WSDL
+
+        request = urllib2.Request(self.url)
+        if metadata is not None:
+            if metadata['etag']:
+                request.add_header('If-None-Match', metadata['etag'])
+            if metadata['last_modified']:
+                request.add_header('If-Modified-Since',
+                                   metadata['last_modified'])
+        try:
+            response = urllib2.urlopen(request)
+            wsdl = response.read()
+        except urllib2.HTTPError as error:
+            if error.code != 304 or metadata is None:
+                raise
+            metadata['fetched'] = time.time()
+            self.save(metadata)
+            return metadata
+        except (urllib2.URLError, IOError):
+            if metadata is None:
+                raise
+            logging.warning('Could not revalidate %s, using the WSDL cached '
+                            'in %s', self.url, self.wsdl_file, exc_info=True)
+            return metadata
+
+        write_atomically(self.wsdl_file, wsdl)
+        proxy = WSDL.Proxy(self.wsdl_file)
+        metadata = {
+            'etag': response.info().getheader('ETag'),
+            'last_modified': response.info().getheader('Last-Modified'),
+            'fetched': time.time(),
+            'methods': dict(
+                (name, (method.location, method.namespace,
+                        method.soapAction))
+                for name, method in proxy.methods.items()
+            ),
+        }
+        self.save(metadata)
+        return metadata
+
+
+def write_atomically(filename, content, mode=0o666):
+    # The temporary file is proper to the thread, which may not be the only
+    # one of its process writing the file
+    temporary_file = '%s.%d.%d' % (filename, os.getpid(),
+                                   threading.current_thread().ident)
+    with os.fdopen(os.open(temporary_file,
+                           os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode),
+                   'w') as output:
+        output.write(content)
+    os.rename(temporary_file, filename)
+
+
+class SpoolSocket(object):
+    # Unix datagram socket on which serve receives the events to spool, so
+    # that spool neither opens the SQLite file nor waits for its lock
+    MAX_DATAGRAM = 65536
+
+    def __init__(self, path):
+        self.path = path
+        self.socket = None
+
+    def send(self, hostname, state, service, plugin_output, project_id,
+             instance=None):
+        # Returns False when nobody is listening, or is not keeping up, or
+        # when the event is too large to be received whole
+        import socket
+
+        event = json.dumps(spooled_row(hostname, state, service,
+                                       plugin_output, project_id, instance))
+        if len(event) > self.MAX_DATAGRAM:
+            return False
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            client.setblocking(False)
+            client.sendto(event, self.path)
+        except socket.error:
+            logging.debug('Could not send to %s', self.path, exc_info=True)
+            return False
+        finally:
+            client.close()
+        return True
+
+    def bind(self):
+        import socket
+
+        try:
+            os.remove(self.path)
+        except OSError as error:
+            if error.errno != errno.ENOENT:
+                raise
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.socket.bind(self.path)
+
+    def receive(self, timeout):
+        # Waits up to timeout seconds, then returns every pending event
+        import socket
+
+        events = []
+        if not select.select([self.socket], [], [], timeout)[0]:
+            return events
+        while True:
+            try:
+                datagram = self.socket.recv(self.MAX_DATAGRAM)
+            except socket.error as error:
+                if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return events
+                raise
+            try:
+                event = json.loads(datagram)
+                events.append(dict(
+                    (column, event.get(column))
+                    for column in ('hostname', 'state', 'service',
+                                   'plugin_output', 'project_id', 'instance')
+                ))
+            except (ValueError, AttributeError):
+                logging.warning('Ignoring malformed event %r', datagram)
+
+    def close(self):
+        # The path is removed first, so that spool falls back to SQLite.
+        # Returns the events received before, which their senders count on.
+        os.remove(self.path)
+        events = self.receive(0)
+        self.socket.close()
+        return events
+
+
 class Nagios2Mantis(object):
-    def __init__(self, config):
+    def __init__(self, config, metrics=None):
         self.config = config
-        self.db_spool = DbSpool(config.sqlite_file)
+        self.metrics = metrics or Metrics()
+        self.db_spool = DbSpool(config.sqlite_file, config.journal_mode,
+                                config.synchronous, config.commit_every,
+                                config.page_size, self.metrics,
+                                config.supersede, config.instance,
+                                config.instances.keys())
+        # Identifies the rows leased by this process in the spool
+        self.worker = '%s:%d' % (os.uname()[1], os.getpid())
+        if config.instance is not None:
+            self.worker += ':' + config.instance
+        self.pool = None
+        self.breaker_lock = threading.Lock()
+        self.failures = 0
+        self.threshold = config.breaker_threshold
+        self.tripped = False
+        self.reached = False
+        self.transport = None
+        if config.transport == 'keepalive':
+            connections = ConnectionPool(config.pool_size,
+                                         config.connect_timeout,
+                                         config.read_timeout)
+            self.transport = lambda: KeepAliveTransport(connections)
+        self.spool_socket = None
+        self.running = True
+        self.issue_statuses = None
+        self._local = threading.local()
+        self.mantis_lock = threading.Lock()
+        self.cached_mantis = None
+        # Thread, Nagios2Mantis and queued drains of each other Mantis
+        # instance
+        self.instance_pools = {}
+        self.instance_drainers = {}
+        self.instance_drains = {}
 
     @property
     def mantis(self):
-        if not hasattr(self, '_mantis'):
-            self._mantis = WSDL.Proxy(self.config.wsdl)
-        return self._mantis
+        # SOAPpy proxies are not thread safe: each worker gets its own one.
+        # A MantisProxy keeps no state between calls, and the workers share
+        # the one of the cached WSDL, loaded or refreshed once.
+        kw = {}
+        if self.transport is not None:
+            kw['transport'] = self.transport
+        if self.config.wsdl_cache_dir:
+            with self.mantis_lock:
+                if self.cached_mantis is None:
+                    self.cached_mantis = WsdlCache(
+                        self.config.wsdl, self.config.wsdl_cache_dir,
+                        self.config.wsdl_max_age).proxy(**kw)
+            return self.cached_mantis
+        if not hasattr(self._local, 'mantis'):
+            from SOAPpy import WSDL
 
-    def empty_cache(self):
-        for row in self.db_spool.rows():
+            # SOAPpy parses the error message when the WSDL cannot be
+            # fetched, and fails with a TypeError: it is a transport error
             try:
-                self.empty_row(row)
-            except:
-                logging.exception('Treating row whose id is %d failed', row[0])
+                self._local.mantis = WSDL.Proxy(self.config.wsdl, **kw)
+            except Exception as error:
+                raise IOError('Could not load the WSDL %s: %s' % (
+                    self.config.wsdl, error))
+        return self._local.mantis
+
+    def empty_cache(self):
+        self.drain()
+        self.close()
+
+    def close(self):
+        # The threads of the other instances finish their queued drains, then
+        # close their own spool connections, as SQLite connections belong to
+        # their thread
+        for name, pool in self.instance_pools.items():
+            pool.map(self.close_instance, [name]).wait()
+            pool.close()
+        self.instance_pools = {}
+        self.instance_drains = {}
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
         self.db_spool.close()
 
+    def close_instance(self, name):
+        drainer = self.instance_drainers.pop(name, None)
+        if drainer is not None:
+            drainer.close()
+
+    def drain(self, after_id=0):
+        try:
+            with self.metrics.timer('nagios2mantis_drain_seconds'):
+                self.drain_instances()
+                return self.drain_pages(after_id)
+        finally:
+            self.metrics.set('nagios2mantis_last_drain_timestamp_seconds',
+                             time.time())
+            self.write_metrics()
+
+    def write_metrics(self):
+        # serve and the cron runs may write the file at the same time: each
+        # one merges what it gathered since its last write under a lock
+        if not self.config.metrics_file:
+            return
+        self.set_gauges()
+        with open(self.config.metrics_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            metrics = Metrics()
+            metrics.load(self.config.metrics_file)
+            metrics.merge(self.metrics.take())
+            write_atomically(self.config.metrics_file, metrics.render())
+
+    def drain_instances(self):
+        # Each other Mantis instance is drained by a thread of its own, with
+        # its own spool connection, proxies, workers and circuit breaker, so
+        # that a slow or down instance does not hold back the others, nor
+        # this drain, which does not wait for theirs. At most one drain is
+        # queued behind the running one, to send what arrived since it began.
+        for name in sorted(self.config.instances):
+            if name not in self.instance_pools:
+                self.instance_pools[name] = WorkerPool(1)
+            queued = [event for event in self.instance_drains.get(name, [])
+                      if not event.is_set()]
+            if len(queued) < 2:
+                queued.append(self.instance_pools[name].map(
+                    self.drain_instance, [name]))
+            self.instance_drains[name] = queued
+
+    def drain_instance(self, name):
+        # Runs in the thread of the instance, which owns its spool connection
+        if name not in self.instance_drainers:
+            self.instance_drainers[name] = Nagios2Mantis(
+                self.config.for_instance(name), self.metrics)
+        drainer = self.instance_drainers[name]
+        drainer.running = self.running
+        drainer.drain_pages()
+
+    def set_gauges(self):
+        depth, oldest = self.db_spool.depth()
+        self.metrics.set('nagios2mantis_spool_rows', depth)
+        self.metrics.set('nagios2mantis_spool_oldest_row_age_seconds',
+                         oldest or 0)
+        self.metrics.set('nagios2mantis_breaker_opened',
+                         self.db_spool.get_breaker(datetime.now())[0])
+
+    def stats(self):
+        # The metrics of the previous runs, and of this one so far
+        self.set_gauges()
+        metrics = Metrics()
+        if self.config.metrics_file:
+            metrics.load(self.config.metrics_file)
+        with self.metrics.lock:
+            return metrics.merge(self.metrics).render()
+
+    def drain_pages(self, after_id=0):
+        # Empty the spool page by page, committing after each one. Returns
+        # the id of the last row read, from which a drain can resume.
+        opened, open_until = self.db_spool.get_breaker(datetime.now())
+        if open_until is not None:
+            logging.info('Mantis is not tried again before %s', open_until)
+            return after_id
+        # Once the breaker was opened, a single failure opens it again
+        self.failures = 0
+        self.threshold = self.config.breaker_threshold
+        if opened and self.threshold:
+            self.threshold = 1
+        self.tripped = False
+        self.reached = False
+
+        projects = set()
+        lease = timedelta(seconds=self.config.lease_time)
+        try:
+            for rows in self.db_spool.pages(after_id, self.worker, lease):
+                if self.config.prefetch_issues:
+                    new_projects = set(row[5] for row in rows) - projects
+                    if new_projects:
+                        projects.update(new_projects)
+                        try:
+                            self.prefetch_issues(new_projects)
+                        except transport_errors() as error:
+                            # The issues are looked up one by one instead
+                            logging.warning('Could not reach Mantis to load '
+                                            'the issues: %s', error)
+                            self.count_failure()
+                groups = coalesce(rows)
+                if self.config.suppress_services:
+                    groups = correlate(groups)
+                with self.db_spool.batch():
+                    self.dispatch(groups)
+                after_id = rows[-1][0]
+                if not self.running or self.tripped:
+                    break
+            if self.tripped:
+                opened += 1
+                open_until = datetime.now() + backoff(
+                    self.config.retry_backoff, self.config.max_backoff,
+                    opened)
+                logging.warning('Mantis could not be reached %d times in a '
+                                'row, it is not tried again before %s',
+                                self.failures, open_until)
+                self.db_spool.set_breaker(opened, open_until)
+            elif opened and self.reached:
+                self.db_spool.set_breaker(0, None)
+        finally:
+            self.issue_statuses = None
+            self.db_spool.release(self.worker)
+        return after_id
+
+    def prefetch_issues(self, project_ids):
+        # Load the status of the issues of the given projects, page after
+        # page, so that find_issue() does not need a mc_issue_get per row
+        from SOAPpy import faultType
+
+        if self.issue_statuses is None:
+            self.issue_statuses = {}
+        page_size = self.config.prefetch_page_size
+        for project_id in project_ids:
+            page_number = 1
+            while True:
+                try:
+                    headers = self.call(
+                        'mc_project_get_issue_headers',
+                        self.config.username,
+                        self.config.password,
+                        project_id,
+                        page_number,
+                        page_size
+                    )
+                except faultType:
+                    logging.exception(
+                        'An error occured while loading the issues of '
+                        'project %s from Mantis.', project_id)
+                    break
+                # Mantis repeats the last page past the end
+                new = [header for header in headers
+                       if header['id'] not in self.issue_statuses]
+                for header in new:
+                    self.issue_statuses[header['id']] = header['status']
+                if len(new) < page_size:
+                    break
+                page_number += 1
+
+    def dispatch(self, groups):
+        # Groups are about distinct (hostname, service) keys and can be sent
+        # concurrently, while the rows of a group are sent in order
+        if self.config.workers <= 1:
+            for rows in groups:
+                self.send_group(rows)
+            return
+
+        if self.pool is None:
+            self.pool = WorkerPool(self.config.workers)
+        writer = SpoolWriter(self.db_spool)
+        self.db_spool = writer
+        try:
+            writer.serve(self.pool.map(self.send_group, groups))
+        finally:
+            self.db_spool = writer.db_spool
+
+    def send_group(self, rows):
+        # Sending a page may take longer than lease_time: the lease on the
+        # rows of a group is renewed before it is sent, and the group is
+        # skipped if another worker claimed them meanwhile
+        ids = [row[0] for row in rows]
+        if self.db_spool.renew(self.worker, ids, timedelta(
+                seconds=self.config.lease_time)) < len(ids):
+            logging.warning('Rows whose ids are %s are not leased anymore, '
+                            'they are skipped',
+                            ', '.join(str(row_id) for row_id in ids))
+            return
+        self.empty_group(rows)
+
+    def empty_group(self, rows):
+        # Failed rows are postponed, and the drain is stopped once Mantis
+        # could not be reached breaker_threshold times in a row
+        if self.tripped:
+            return
+        ids = ', '.join(str(row[0]) for row in rows)
+        try:
+            self.empty_rows(rows)
+        except transport_errors() as error:
+            logging.warning('Could not reach Mantis for rows whose ids are '
+                            '%s: %s', ids, error)
+            self.postpone([row[0] for row in rows], error, transient=True)
+            self.count_failure()
+        except:
+            logging.exception('Treating rows whose ids are %s failed', ids)
+            self.postpone([row[0] for row in rows], sys.exc_info()[1])
+        else:
+            with self.breaker_lock:
+                self.failures = 0
+                self.reached = True
+
+    def count_failure(self):
+        with self.breaker_lock:
+            self.failures += 1
+            if self.threshold and self.failures >= self.threshold:
+                self.tripped = True
+
+    def postpone(self, row_ids, error, transient=False):
+        # Rows which failed max_attempts times for another reason than
+        # Mantis being unreachable are moved to the dead letters
+        self.metrics.inc('nagios2mantis_rows_postponed_total', len(row_ids))
+        dead = self.db_spool.postpone(
+            row_ids, lambda attempts: backoff(
+                self.config.retry_backoff, self.config.max_backoff,
+                attempts),
+            u'%s: %s' % (type(error).__name__, error),
+            self.config.max_attempts, transient)
+        if dead:
+            logging.error('Rows whose ids are %s failed %d times, they are '
+                          'moved to the dead letters',
+                          ', '.join(str(row_id) for row_id in dead),
+                          self.config.max_attempts)
+            self.metrics.inc('nagios2mantis_rows_dead_total', len(dead))
+
+    def serve(self):
+        # Keep the Mantis proxy, the configuration and the spool connection
+        # open, and drain the spool each time it is notified
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        logging.info('Serving spool %s', self.config.sqlite_file)
+        if self.config.spool_socket:
+            self.spool_socket = SpoolSocket(self.config.spool_socket)
+            self.spool_socket.bind()
+        try:
+            while self.running:
+                notified = self.notified()
+                # A failed drain, e.g. on a spool locked for too long, is
+                # tried again rather than stopping the daemon
+                try:
+                    self.drain()
+                except Exception:
+                    logging.exception('Draining spool %s failed',
+                                      self.config.sqlite_file)
+                self.wait(notified)
+        finally:
+            if self.spool_socket is not None:
+                events = self.spool_socket.close()
+                self.spool_socket = None
+                if events:
+                    self.db_spool.add_many(*events)
+        self.close()
+
+    def stop(self, signum=None, frame=None):
+        self.running = False
+        for drainer in self.instance_drainers.values():
+            drainer.running = False
+
+    def notified(self):
+        try:
+            return os.stat(self.config.inotify_file).st_mtime
+        except OSError:
+            return None
+
+    def wait(self, notified):
+        deadline = time.time() + self.config.serve_interval
+        while self.running and time.time() < deadline:
+            if self.spool_socket is None:
+                time.sleep(self.config.poll_interval)
+            else:
+                # Everything received so far is spooled in a single commit
+                events = self.spool_socket.receive(self.config.poll_interval)
+                if events:
+                    self.db_spool.add_many(*events)
+                    return
+            if self.notified() != notified:
+                return
+
     def empty_row(self, row):
-        row_id, hostname, state, service, plugin_output, project_id = row
-        summary = get_summary(hostname, state, service)
-        issue = self.find_issue(hostname, service)
+        self.empty_rows([row])
+
+    def empty_rows(self, rows):
+        # The rows of the services of a host which is down may follow the
+        # rows of the host
+        services = [row for row in rows if row[3] != rows[0][3]]
+        issue_id = self.send_rows([row for row in rows
+                                   if row[3] == rows[0][3]])
+        if services:
+            self.add_services_note(issue_id, services)
+
+    def send_rows(self, rows):
+        # All the rows are about the same hostname and service: look the
+        # issue up once, and send all the transitions in a single note.
+        # Returns the id of the issue, if there is one.
+        issue = self.find_issue(rows[0][1], rows[0][3])
+        transitions = {}
+        if self.config.supersede == 'fold':
+            transitions = self.db_spool.get_transitions(
+                [row[0] for row in rows])
 
         if issue is None:
-            if state == 'UP':
+            # Recoveries of problems without an issue are not sent, but
+            # must not stay in the spool either
+            skipped = []
+            while rows and rows[0][2] == 'UP':
+                skipped.append(rows[0][0])
+                rows = rows[1:]
+            if skipped:
+                self.db_spool.delete(*skipped)
+            if not rows:
                 return
+            row_id, hostname, state, service, plugin_output, project_id = \
+                rows[0]
             issue = {
-                'summary': summary,
+                'summary': get_summary(hostname, state, service),
                 'description': self.config.issue_description.format(
                     plugin_output=plugin_output
-                ),
+                ) + folded(transitions.get(row_id)),
                 'category': self.config.category_name,
                 'project': {
                     'id': project_id
                 },
             }
-            self.add_issue(hostname, service, issue, row_id)
-        else:
-            self.add_note(issue['id'],
-                          self.config.note_description.format(
-                              state=state,
-                              plugin_output=plugin_output),
-                          row_id)
+            issue_id = self.add_issue(hostname, service, issue, [row_id])
+            rows = rows[1:]
+            if issue_id is None or not rows:
+                return issue_id
+            issue = {'id': issue_id}
+
+        notes = [self.config.note_description.format(state=row[2],
+                                                     plugin_output=row[4]) +
+                 folded(transitions.get(row[0]))
+                 for row in rows]
+        self.add_note(issue['id'], u'\n'.join(notes),
+                      [row[0] for row in rows])
+        return issue['id']
+
+    def add_services_note(self, issue_id, rows):
+        # The services of a host which is down are sent in a single note on
+        # the host issue. They are not related to it, so that their events
+        # once the host is back are sent on their own. Without a host issue,
+        # they are sent on their own.
+        if issue_id is None:
+            for group in coalesce(rows):
+                self.send_rows(group)
+            return
+        transitions = {}
+        if self.config.supersede == 'fold':
+            transitions = self.db_spool.get_transitions(
+                [row[0] for row in rows])
+        notes = [u'%s: %s' % (row[3], self.config.note_description.format(
+            state=row[2], plugin_output=row[4])) +
+            folded(transitions.get(row[0])) for row in rows]
+        if not self.add_note(issue_id, u'\n'.join(notes),
+                             [row[0] for row in rows]):
+            return
+        self.metrics.inc('nagios2mantis_rows_suppressed_total', len(rows))
+
+    def call(self, method, *args):
+        # Every Mantis call goes through here to be measured and rate limited
+        from SOAPpy import faultType
+
+        if self.config.rate_limit:
+            self.throttle()
+        outcome = 'error'
+        start = time.time()
+        try:
+            with self.metrics.timer('nagios2mantis_mantis_call_seconds',
+                                    method=method):
+                result = getattr(self.mantis, method)(*args)
+            outcome = 'ok'
+            return result
+        except faultType:
+            outcome = 'fault'
+            raise
+        finally:
+            self.metrics.inc('nagios2mantis_mantis_calls_total',
+                             method=method, outcome=outcome)
+            if self.config.rate_limit and self.config.adaptive_rate:
+                # Faults are answers: only the calls which did not reach
+                # Mantis or were slow tell that it is overloaded
+                self.adapt_rate(outcome == 'error' or time.time() - start >
+                                self.config.latency_target)
+
+    def rate_bounds(self):
+        # The adaptive rate goes down to a twentieth of rate_limit
+        if self.config.adaptive_rate:
+            return self.config.rate_limit / 20, self.config.rate_limit
+        return self.config.rate_limit, self.config.rate_limit
+
+    def throttle(self):
+        # Waits for a token of the bucket the processes sending to this
+        # Mantis instance share in the spool
+        min_rate, max_rate = self.rate_bounds()
+        wait = self.db_spool.take_token(time.time(), min_rate, max_rate,
+                                        self.config.rate_burst)
+        if wait > 0:
+            self.metrics.inc('nagios2mantis_rate_limited_seconds_total', wait)
+            time.sleep(wait)
+
+    def adapt_rate(self, congested):
+        min_rate, max_rate = self.rate_bounds()
+        rate = self.db_spool.adapt_rate(time.time(), congested, min_rate,
+                                        max_rate, self.config.rate_burst)
+        if congested:
+            logging.info('Mantis is overloaded, sending at most %.2f calls '
+                         'per second', rate)
+        self.metrics.set('nagios2mantis_rate_limit_calls_per_second', rate)
 
     def find_issue(self, hostname, service):
         # Find an existing issue
+        from SOAPpy import faultType
+
         issue_id = self.db_spool.get_issue_id(hostname, service)
-        try:
-            issue = self.mantis.mc_issue_get(
-                self.config.username,
-                self.config.password,
-                issue_id
-            )
-        except faultType:
-            issue = None
-        if issue is None or issue['status']['id'] in [80, 90]:
+        if issue_id is None:
+            return None
+        status_id = None
+        if issue_id is not None and self.config.issue_status_ttl > 0:
+            status_id = self.db_spool.get_issue_status(
+                hostname, service, datetime.now() - timedelta(
+                    seconds=self.config.issue_status_ttl))
+
+        if status_id is not None:
+            issue = {'id': issue_id, 'status': {'id': status_id}}
+        elif self.issue_statuses is not None and \
+                issue_id in self.issue_statuses:
+            issue = {
+                'id': issue_id,
+                'status': {'id': self.issue_statuses[issue_id]},
+            }
+            self.cache_issue_status(hostname, service, issue)
+        else:
+            try:
+                issue = self.call(
+                    'mc_issue_get',
+                    self.config.username,
+                    self.config.password,
+                    issue_id
+                )
+            except faultType:
+                issue = None
+            self.cache_issue_status(hostname, service, issue)
+        if issue is None or issue['status']['id'] in CLOSED_STATUSES:
             self.db_spool.del_relation(hostname, service)
             issue = None
         return issue
 
-    def add_issue(self, hostname, service, issue, row_id):
+    def cache_issue_status(self, hostname, service, issue):
+        if issue is not None and self.config.issue_status_ttl > 0:
+            self.db_spool.set_issue_status(hostname, service,
+                                           issue['status']['id'])
+
+    def add_issue(self, hostname, service, issue, row_ids):
+        from SOAPpy import faultType
+
         try:
             # Open Mantis issue
             logging.info('Add an issue \'%s\'', issue['summary'])
-            issue_id = self.mantis.mc_issue_add(
+            issue_id = self.call(
+                'mc_issue_add',
                 self.config.username,
                 self.config.password,
                 issue
             )
-            self.db_spool.add_relation(hostname, service, issue_id)
-        except faultType:
+            self.db_spool.add_relation(hostname, service, issue_id,
+                                       issue['project']['id'])
+            # The next rows of the drain do not need to look it up
+            if self.issue_statuses is not None:
+                self.issue_statuses[issue_id] = NEW_STATUS
+        except faultType as fault:
             logging.exception(
                 'An error occured while adding an issue in Mantis. '
                 'Params where (%s, %s, %s).',
@@ -145,22 +1488,28 @@ class Nagios2Mantis(object):
                 self.config.password,
                 issue
             )
+            self.postpone(row_ids, fault)
         else:
-            self.db_spool.delete(row_id)
+            self.metrics.inc('nagios2mantis_rows_sent_total', len(row_ids))
+            self.db_spool.delete(*row_ids)
+            return issue_id
+
+    def add_note(self, issue_id, summary, row_ids):
+        from SOAPpy import faultType
 
-    def add_note(self, issue_id, summary, row_id):
         try:
             # Add a note
             logging.info('Add a note \'%s\' to issue %d', summary,
                          issue_id)
             note = {'text': summary}
-            self.mantis.mc_issue_note_add(
+            self.call(
+                'mc_issue_note_add',
                 self.config.username,
                 self.config.password,
                 issue_id,
                 note
             )
-        except faultType:
+        except faultType as fault:
             logging.exception(
                 'An error occured while adding a note in Mantis. '
                 'Params where (%s, %d, %s).',
@@ -168,13 +1517,18 @@ class Nagios2Mantis(object):
                 issue_id,
                 note
             )
+            self.db_spool.invalidate_issue_status(issue_id)
+            self.postpone(row_ids, fault)
         else:
-            self.db_spool.delete(row_id)
+            self.metrics.inc('nagios2mantis_rows_sent_total', len(row_ids))
+            self.db_spool.delete(*row_ids)
+            return True
 
-    def spool(self, hostname, state, service, plugin_output, project_id):
+    def spool(self, hostname, state, service, plugin_output, project_id,
+              instance=None):
         try:
             self.db_spool.add(hostname, state, service, plugin_output,
-                              project_id)
+                              project_id, instance)
             self.db_spool.close()
             self.notify()
         except:
@@ -185,44 +1539,329 @@ class Nagios2Mantis(object):
                 hostname, state, service, plugin_output, project_id
             )
 
+    def import_events(self, events, batch_size=5000):
+        # Spool events read by one of the IMPORT_FORMATS, batch_size rows per
+        # transaction. Returns the number of events spooled.
+        targets = {}
+        count = 0
+        rows = []
+        for event in events:
+            host_notes = event.pop('host_notes')
+            if host_notes not in targets:
+                targets[host_notes] = self.config.route(*parse_host_notes(
+                    host_notes and host_notes.encode('utf-8'),
+                    self.db_spool))
+            event['project_id'], event['instance'] = targets[host_notes]
+            rows.append(event)
+            if len(rows) >= batch_size:
+                count += self.import_rows(rows)
+                rows = []
+        count += self.import_rows(rows)
+        if count:
+            self.notify()
+        return count
+
+    def import_rows(self, rows):
+        if rows:
+            with self.db_spool.batch():
+                self.db_spool.add_many(*rows)
+            logging.info('Imported %d events', len(rows))
+        return len(rows)
+
     def notify(self):
         open(self.config.inotify_file, 'w').close()
 
+    def dead_letters(self, action, hostname=None, service=None, ids=None):
+        # Lists, requeues or purges the dead letters, all of them or those
+        # of a host, a service or with the given ids
+        if action == 'list':
+            return u''.join(
+                u'%d\t%s\t%s\t%s\t%s\t%d\t%s\n' % row
+                for row in self.db_spool.get_dead(hostname, service, ids))
+        if action == 'requeue':
+            count = self.db_spool.requeue_dead(hostname, service, ids)
+            if count:
+                self.notify()
+            return u'%d rows requeued\n' % count
+        return u'%d rows purged\n' % self.db_spool.purge_dead(
+            hostname, service, ids)
+
+    def clean(self):
+        # Forget the relations older than relation_max_age days, and those
+        # to resolved or closed issues, then shrink the spool file
+        started = datetime.now()
+        removed = self.db_spool.remove_old_rels(
+            started - timedelta(days=self.config.relation_max_age),
+            self.config.clean_batch_size)
+        logging.info('Removed %d relations older than %g days', removed,
+                     self.config.relation_max_age)
+        self.metrics.inc('nagios2mantis_relations_removed_total', removed,
+                         reason='age')
+        if self.config.verify_relations:
+            self.verify_relations(started)
+            for name in sorted(self.config.instances):
+                verifier = Nagios2Mantis(self.config.for_instance(name),
+                                         self.metrics)
+                try:
+                    verifier.verify_relations(started)
+                finally:
+                    verifier.db_spool.close()
+        self.db_spool.vacuum()
+        self.write_metrics()
+
+    def verify_relations(self, created_before):
+        # The issue statuses are loaded a project at a time. The pages shift
+        # as issues are updated meanwhile, so the issues missing from them
+        # are looked up one by one. Relations made while they are loaded, or
+        # without a known project, are kept.
+        from SOAPpy import faultType
+
+        relations = [relation for relation in
+                     self.db_spool.get_relations(created_before)
+                     if relation[2] is not None]
+        closed = []
+        try:
+            self.prefetch_issues(sorted(set(
+                project_id for row_id, issue_id, project_id in relations)))
+            for row_id, issue_id, project_id in relations:
+                status_id = self.issue_statuses.get(issue_id)
+                if status_id is None:
+                    try:
+                        status_id = self.call(
+                            'mc_issue_get',
+                            self.config.username,
+                            self.config.password,
+                            issue_id
+                        )['status']['id']
+                    except faultType:
+                        # The issue was deleted
+                        status_id = CLOSED_STATUSES[-1]
+                if status_id in CLOSED_STATUSES:
+                    closed.append(row_id)
+        finally:
+            self.issue_statuses = None
+        removed = self.db_spool.del_relations(closed,
+                                              self.config.clean_batch_size)
+        logging.info('Removed %d relations to closed issues', removed)
+        self.metrics.inc('nagios2mantis_relations_removed_total', removed,
+                         reason='closed')
+
 
 def empty(args):  # pragma: no cover
-    config = Config(args.configuration_file)
+    config = Config(args.configuration_file, args.config_snapshot)
     nagios2mantis = Nagios2Mantis(config)
     nagios2mantis.empty_cache()
 
 
-def get_project_id(host_notes):
-    if host_notes is not None and host_notes is not '':
-        host_notes = yaml.load(host_notes)
-        if 'mantis_project_id' in host_notes:
-            return host_notes['mantis_project_id']
-    return None
+def serve(args):  # pragma: no cover
+    config = Config(args.configuration_file, args.config_snapshot)
+    nagios2mantis = Nagios2Mantis(config)
+    nagios2mantis.serve()
 
 
-def spool(args):  # pragma: no cover
-    config = Config(args.configuration_file)
+def stats(args):  # pragma: no cover
+    config = Config(args.configuration_file, args.config_snapshot)
+    nagios2mantis = Nagios2Mantis(config)
+    sys.stdout.write(nagios2mantis.stats())
+
+
+def import_files(args):  # pragma: no cover
+    config = Config(args.configuration_file, args.config_snapshot)
     nagios2mantis = Nagios2Mantis(config)
+    read = IMPORT_FORMATS[args.format]
+    for filename in args.files:
+        with (sys.stdin if filename == '-' else open(filename)) as lines:
+            count = nagios2mantis.import_events(
+                read(lines, args.encoding), args.batch_size)
+        logging.info('Imported %d events from %s', count, filename)
+    nagios2mantis.db_spool.close()
 
-    project_id = get_project_id(args.host_notes) or config.project_id
 
+def parse_host_notes(host_notes, db_spool=None):
+    # Returns the mantis_project_id and mantis_instance of the host notes.
+    # Those of host notes needing a YAML parser are kept in the spool, when
+    # there is one, as host notes seldom change.
+    if not host_notes:
+        return None, None
+    match = PROJECT_ID_NOTES.match(host_notes)
+    if match:
+        return int(match.group(1)), None
+
+    if db_spool is not None:
+        digest = hashlib.sha1(host_notes).hexdigest()
+        cached = db_spool.get_host_notes(digest)
+        if cached is not None:
+            return cached
+
+    import yaml
+
+    try:
+        parsed = yaml.safe_load(host_notes)
+    except yaml.YAMLError:
+        logging.warning('Host notes %r are not valid YAML', host_notes)
+        parsed = None
+    project_id = instance = None
+    if isinstance(parsed, dict):
+        project_id = parsed.get('mantis_project_id')
+        instance = parsed.get('mantis_instance')
+        if instance is not None:
+            instance = str(instance)
+
+    if db_spool is not None:
+        db_spool.set_host_notes(digest, project_id, instance)
+    return project_id, instance
+
+
+def spool(args):  # pragma: no cover
+    config = Config(args.configuration_file, args.config_snapshot)
+
+    # Hand the event to nagios2mantis serve, or spool it ourselves
+    if config.spool_socket:
+        project_id, instance = config.route(
+            *parse_host_notes(args.host_notes))
+        if SpoolSocket(config.spool_socket).send(
+                args.hostname, args.state, args.service, args.plugin_output,
+                project_id, instance):
+            return
+    nagios2mantis = Nagios2Mantis(config)
+    project_id, instance = config.route(
+        *parse_host_notes(args.host_notes, nagios2mantis.db_spool))
     nagios2mantis.spool(args.hostname, args.state, args.service,
-                        args.plugin_output, project_id)
+                        args.plugin_output, project_id, instance)
+
+
+def dead(args):  # pragma: no cover
+    config = Config(args.configuration_file, args.config_snapshot)
+    nagios2mantis = Nagios2Mantis(config)
+    sys.stdout.write(nagios2mantis.dead_letters(
+        args.action, args.hostname, args.service, args.ids).encode('utf-8'))
+    nagios2mantis.db_spool.close()
 
 
 def clean(args):  # pragma: no cover
-    config = Config(args.configuration_file)
+    config = Config(args.configuration_file, args.config_snapshot)
     nagios2mantis = Nagios2Mantis(config)
-    one_month_ago = datetime.now() - timedelta(days=30)
-    nagios2mantis.remove_old_rels(one_month_ago)
+    nagios2mantis.clean()
+    nagios2mantis.db_spool.close()
 
 
 class DbSpool(object):
-    def __init__(self, sqlite_file):
+    JOURNAL_MODES = ['DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF']
+    SYNCHRONOUS = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+    SUPERSEDE = ['none', 'drop', 'fold']
+
+    def __init__(self, sqlite_file, journal_mode=None, synchronous=None,
+                 commit_every=100, page_size=500, metrics=None,
+                 supersede='none', instance=None, instances=()):
+        self.metrics = metrics or Metrics()
+        self.supersede = supersede
+        # Rows, relations and the circuit breaker are those of a Mantis
+        # instance. The default one also takes the rows of the instances
+        # which are not configured anymore.
+        self.instance = instance
+        self.instances = sorted(instances)
         self.db = sqlite3.connect(sqlite_file, timeout=120)
+        # Only takes effect on a new spool, before its journal mode or any
+        # table is written: the others are rebuilt by the first vacuum(),
+        # run by clean rather than by whichever process opens the spool
+        self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        if journal_mode is not None:
+            if journal_mode.upper() not in self.JOURNAL_MODES:
+                raise ValueError('Unknown journal mode %s' % journal_mode)
+            self.db.execute('PRAGMA journal_mode = %s' % journal_mode)
+        if synchronous is not None:
+            if synchronous.upper() not in self.SYNCHRONOUS:
+                raise ValueError('Unknown synchronous level %s' % synchronous)
+            self.db.execute('PRAGMA synchronous = %s' % synchronous)
+        self.commit_every = commit_every
+        self.page_size = page_size
+        self.pending = None
+        self.migrate()
+
+    @contextmanager
+    def batch(self):
+        # Writes made in the block are kept and run in a single transaction
+        # every commit_every writes and at the end of the block, so that the
+        # database is locked once per batch instead of once per write
+        self.pending = []
+        try:
+            yield
+        finally:
+            self.flush()
+            self.pending = None
+
+    def write(self, request, *params):
+        if self.pending is None:
+            with self.metrics.timer('nagios2mantis_spool_seconds',
+                                    operation='write'):
+                self.db.executemany(request, params)
+                self.db.commit()
+            return
+        self.pending.append((request, params))
+        if len(self.pending) >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        try:
+            with self.metrics.timer('nagios2mantis_spool_seconds',
+                                    operation='commit'):
+                for request, params in pending:
+                    try:
+                        self.db.executemany(request, params)
+                    except sqlite3.IntegrityError:
+                        logging.exception('Writing %s with %s failed',
+                                          request, params)
+                self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+
+    def migrate(self):
+        # Upgrade the database in place, from its PRAGMA user_version to the
+        # last migration. The processes opening an older spool at once, as
+        # in an alert storm right after an upgrade, take the write lock in
+        # turn: the first one migrates, the others find it up to date.
+        migrations = [
+            self.create_tables,
+            self.add_status_columns,
+            self.add_relation_indexes,
+            self.add_lease_columns,
+            self.add_retry_columns,
+            self.add_creation_column,
+            self.add_transitions_column,
+            self.create_host_notes_table,
+            self.add_relation_project_column,
+            self.enable_incremental_vacuum,
+            self.add_instance_columns,
+            self.create_dead_table,
+            self.create_limiter_table,
+            self.add_failures_column,
+        ]
+        if self.db.execute('PRAGMA user_version').fetchone()[0] == \
+                len(migrations):
+            return
+        # Without an isolation level, the sqlite3 module does not commit
+        # before each schema change, and the migrations run in a single
+        # transaction
+        isolation_level = self.db.isolation_level
+        self.db.isolation_level = None
+        try:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                version = self.db.execute(
+                    'PRAGMA user_version').fetchone()[0]
+                for version in range(version, len(migrations)):
+                    migrations[version]()
+                self.db.execute('PRAGMA user_version = %d' % len(migrations))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+        finally:
+            self.db.isolation_level = isolation_level
+
+    def create_tables(self):
         self.db.execute('''
 CREATE TABLE IF NOT EXISTS nagios2mantis (
   id INTEGER PRIMARY KEY,
@@ -240,98 +1879,598 @@ CREATE TABLE IF NOT EXISTS nagios_mantis_relation(
   creation DATETIME
 )''')
 
-    def add_relation(self, hostname, service, issue_id):
-        db_issue_id = self.get_issue_id(hostname, service)
-        assert not db_issue_id, 'A relation for hostname %s and service %s '\
-            'and with issue_id %d already exists' % (hostname, service,
-                                                     issue_id)
+    def add_status_columns(self):
+        self.add_column('nagios_mantis_relation', 'status_id', 'INTEGER')
+        self.add_column('nagios_mantis_relation', 'status_fetched',
+                        'DATETIME')
+
+    def add_relation_indexes(self):
+        # Keep the last relation of each hostname and service
+        self.db.execute('''
+DELETE FROM nagios_mantis_relation
+WHERE rowid NOT IN (
+  SELECT MAX(rowid) FROM nagios_mantis_relation
+  GROUP BY hostname, IFNULL(service, ''))''')
+        self.db.execute('''
+CREATE UNIQUE INDEX IF NOT EXISTS nagios_mantis_relation_key
+ON nagios_mantis_relation (hostname, IFNULL(service, ''))''')
+        self.db.execute('''
+CREATE INDEX IF NOT EXISTS nagios_mantis_relation_creation
+ON nagios_mantis_relation (creation)''')
+
+    def add_lease_columns(self):
+        self.add_column('nagios2mantis', 'worker', 'TEXT')
+        self.add_column('nagios2mantis', 'lease_expiry', 'DATETIME')
+        self.db.execute('''
+CREATE INDEX IF NOT EXISTS nagios2mantis_key
+ON nagios2mantis (hostname, IFNULL(service, ''))''')
+
+    def add_retry_columns(self):
+        self.add_column('nagios2mantis', 'attempts',
+                        'INTEGER NOT NULL DEFAULT 0')
+        self.add_column('nagios2mantis', 'next_attempt', 'DATETIME')
+        self.db.execute('''
+CREATE TABLE IF NOT EXISTS nagios2mantis_breaker (
+  id INTEGER PRIMARY KEY,
+  opened INTEGER NOT NULL,
+  open_until DATETIME
+)''')
+
+    def add_creation_column(self):
+        self.add_column('nagios2mantis', 'creation', 'DATETIME')
 
+    def add_transitions_column(self):
+        self.add_column('nagios2mantis', 'transitions',
+                        'INTEGER NOT NULL DEFAULT 1')
+
+    def create_host_notes_table(self):
+        self.db.execute('''
+CREATE TABLE IF NOT EXISTS nagios2mantis_host_notes (
+  digest TEXT PRIMARY KEY,
+  project_id INTEGER
+)''')
+
+    def add_relation_project_column(self):
+        self.add_column('nagios_mantis_relation', 'project_id', 'INTEGER')
+
+    def enable_incremental_vacuum(self):
+        # Kept so that the versions of the spools do not change: auto_vacuum
+        # is set as the spool is opened, as it cannot be once tables exist
+        pass
+
+    def add_instance_columns(self):
+        for table in ('nagios2mantis', 'nagios_mantis_relation',
+                      'nagios2mantis_breaker', 'nagios2mantis_host_notes'):
+            self.add_column(table, 'instance', 'TEXT')
+
+    def create_dead_table(self):
+        self.db.execute('''
+CREATE TABLE IF NOT EXISTS nagios2mantis_dead (
+  id INTEGER PRIMARY KEY,
+  hostname TEXT,
+  state TEXT,
+  service TEXT,
+  plugin_output TEXT,
+  project_id INTEGER,
+  instance TEXT,
+  creation DATETIME,
+  transitions INTEGER NOT NULL DEFAULT 1,
+  attempts INTEGER NOT NULL,
+  error TEXT,
+  died DATETIME
+)''')
+
+    def create_limiter_table(self):
+        self.db.execute('''
+CREATE TABLE IF NOT EXISTS nagios2mantis_limiter (
+  id INTEGER PRIMARY KEY,
+  instance TEXT,
+  rate REAL NOT NULL,
+  tokens REAL NOT NULL,
+  updated REAL NOT NULL,
+  decreased REAL
+)''')
+
+    def add_failures_column(self):
+        # The attempts which failed for another reason than Mantis being
+        # unreachable
+        self.add_column('nagios2mantis', 'failures',
+                        'INTEGER NOT NULL DEFAULT 0')
+
+    def add_column(self, table, column, definition):
+        columns = [row[1] for row in
+                   self.db.execute('PRAGMA table_info(%s)' % table)]
+        if column not in columns:
+            self.db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                table, column, definition))
+
+    def add_relation(self, hostname, service, issue_id, project_id=None):
+        # Raises sqlite3.IntegrityError if a relation already exists. The
+        # relation of a host moved from another Mantis instance is replaced.
         params = {
             'hostname': hostname,
             'service': service,
             'issue_id': issue_id,
+            'project_id': project_id,
+            'instance': self.instance,
             'creation': datetime.now(),
         }
-        self.db.execute('''
+        self.write('''DELETE FROM nagios_mantis_relation
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '')
+        AND IFNULL(instance, '') != IFNULL(:instance, '');''', params)
+        self.write('''
         INSERT INTO nagios_mantis_relation
-        (hostname, service, issue_id, creation)
-        VALUES (:hostname, :service, :issue_id, :creation);''', params)
-        self.db.commit()
+        (hostname, service, issue_id, project_id, instance, creation)
+        VALUES (:hostname, :service, :issue_id, :project_id, :instance,
+        :creation);''', params)
 
+    # The relations are looked up with the expression of the unique index
     def get_issue_id(self, hostname, service):
-        if service is None:
-            request = '''SELECT issue_id
-            FROM nagios_mantis_relation
-            WHERE hostname = :hostname AND service IS :service;'''
-        else:
-            request = '''SELECT issue_id
-            FROM nagios_mantis_relation
-            WHERE hostname = :hostname AND service = :service;'''
-        cursor = self.db.cursor()
-        cursor.execute(request, {'hostname': hostname, 'service': service})
-        try:
-            rows = cursor.fetchall()
-            assert len(rows) <= 1, 'More than one issue found for hostname '\
-                '%s and service %s' % (hostname, service)
-            if len(rows) == 0:
-                return None
-            return rows[0][0]
-        finally:
-            cursor.close()
+        row = self.db.execute('''SELECT issue_id
+        FROM nagios_mantis_relation
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '')
+        AND IFNULL(instance, '') = IFNULL(:instance, '');''', {
+            'hostname': hostname,
+            'service': service,
+            'instance': self.instance,
+        }).fetchone()
+        if row is None:
+            return None
+        return row[0]
 
     def del_relation(self, hostname, service):
-        if service is None:
-            request = '''DELETE FROM nagios_mantis_relation
-            WHERE hostname = :hostname AND service IS :service;'''
-        else:
-            request = '''DELETE FROM nagios_mantis_relation
-            WHERE hostname = :hostname AND service = :service;'''
+        self.write('''DELETE FROM nagios_mantis_relation
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '');''',
+                   {'hostname': hostname, 'service': service})
 
-        self.db.execute(request, {'hostname': hostname, 'service': service})
-        self.db.commit()
+    def get_issue_status(self, hostname, service, fetched_after):
+        row = self.db.execute('''SELECT status_id
+        FROM nagios_mantis_relation
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '')
+        AND status_fetched > :fetched_after;''', {
+            'hostname': hostname,
+            'service': service,
+            'fetched_after': fetched_after,
+        }).fetchone()
+        if row is None:
+            return None
+        return row[0]
 
-    def remove_old_rels(self, creation_date):
-        self.db.execute(
-            'DELETE FROM nagios_mantis_relation '
-            'WHERE creation < :creation_date',
-            {'creation_date': creation_date}
-        )
-        self.db.commit()
+    def set_issue_status(self, hostname, service, status_id):
+        self.write('''UPDATE nagios_mantis_relation
+        SET status_id = :status_id, status_fetched = :status_fetched
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '');''', {
+            'hostname': hostname,
+            'service': service,
+            'status_id': status_id,
+            'status_fetched': datetime.now(),
+        })
+
+    def invalidate_issue_status(self, issue_id):
+        self.write('''UPDATE nagios_mantis_relation
+        SET status_id = NULL, status_fetched = NULL
+        WHERE issue_id = :issue_id
+        AND IFNULL(instance, '') = IFNULL(:instance, '');''', {
+            'issue_id': issue_id,
+            'instance': self.instance,
+        })
+
+    def remove_old_rels(self, creation_date, batch_size=1000):
+        # Deleted through the creation index, batch_size relations per
+        # transaction so that the spool is never locked for long
+        removed = 0
+        while True:
+            with self.metrics.timer('nagios2mantis_spool_seconds',
+                                    operation='clean'):
+                deleted = self.db.execute('''DELETE FROM nagios_mantis_relation
+                WHERE rowid IN (
+                  SELECT rowid FROM nagios_mantis_relation
+                  WHERE creation < :creation_date
+                  LIMIT :batch_size);''', {
+                    'creation_date': creation_date,
+                    'batch_size': batch_size,
+                }).rowcount
+                self.db.commit()
+            removed += deleted
+            if deleted < batch_size:
+                return removed
+
+    def get_relations(self, created_before):
+        return self.db.execute('''SELECT rowid, issue_id, project_id
+        FROM nagios_mantis_relation
+        WHERE creation < :created_before
+        AND project_id IS NOT NULL
+        AND IFNULL(instance, '') = IFNULL(:instance, '');''', {
+            'created_before': created_before,
+            'instance': self.instance,
+        }).fetchall()
+
+    def del_relations(self, row_ids, batch_size=1000):
+        for start in range(0, len(row_ids), batch_size):
+            with self.metrics.timer('nagios2mantis_spool_seconds',
+                                    operation='clean'):
+                self.db.executemany(
+                    'DELETE FROM nagios_mantis_relation WHERE rowid = ?',
+                    [(row_id,) for row_id in
+                     row_ids[start:start + batch_size]])
+                self.db.commit()
+        return len(row_ids)
+
+    def vacuum(self):
+        # The file is rebuilt once to be incremental, then each step of the
+        # pragma frees a page
+        with self.metrics.timer('nagios2mantis_spool_seconds',
+                                operation='vacuum'):
+            if self.db.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                self.db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                self.db.execute('VACUUM')
+            self.db.execute('PRAGMA incremental_vacuum').fetchall()
 
     def close(self):
         self.db.close()
 
-    def add(self, hostname, state, service, plugin_output, project_id):
-        encoding = locale.getpreferredencoding()
-        u = lambda s: s is not None and unicode(s, encoding) or None
-        request_params = {
-            'hostname': u(hostname),
-            'state': u(state),
-            'service': u(service),
-            'plugin_output': u(plugin_output),
-            'project_id': project_id
-        }
-        self.db.execute('''INSERT INTO nagios2mantis
-        (hostname, state, service, plugin_output, project_id)
-        VALUES (:hostname, :state, :service, :plugin_output, :project_id);''',
-                        request_params)
+    def add(self, hostname, state, service, plugin_output, project_id,
+            instance=None):
+        self.add_many(spooled_row(hostname, state, service, plugin_output,
+                                  project_id, instance))
+
+    def add_many(self, *rows):
+        if self.supersede == 'none':
+            self.write('''INSERT INTO nagios2mantis
+            (hostname, state, service, plugin_output, project_id, instance,
+             creation)
+            VALUES (:hostname, :state, :service, :plugin_output, :project_id,
+            :instance, CURRENT_TIMESTAMP);''', *rows)
+            return
+
+        # Only the last row of each hostname and service is kept. It takes
+        # the place of the rows no worker is sending, keeping the creation
+        # date and the retries of the oldest one.
+        now = datetime.now()
+        latest = OrderedDict()
+        for row in rows:
+            previous = latest.pop((row['hostname'], row['service']), None)
+            latest[row['hostname'], row['service']] = dict(
+                row, now=now,
+                transitions=previous['transitions'] + 1 if previous else 1)
+        rows = latest.values()
+        self.write('''INSERT INTO nagios2mantis
+        (hostname, state, service, plugin_output, project_id, instance,
+         creation, transitions, attempts, failures, next_attempt)
+        SELECT :hostname, :state, :service, :plugin_output, :project_id,
+        :instance, IFNULL(MIN(creation), CURRENT_TIMESTAMP),
+        :transitions + IFNULL(SUM(transitions), 0),
+        IFNULL(MAX(attempts), 0), IFNULL(MAX(failures), 0), MAX(next_attempt)
+        FROM nagios2mantis
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '')
+        AND (worker IS NULL OR lease_expiry < :now);''', *rows)
+        self.write('''DELETE FROM nagios2mantis
+        WHERE hostname = :hostname
+        AND IFNULL(service, '') = IFNULL(:service, '')
+        AND (worker IS NULL OR lease_expiry < :now)
+        AND id < (
+          SELECT MAX(id) FROM nagios2mantis
+          WHERE hostname = :hostname
+          AND IFNULL(service, '') = IFNULL(:service, ''));''', *rows)
+
+    def get_host_notes(self, digest):
+        # Returns a (project_id, instance) tuple, or None for unknown host
+        # notes
+        row = self.db.execute('''SELECT project_id, instance
+        FROM nagios2mantis_host_notes
+        WHERE digest = :digest''', {'digest': digest}).fetchone()
+        if row is None or row[1] is None:
+            return row
+        return row[0], str(row[1])
+
+    def set_host_notes(self, digest, project_id, instance=None):
+        self.write('''INSERT OR REPLACE INTO nagios2mantis_host_notes
+        (digest, project_id, instance)
+        VALUES (:digest, :project_id, :instance);''', {
+            'digest': digest,
+            'project_id': project_id,
+            'instance': instance,
+        })
+
+    def get_transitions(self, ids):
+        # Returns how many notifications the rows stand for, by id
+        return dict(self.db.execute('''SELECT id, transitions
+        FROM nagios2mantis
+        WHERE id IN (%s)''' % ', '.join('?' * len(ids)), ids).fetchall())
+
+    def pages(self, after_id=0, worker=None, lease=None):
+        # Read the spool by bounded pages of rows, in id order, so that it is
+        # never loaded in memory as a whole. With a worker, only the rows it
+        # managed to lease are returned.
+        while True:
+            if worker is not None:
+                with self.metrics.timer('nagios2mantis_spool_seconds',
+                                        operation='claim'):
+                    self.claim(worker, after_id, lease)
+            with self.metrics.timer('nagios2mantis_spool_seconds',
+                                    operation='page'):
+                rows = self.db.execute('''
+            SELECT id, hostname, state, service, plugin_output, project_id
+            FROM nagios2mantis
+            WHERE id > :after_id AND (:worker IS NULL OR worker = :worker)
+            ORDER BY id
+            LIMIT :limit''', {
+                    'after_id': after_id,
+                    'worker': worker,
+                    'limit': self.page_size,
+                }).fetchall()
+            if rows:
+                yield rows
+            if len(rows) < self.page_size:
+                return
+            after_id = rows[-1][0]
+
+    def claim(self, worker, after_id, lease):
+        # Lease the next page of rows to the worker in a single statement.
+        # Rows whose lease has expired are claimed again, but not the rows
+        # of a hostname and service another worker holds a lease on, nor the
+        # rows of a hostname and service with a postponed row, so that they
+        # are still sent in order.
+        now = datetime.now()
+        self.db.execute('''
+        UPDATE nagios2mantis
+        SET worker = :worker, lease_expiry = :lease_expiry
+        WHERE id IN (
+          SELECT id FROM nagios2mantis AS row
+          WHERE id > :after_id
+          AND %s
+          AND (worker IS NULL OR worker = :worker OR lease_expiry < :now)
+          AND NOT EXISTS (
+            SELECT 1 FROM nagios2mantis AS other
+            WHERE other.hostname = row.hostname
+            AND IFNULL(other.service, '') = IFNULL(row.service, '')
+            AND other.worker != :worker
+            AND other.lease_expiry >= :now)
+          AND NOT EXISTS (
+            SELECT 1 FROM nagios2mantis AS postponed
+            WHERE postponed.hostname = row.hostname
+            AND IFNULL(postponed.service, '') = IFNULL(row.service, '')
+            AND postponed.next_attempt > :now)
+          ORDER BY id
+          LIMIT :limit)''' % self.instance_filter(), dict({
+            'worker': worker,
+            'lease_expiry': now + lease,
+            'after_id': after_id,
+            'now': now,
+            'limit': self.page_size,
+        }, **self.instance_params()))
+        self.db.commit()
+
+    def instance_filter(self):
+        if self.instance is not None:
+            return 'row.instance = :instance'
+        return 'IFNULL(row.instance, \'\') NOT IN (%s)' % ', '.join(
+            ':instance%d' % index for index in range(len(self.instances)))
+
+    def instance_params(self):
+        params = {'instance': self.instance}
+        for index, instance in enumerate(self.instances):
+            params['instance%d' % index] = instance
+        return params
+
+    def renew(self, worker, ids, lease):
+        # Extends the lease of the worker on the rows, at once whatever the
+        # batch, and returns how many of them it still holds
+        try:
+            renewed = self.db.execute('''UPDATE nagios2mantis
+            SET lease_expiry = ?
+            WHERE worker = ? AND id IN (%s)''' % ', '.join('?' * len(ids)),
+                                      [datetime.now() + lease, worker] +
+                                      list(ids)).rowcount
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return renewed
+
+    def release(self, worker):
+        self.write('''UPDATE nagios2mantis
+        SET worker = NULL, lease_expiry = NULL
+        WHERE worker = :worker;''', {'worker': worker})
+
+    def postpone(self, ids, backoff, error=None, max_attempts=0,
+                 transient=False):
+        # backoff(attempts) is the delay before a row which failed attempts
+        # times is tried again. With max_attempts, the rows which failed
+        # that many times, not counting the transient failures, are moved to
+        # the dead letters along with error. Returns the ids of those rows.
+        now = datetime.now()
+        attempts = self.db.execute('''SELECT id, attempts, failures
+        FROM nagios2mantis WHERE id IN (%s)''' % ', '.join('?' * len(ids)),
+                                   ids).fetchall()
+        failed = 0 if transient else 1
+        self.write('''UPDATE nagios2mantis
+        SET attempts = :attempts, failures = :failures,
+        next_attempt = :next_attempt
+        WHERE id = :id;''', *[{
+            'id': id,
+            'attempts': attempt + 1,
+            'failures': failures + failed,
+            'next_attempt': now + backoff(attempt + 1),
+        } for id, attempt, failures in attempts])
+        dead = [{'id': id, 'error': error, 'now': now}
+                for id, attempt, failures in attempts
+                if max_attempts and failed and
+                failures + failed >= max_attempts]
+        if dead:
+            self.write('''INSERT INTO nagios2mantis_dead
+            (hostname, state, service, plugin_output, project_id, instance,
+             creation, transitions, attempts, error, died)
+            SELECT hostname, state, service, plugin_output, project_id,
+            instance, creation, transitions, attempts, :error, :now
+            FROM nagios2mantis WHERE id = :id;''', *dead)
+            self.delete(*[row['id'] for row in dead])
+        return [row['id'] for row in dead]
+
+    def get_dead(self, hostname=None, service=None, ids=None):
+        # Returns the id, death date, hostname, service, state, attempts and
+        # error of the dead letters
+        where, params = self.dead_filter(hostname, service, ids)
+        return self.db.execute('''SELECT id, died, hostname,
+        IFNULL(service, ''), state, attempts, error
+        FROM nagios2mantis_dead WHERE %s ORDER BY id''' % where,
+                               params).fetchall()
+
+    def requeue_dead(self, hostname=None, service=None, ids=None):
+        # The rows get new ids, after those already in the spool
+        where, params = self.dead_filter(hostname, service, ids)
+        count = self.db.execute('''INSERT INTO nagios2mantis
+        (hostname, state, service, plugin_output, project_id, instance,
+         creation, transitions)
+        SELECT hostname, state, service, plugin_output, project_id, instance,
+        creation, transitions
+        FROM nagios2mantis_dead WHERE %s ORDER BY id''' % where,
+                                params).rowcount
+        self.db.execute('DELETE FROM nagios2mantis_dead WHERE %s' % where,
+                        params)
         self.db.commit()
+        return count
+
+    def purge_dead(self, hostname=None, service=None, ids=None):
+        where, params = self.dead_filter(hostname, service, ids)
+        count = self.db.execute(
+            'DELETE FROM nagios2mantis_dead WHERE %s' % where,
+            params).rowcount
+        self.db.commit()
+        return count
+
+    def dead_filter(self, hostname, service, ids):
+        where = ['1']
+        params = {'hostname': hostname, 'service': service}
+        if hostname is not None:
+            where.append('hostname = :hostname')
+        if service is not None:
+            where.append('service = :service')
+        if ids:
+            where.append('id IN (%s)' % ', '.join(
+                ':id%d' % index for index in range(len(ids))))
+            params.update(('id%d' % index, id)
+                          for index, id in enumerate(ids))
+        return ' AND '.join(where), params
 
-    def rows(self):
-        cursor = self.db.cursor()
-        cursor.execute('''
-        SELECT id, hostname, state, service, plugin_output, project_id
-        FROM nagios2mantis''')
+    def get_breaker(self, now):
+        # Returns how many times in a row the circuit breaker was opened,
+        # and until when it is open if it still is at that time
+        row = self.db.execute('''SELECT opened,
+        CASE WHEN open_until > :now THEN open_until END
+        FROM nagios2mantis_breaker
+        WHERE IFNULL(instance, '') = IFNULL(:instance, '')''', {
+            'now': now,
+            'instance': self.instance,
+        }).fetchone()
+        return row or (0, None)
+
+    def set_breaker(self, opened, open_until):
+        self.write('''INSERT OR REPLACE INTO nagios2mantis_breaker
+        (id, instance, opened, open_until)
+        VALUES ((SELECT id FROM nagios2mantis_breaker
+                 WHERE IFNULL(instance, '') = IFNULL(:instance, '')),
+        :instance, :opened, :open_until);''', {
+            'instance': self.instance,
+            'opened': opened,
+            'open_until': open_until,
+        })
+
+    def take_token(self, now, min_rate, max_rate, burst):
+        # Takes a token from the bucket of the instance, refilled at its rate
+        # since it was last used, up to burst tokens, and returns the seconds
+        # to wait for it. Tokens are taken ahead, so that the callers of all
+        # processes get them in turn. The bucket is updated and read in the
+        # same transaction, and committed at once, whatever the batch.
+        params = {
+            'instance': self.instance,
+            'now': now,
+            'min_rate': min_rate,
+            'max_rate': max_rate,
+            'burst': burst,
+        }
         try:
-            return cursor.fetchall()
-        finally:
-            cursor.close()
+            updated = self.db.execute('''UPDATE nagios2mantis_limiter
+            SET tokens = MIN(:burst, tokens + MAX(0, :now - updated) *
+                             MAX(:min_rate, MIN(rate, :max_rate))) - 1,
+            rate = MAX(:min_rate, MIN(rate, :max_rate)),
+            updated = MAX(updated, :now)
+            WHERE IFNULL(instance, '') = IFNULL(:instance, '')''',
+                                      params).rowcount
+            if not updated:
+                self.db.execute('''INSERT OR REPLACE INTO nagios2mantis_limiter
+                (id, instance, rate, tokens, updated)
+                VALUES ((SELECT id FROM nagios2mantis_limiter
+                         WHERE IFNULL(instance, '') = IFNULL(:instance, '')),
+                :instance, :max_rate, :burst - 1, :now)''', params)
+            tokens, rate = self.get_limiter()
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return max(0, -tokens / rate)
+
+    def adapt_rate(self, now, congested, min_rate, max_rate, burst):
+        # Additive increase, multiplicative decrease: the rate is halved when
+        # Mantis is congested, at most once a second, and grows back by a
+        # twentieth of max_rate after each other call. Returns the new rate.
+        try:
+            self.db.execute('''UPDATE nagios2mantis_limiter
+            SET tokens = MIN(:burst, tokens + MAX(0, :now - updated) * rate),
+            updated = MAX(updated, :now),
+            rate = CASE
+              WHEN NOT :congested THEN MIN(:max_rate, rate + :max_rate / 20)
+              WHEN :now - IFNULL(decreased, 0) >= 1
+              THEN MAX(:min_rate, rate / 2)
+              ELSE rate END,
+            decreased = CASE
+              WHEN :congested AND :now - IFNULL(decreased, 0) >= 1 THEN :now
+              ELSE decreased END
+            WHERE IFNULL(instance, '') = IFNULL(:instance, '')''', {
+                'instance': self.instance,
+                'now': now,
+                'congested': congested,
+                'min_rate': min_rate,
+                'max_rate': max_rate,
+                'burst': burst,
+            })
+            limiter = self.get_limiter()
+            self.db.commit()
+        except:
+            self.db.rollback()
+            raise
+        return limiter[1] if limiter else max_rate
+
+    def get_limiter(self):
+        # Returns the tokens and the rate of the bucket of the instance
+        return self.db.execute('''SELECT tokens, rate
+        FROM nagios2mantis_limiter
+        WHERE IFNULL(instance, '') = IFNULL(:instance, '')''', {
+            'instance': self.instance,
+        }).fetchone()
+
+    def depth(self):
+        # Returns the number of rows in the spool, and the age in seconds of
+        # the oldest one
+        return self.db.execute('''SELECT COUNT(*),
+        strftime('%s', 'now') - strftime('%s', MIN(creation))
+        FROM nagios2mantis''').fetchone()
 
-    def delete(self, id):
-        self.db.execute('''DELETE FROM nagios2mantis
+    def rows(self, after_id=0):
+        for rows in self.pages(after_id):
+            for row in rows:
+                yield row
+
+    def delete(self, *ids):
+        self.write('''DELETE FROM nagios2mantis
         WHERE id = :id;''',
-                        {'id': id})
-        self.db.commit()
+                   *[{'id': id} for id in ids])
 
 
 class HelpAction(argparse._HelpAction):
@@ -362,19 +2501,98 @@ def main(cli_args):
         help='INI file containing Mantis parameters',
         default='/etc/nagios2mantis.ini'
     )
+    parser.add_argument(
+        '--config-snapshot',
+        help='File keeping the parsed configuration between runs, as long '
+             'as the INI file is not modified',
+        default='/var/lib/nagios2mantis/config.json'
+    )
     subparsers = parser.add_subparsers()
 
     empty_parser = subparsers.add_parser(
         'empty', help='Create mantis ticket and empty the spool')
     empty_parser.set_defaults(func=empty)
 
+    serve_parser = subparsers.add_parser(
+        'serve',
+        help='Stay in the foreground and empty the spool each time it is '
+             'notified, instead of relying on cron and incron'
+    )
+    serve_parser.set_defaults(func=serve)
+
     clean_parser = subparsers.add_parser(
         'clean',
-        help='Remove old relations between nagios host/service and mantis '
-             'ticket'
+        help='Remove the old relations between nagios hosts/services and '
+             'mantis tickets, and those to closed tickets when '
+             'verify_relations is set'
     )
     clean_parser.set_defaults(func=clean)
 
+    import_parser = subparsers.add_parser(
+        'import',
+        help='Add the notifications of a nagios.log, CSV or JSON lines file '
+             'to the spool'
+    )
+    import_parser.add_argument(
+        'files',
+        help='Files to import, - for the standard input',
+        nargs='*',
+        default=['-']
+    )
+    import_parser.add_argument(
+        '--format',
+        help='nagios for a Nagios log, csv or jsonl for hostname, state, '
+             'service, plugin_output and host_notes fields',
+        choices=IMPORT_FORMATS.keys(),
+        default='nagios'
+    )
+    import_parser.add_argument(
+        '--encoding',
+        help='Encoding of the files',
+        default='utf-8'
+    )
+    import_parser.add_argument(
+        '--batch-size',
+        help='Number of events spooled per transaction',
+        type=int,
+        default=5000
+    )
+    import_parser.set_defaults(func=import_files)
+
+    dead_parser = subparsers.add_parser(
+        'dead',
+        help='List, requeue or purge the events which failed max_attempts '
+             'times'
+    )
+    dead_parser.add_argument(
+        'action',
+        choices=['list', 'requeue', 'purge'],
+        nargs='?',
+        default='list'
+    )
+    dead_parser.add_argument(
+        '--hostname',
+        help='Only the events of this host'
+    )
+    dead_parser.add_argument(
+        '--service',
+        help='Only the events of this service'
+    )
+    dead_parser.add_argument(
+        '--ids',
+        help='Only the events with these ids, as listed',
+        type=int,
+        nargs='+'
+    )
+    dead_parser.set_defaults(func=dead)
+
+    stats_parser = subparsers.add_parser(
+        'stats',
+        help='Print the spool depth and the metrics of the previous runs in '
+             'the Prometheus text format'
+    )
+    stats_parser.set_defaults(func=stats)
+
     spool_parser = subparsers.add_parser(
         'spool', help='Add an new event in the spool')
     spool_parser.add_argument(
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+#
+# Measures how fast nagios2mantis empties its spool into a local FakeMantis:
+#
+#   PYTHONPATH=. python tests/benchmark.py --rows 1000 --latency 0.005
+
+import argparse
+import json
+import os.path
+import shutil
+import tempfile
+import time
+
+from fake_mantis import FakeMantis
+from nagios2mantis import Config
+from nagios2mantis import Nagios2Mantis
+
+STATES = ['DOWN', 'UP', 'CRITICAL', 'OK', 'WARNING']
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def seed(db_spool, rows, hosts, services):
+    # Spreads the rows over hosts times services keys, each key going
+    # through the states in turn, like Nagios notifications would
+    keys = [('host%d' % host, 'service%d' % service if service else None)
+            for host in range(hosts) for service in range(services)]
+    db_spool.add_many(*[{
+        'hostname': keys[row % len(keys)][0],
+        'state': STATES[row // len(keys) % len(STATES)],
+        'service': keys[row % len(keys)][1],
+        'plugin_output': 'Benchmark row %d' % row,
+        'project_id': 1 + row % 3,
+        'instance': None,
+    } for row in range(rows)])
+
+
+def run(rows=1000, hosts=50, services=5, latency=0, fault_rate=0,
+        error_rate=0, workers=1, transport='soappy', prefetch=False,
+        supersede='none'):
+    directory = tempfile.mkdtemp()
+    server = FakeMantis(latency, fault_rate, error_rate, seed=0)
+    try:
+        config = Config(os.path.join(os.path.dirname(__file__),
+                                     'nagios2mantis_test.ini'))
+        config.wsdl = server.wsdl
+        config.sqlite_file = os.path.join(directory, 'spool.sqlite')
+        config.inotify_file = os.path.join(directory, 'nagios2mantis.inotify')
+        config.workers = workers
+        config.transport = transport
+        config.prefetch_issues = prefetch
+        config.supersede = supersede
+        config.breaker_threshold = 0
+        nagios2mantis = Nagios2Mantis(config)
+        seed(nagios2mantis.db_spool, rows, hosts, services)
+        # The WSDL is downloaded once, before timing the drain
+        nagios2mantis.mantis
+
+        # A row is sent when it is deleted from the spool
+        done = []
+        delete = nagios2mantis.db_spool.delete
+
+        def counted_delete(*ids):
+            done.extend(ids)
+            delete(*ids)
+        nagios2mantis.db_spool.delete = counted_delete
+
+        # The latency of a row is the time taken to send its group, which
+        # does not depend on how many rows were spooled before it
+        latencies = []
+        empty_group = nagios2mantis.empty_group
+
+        def timed_empty_group(rows):
+            start = time.time()
+            try:
+                empty_group(rows)
+            finally:
+                latencies.extend([time.time() - start] * len(rows))
+        nagios2mantis.empty_group = timed_empty_group
+
+        start = time.time()
+        nagios2mantis.empty_cache()
+        elapsed = time.time() - start
+        calls = sum(server.calls.values())
+        return {
+            'rows': rows,
+            'sent': len(done),
+            'seconds': elapsed,
+            'rows_per_second': len(done) / elapsed if elapsed else None,
+            'calls': dict(server.calls),
+            'calls_per_row': float(calls) / rows if rows else None,
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+def main():  # pragma: no cover
+    parser = argparse.ArgumentParser(
+        description='Empty a spool into a local fake Mantis and report the '
+        'throughput of nagios2mantis')
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--hosts', type=int, default=50)
+    parser.add_argument('--services', type=int, default=5,
+                        help='Services per host, the first one being the '
+                        'host itself')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds the fake Mantis waits per call')
+    parser.add_argument('--fault-rate', type=float, default=0,
+                        help='Share of the calls answered with a SOAP fault')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Share of the calls answered with an HTTP 503')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--transport', choices=['soappy', 'keepalive'],
+                        default='soappy')
+    parser.add_argument('--prefetch', action='store_true')
+    parser.add_argument('--supersede', choices=['none', 'drop', 'fold'],
+                        default='none')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON, to keep a baseline')
+    args = parser.parse_args()
+
+    results = run(args.rows, args.hosts, args.services, args.latency,
+                  args.fault_rate, args.error_rate, args.workers,
+                  args.transport, args.prefetch, args.supersede)
+    if args.json:
+        print json.dumps(results, sort_keys=True)
+        return
+    print 'Rows sent:      %(sent)d/%(rows)d in %(seconds).2fs' % results
+    print 'Rows/s:         %(rows_per_second).1f' % results
+    print 'Calls per row:  %(calls_per_row).2f' % results
+    print 'Calls:          %s' % ', '.join(
+        '%s=%d' % call for call in sorted(results['calls'].items()))
+    print 'Send latency:   p50 %(p50).3fs, p99 %(p99).3fs' % results
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+
+import BaseHTTPServer
+import os.path
+import random
+import SocketServer
+import threading
+import time
+from collections import Counter
+
+import SOAPpy
+from SOAPpy import faultType
+
+NAMESPACE = 'http://futureware.biz/mantisconnect'
+WSDL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'mantisconnect.wsdl')
+WSDL_LOCATION = 'http://mantis.example.com/api/soap/mantisconnect.php'
+
+
+class FakeMantisHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Send each response at once: header lines written one by one are
+    # delayed by Nagle's algorithm on persistent connections
+    wbufsize = -1
+
+    def do_GET(self):
+        with open(WSDL_FILE) as wsdl_file:
+            wsdl = wsdl_file.read().replace(WSDL_LOCATION, self.server.url)
+        self.respond(200, wsdl)
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers['Content-Length']))
+        method = SOAPpy.parseSOAPRPC(request, header=1, body=1, attrs=1)[0]
+        try:
+            result = self.server.call(method._name,
+                                      SOAPpy.simplify(method._aslist()))
+        except HTTPError as error:
+            self.respond(error.status, '')
+        except faultType as fault:
+            self.respond(500, SOAPpy.buildSOAP(fault))
+        else:
+            self.respond(200, SOAPpy.buildSOAP(
+                kw={'return': result}, method=method._name + 'Response',
+                namespace=NAMESPACE))
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, status)
+        self.status = status
+
+
+class FakeMantis(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    # MantisConnect stand-in keeping its issues in memory. Each call waits
+    # latency seconds, then fails with a SOAP fault with probability
+    # fault_rate, or with an HTTP 503 with probability error_rate.
+    daemon_threads = True
+
+    def __init__(self, latency=0, fault_rate=0, error_rate=0, seed=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeMantisHandler)
+        self.latency = latency
+        self.fault_rate = fault_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.issues = {}
+        self.calls = Counter()
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/api/soap/mantisconnect.php' % \
+            self.server_address[1]
+
+    @property
+    def wsdl(self):
+        return self.url + '?wsdl'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def call(self, method, args):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.calls[method] += 1
+            draw = self.random.random()
+            if draw < self.error_rate:
+                raise HTTPError(503)
+            if draw < self.error_rate + self.fault_rate:
+                raise faultType('SOAP-ENV:Server', 'Injected fault')
+            return getattr(self, method)(*args[2:])
+
+    def mc_issue_get(self, issue_id):
+        issue = self.get_issue(issue_id)
+        return {'id': issue['id'], 'status': {'id': issue['status']}}
+
+    def mc_issue_add(self, issue):
+        issue_id = len(self.issues) + 1
+        self.issues[issue_id] = dict(issue, id=issue_id, status=10, notes=[])
+        return issue_id
+
+    def mc_issue_note_add(self, issue_id, note):
+        notes = self.get_issue(issue_id)['notes']
+        notes.append(note['text'])
+        return len(notes)
+
+    def mc_project_get_issue_headers(self, project_id, page_number,
+                                     per_page):
+        issues = sorted(
+            (issue for issue in self.issues.values()
+             if issue['project']['id'] == project_id),
+            key=lambda issue: issue['id'])
+        # Mantis repeats the last page past the end
+        start = min((page_number - 1) * per_page,
+                    max(0, (len(issues) - 1) // per_page * per_page))
+        return [{'id': issue['id'], 'status': issue['status']}
+                for issue in issues[start:start + per_page]]
+
+    def get_issue(self, issue_id):
+        if issue_id not in self.issues:
+            raise faultType('SOAP-ENV:Client', 'Issue does not exist')
+        return self.issues[issue_id]
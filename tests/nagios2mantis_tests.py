@@ -1,23 +1,60 @@
 #!/usr/bin/env python
 # -*- encoding: utf-8 -*-
 
+import BaseHTTPServer
 import ConfigParser
 from datetime import datetime
+from datetime import timedelta
+import errno
+import mimetools
 import os.path
+import select
+import shutil
+import signal
+import socket
+import SocketServer
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
 import time
 import unittest
+import httplib
+import urllib
+import urllib2
+from StringIO import StringIO
 
 import mock
 
+import SOAPpy
 from SOAPpy import faultType
-
+from SOAPpy.Client import HTTPTransport
+from SOAPpy.Errors import HTTPError
+
+import benchmark
+from fake_mantis import FakeMantis
+from nagios2mantis import backoff
+from nagios2mantis import coalesce
+from nagios2mantis import correlate
 from nagios2mantis import get_summary
 from nagios2mantis import DbSpool
 from nagios2mantis import main
 from nagios2mantis import Config
 from nagios2mantis import Nagios2Mantis
-from nagios2mantis import get_project_id
+from nagios2mantis import parse_host_notes
+from nagios2mantis import read_csv
+from nagios2mantis import read_jsonl
+from nagios2mantis import read_nagios_log
+from nagios2mantis import ConnectionPool
+from nagios2mantis import KeepAliveTransport
+from nagios2mantis import MantisProxy
+from nagios2mantis import Metrics
+from nagios2mantis import WsdlCache
+from nagios2mantis import SpoolSocket
+from nagios2mantis import Template
+from nagios2mantis import SpoolWriter
+from nagios2mantis import WorkerPool
 
 
 class GetSummaryTest(unittest.TestCase):
@@ -48,15 +85,97 @@ class DbSpoolTest(unittest.TestCase):
         issue_id = self.spool.get_issue_id('localhost', 'apache2')
         self.assertEquals(1, issue_id)
 
-    def test_get_issue_id_raises(self):
-        self.spool.db.execute('''
-        INSERT INTO nagios_mantis_relation (hostname, service, issue_id)
-        VALUES ('localhost', NULL, 1);''')
+    def test_relation_unique(self):
         self.spool.db.execute('''
         INSERT INTO nagios_mantis_relation (hostname, service, issue_id)
         VALUES ('localhost', NULL, 1);''')
-        with self.assertRaises(AssertionError):
-            self.spool.get_issue_id('localhost', None)
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.spool.db.execute('''
+            INSERT INTO nagios_mantis_relation (hostname, service, issue_id)
+            VALUES ('localhost', NULL, 2);''')
+
+    def test_get_issue_id_uses_index(self):
+        plan = self.spool.db.execute('''EXPLAIN QUERY PLAN
+        SELECT issue_id FROM nagios_mantis_relation
+        WHERE hostname = 'localhost' AND IFNULL(service, '') = '';''')
+        self.assertIn('nagios_mantis_relation_key', str(list(plan)))
+
+    def test_migrate(self):
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        db = sqlite3.connect(sqlite_file)
+        db.execute('''CREATE TABLE nagios_mantis_relation(
+        hostname TEXT, service TEXT, issue_id INTEGER, creation DATETIME)''')
+        db.executemany('''INSERT INTO nagios_mantis_relation
+        VALUES (?, ?, ?, NULL)''', [
+            ('localhost', None, 1),
+            ('localhost', None, 2),
+            ('localhost', 'apache2', 3),
+        ])
+        db.commit()
+        db.close()
+
+        spool = DbSpool(sqlite_file)
+
+        self.assertEquals(
+            spool.db.execute('PRAGMA user_version').fetchone()[0], 14)
+        # Rebuilt by clean only
+        self.assertEquals(
+            spool.db.execute('PRAGMA auto_vacuum').fetchone()[0], 0)
+        self.assertEquals(spool.get_issue_id('localhost', None), 2)
+        self.assertEquals(spool.get_issue_id('localhost', 'apache2'), 3)
+        spool.close()
+
+        spool = DbSpool(sqlite_file)
+        self.assertEquals(spool.get_issue_id('localhost', None), 2)
+        spool.close()
+
+    def old_spool(self):
+        # A spool made before the schema was versioned
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        db = sqlite3.connect(sqlite_file)
+        db.execute('''CREATE TABLE nagios_mantis_relation(
+        hostname TEXT, service TEXT, issue_id INTEGER, creation DATETIME)''')
+        db.commit()
+        db.close()
+        return sqlite_file
+
+    def test_migrate_concurrently(self):
+        sqlite_file = self.old_spool()
+        start = threading.Event()
+        errors = []
+
+        def open_spool():
+            start.wait()
+            try:
+                DbSpool(sqlite_file).close()
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=open_spool) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+
+    def test_migrate_failed(self):
+        sqlite_file = self.old_spool()
+        with mock.patch.object(DbSpool, 'add_instance_columns',
+                               side_effect=sqlite3.OperationalError):
+            with self.assertRaises(sqlite3.OperationalError):
+                DbSpool(sqlite_file)
+
+        db = sqlite3.connect(sqlite_file)
+        self.assertEquals(
+            db.execute('PRAGMA user_version').fetchone()[0], 0)
+        # Nothing was migrated
+        self.assertEquals(
+            len(list(db.execute('PRAGMA table_info(nagios_mantis_relation)'))),
+            4)
+        db.close()
 
     def assert_nb_nagios_mantis(self, expected_nb):
         nb = self.spool.db.execute(
@@ -72,7 +191,7 @@ class DbSpoolTest(unittest.TestCase):
 
     def test_add_relation_raises(self):
         self.spool.add_relation('hostname', None, 1)
-        with self.assertRaises(AssertionError):
+        with self.assertRaises(sqlite3.IntegrityError):
             self.spool.add_relation('hostname', None, 1)
 
     def test_del_relation_service_none(self):
@@ -85,32 +204,179 @@ class DbSpoolTest(unittest.TestCase):
         self.spool.del_relation('hostname', 'apache2')
         self.assert_nb_nagios_mantis(0)
 
+    def test_add_column(self):
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        db = sqlite3.connect(sqlite_file)
+        db.execute('''CREATE TABLE nagios_mantis_relation(
+        hostname TEXT, service TEXT, issue_id INTEGER, creation DATETIME)''')
+        db.execute('''INSERT INTO nagios_mantis_relation
+        VALUES ('localhost', NULL, 1, NULL)''')
+        db.commit()
+        db.close()
+
+        spool = DbSpool(sqlite_file)
+        spool.add_column('nagios_mantis_relation', 'status_id', 'INTEGER')
+        spool.set_issue_status('localhost', None, 10)
+
+        self.assertEquals(spool.get_issue_status(
+            'localhost', None, datetime.now() - timedelta(hours=1)), 10)
+
+    def test_issue_status(self):
+        self.spool.add_relation('localhost', None, 1)
+        self.spool.add_relation('localhost', 'apache2', 2)
+        an_hour_ago = datetime.now() - timedelta(hours=1)
+        self.assertIsNone(self.spool.get_issue_status(
+            'localhost', None, an_hour_ago))
+
+        self.spool.set_issue_status('localhost', None, 10)
+        self.spool.set_issue_status('localhost', 'apache2', 50)
+
+        self.assertEquals(self.spool.get_issue_status(
+            'localhost', None, an_hour_ago), 10)
+        self.assertEquals(self.spool.get_issue_status(
+            'localhost', 'apache2', an_hour_ago), 50)
+        self.assertIsNone(self.spool.get_issue_status(
+            'localhost', None, datetime.now()))
+
+    def test_invalidate_issue_status(self):
+        self.spool.add_relation('localhost', 'apache2', 2)
+        self.spool.set_issue_status('localhost', 'apache2', 50)
+
+        self.spool.invalidate_issue_status(2)
+
+        self.assertIsNone(self.spool.get_issue_status(
+            'localhost', 'apache2', datetime.now() - timedelta(hours=1)))
+
     def test_remove_old_rels(self):
         self.spool.add_relation('hostname', 'apache2', 1)
         time.sleep(1)
-        self.spool.remove_old_rels(datetime.now())
+        self.assertEquals(self.spool.remove_old_rels(datetime.now()), 1)
         self.assert_nb_nagios_mantis(0)
 
+    def test_remove_old_rels_batches(self):
+        for issue_id in range(5):
+            self.spool.add_relation('host%d' % issue_id, None, issue_id)
+        self.spool.db.execute('''UPDATE nagios_mantis_relation
+        SET creation = :creation''', {
+            'creation': datetime.now() - timedelta(days=31)})
+        self.spool.add_relation('localhost', None, 5)
+        self.spool.db.commit()
+
+        with mock.patch.object(self.spool, 'db',
+                               wraps=self.spool.db) as db_mock:
+            self.assertEquals(self.spool.remove_old_rels(
+                datetime.now() - timedelta(days=30), 2), 5)
+
+        self.assertEquals(db_mock.commit.call_count, 3)
+        self.assert_nb_nagios_mantis(1)
+        self.assertEquals(self.spool.get_issue_id('localhost', None), 5)
+
+    def test_remove_old_rels_uses_index(self):
+        plan = self.spool.db.execute('''EXPLAIN QUERY PLAN
+        SELECT rowid FROM nagios_mantis_relation
+        WHERE creation < '2013-01-01' LIMIT 1000;''')
+        self.assertIn('nagios_mantis_relation_creation', str(list(plan)))
+
+    def test_get_relations(self):
+        self.spool.add_relation('localhost', None, 1, 2)
+        self.spool.add_relation('localhost', 'apache2', 3)
+        created_before = datetime.now() + timedelta(seconds=1)
+        self.spool.add_relation('remote', None, 4, 2)
+        self.spool.db.execute('''UPDATE nagios_mantis_relation
+        SET creation = :creation WHERE hostname = 'remote';''', {
+            'creation': created_before})
+
+        self.assertEquals(self.spool.get_relations(created_before),
+                          [(1, 1, 2)])
+
+    def test_del_relations(self):
+        for issue_id in range(5):
+            self.spool.add_relation('host%d' % issue_id, None, issue_id)
+
+        with mock.patch.object(self.spool, 'db',
+                               wraps=self.spool.db) as db_mock:
+            self.assertEquals(self.spool.del_relations([1, 2, 4], 2), 3)
+
+        self.assertEquals(db_mock.commit.call_count, 2)
+        self.assertEquals(
+            self.spool.db.execute('''SELECT issue_id
+            FROM nagios_mantis_relation ORDER BY issue_id''').fetchall(),
+            [(2,), (4,)])
+
+    def test_vacuum(self):
+        # Made before auto_vacuum was set
+        sqlite_file = self.old_spool()
+        spool = DbSpool(sqlite_file)
+        self.assertEquals(
+            spool.db.execute('PRAGMA auto_vacuum').fetchone()[0], 0)
+        with spool.batch():
+            for issue_id in range(1000):
+                spool.add_relation('host%d' % issue_id, 'x' * 1000, issue_id)
+        size = os.path.getsize(sqlite_file)
+        spool.remove_old_rels(datetime.now() + timedelta(seconds=1))
+
+        spool.vacuum()
+
+        self.assertEquals(
+            spool.db.execute('PRAGMA freelist_count').fetchone()[0], 0)
+        self.assertLess(os.path.getsize(sqlite_file), size / 10)
+        self.assertEquals(
+            spool.db.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        spool.close()
+
+    def test_new_spool_incremental(self):
+        sqlite_file = os.path.join(tempfile.mkdtemp(), 'spool.sqlite')
+        self.addCleanup(shutil.rmtree, os.path.dirname(sqlite_file))
+        spool = DbSpool(sqlite_file, journal_mode='WAL')
+        self.assertEquals(
+            spool.db.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+        spool.close()
+
+    def test_vacuum_incremental(self):
+        with self.spool.batch():
+            for issue_id in range(1000):
+                self.spool.add_relation('host%d' % issue_id, 'x' * 1000,
+                                        issue_id)
+        self.spool.remove_old_rels(datetime.now() + timedelta(seconds=1))
+        self.spool.vacuum()
+        self.spool.db = mock.MagicMock(wraps=self.spool.db)
+
+        self.spool.vacuum()
+
+        self.assertNotIn(mock.call('VACUUM'),
+                         self.spool.db.execute.call_args_list)
+
     def test_add_service_none(self):
         self.spool.add('localhost', 'DOWN', None, 'NOT OK', 1)
-        result = self.spool.db.execute('SELECT * FROM nagios2mantis;')
+        result = self.spool.rows()
         self.assertEquals(tuple(result),
                           ((1, u'localhost', u'DOWN', None, u'NOT OK', 1),))
 
     def test_add_service_not_none(self):
         self.spool.add('localhost', 'DOWN', 'apache2', 'NOT OK', 1)
-        result = self.spool.db.execute('SELECT * FROM nagios2mantis;')
+        result = self.spool.rows()
         self.assertEquals(tuple(result), (
             (1, u'localhost', u'DOWN', 'apache2', u'NOT OK', 1),))
 
     def test_add_accent(self):
         self.spool.add('localhost', 'DOWN', None, 'é', 1)
-        result = self.spool.db.execute('SELECT * FROM nagios2mantis;')
+        result = self.spool.rows()
         self.assertEquals(
             tuple(result)[0],
             (1, u'localhost', u'DOWN', None, u'é', 1)
         )
 
+    def test_add_many(self):
+        self.spool.add_many(
+            {'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+             'plugin_output': u'KO', 'project_id': 1, 'instance': None},
+            {'hostname': u'localhost', 'state': u'UP', 'service': None,
+             'plugin_output': u'OK', 'project_id': 1, 'instance': None})
+        self.assertEquals(list(self.spool.rows()), [
+            (1, u'localhost', u'DOWN', None, u'KO', 1),
+            (2, u'localhost', u'UP', None, u'OK', 1)])
+
     def test_rows_0(self):
         result = self.spool.rows()
         self.assertEquals(tuple(result), ())
@@ -121,6 +387,354 @@ class DbSpoolTest(unittest.TestCase):
         self.assertEquals(tuple(result), (
             (1, u'localhost', u'DOWN', 'apache2', u'NOT OK', 1),))
 
+    def test_pages(self):
+        self.spool.page_size = 2
+        for i in range(5):
+            self.spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+
+        pages = [[row[0] for row in rows] for rows in self.spool.pages()]
+
+        self.assertEquals(pages, [[1, 2], [3, 4], [5]])
+
+    def test_pages_exact(self):
+        self.spool.page_size = 2
+        for i in range(4):
+            self.spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+
+        pages = [[row[0] for row in rows] for rows in self.spool.pages(1)]
+
+        self.assertEquals(pages, [[2, 3], [4]])
+
+    def test_rows_after_id(self):
+        for i in range(3):
+            self.spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+
+        self.assertEquals([row[0] for row in self.spool.rows(2)], [3])
+
+    def test_pages_leased(self):
+        lease = timedelta(seconds=60)
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.add('localhost', 'DOWN', 'apache2', 'KO', 1)
+        self.spool.add('remote', 'DOWN', None, 'KO', 1)
+        self.spool.add('localhost', 'UP', None, 'OK', 1)
+        self.spool.page_size = 1
+
+        first = [rows[0][0] for rows in self.spool.pages(0, 'first', lease)]
+        self.spool.add('remote', 'UP', None, 'OK', 1)
+        self.spool.add('other', 'DOWN', None, 'KO', 1)
+        self.spool.page_size = 10
+        second = [row[0] for rows in self.spool.pages(0, 'second', lease)
+                  for row in rows]
+
+        self.assertEquals(first, [1, 2, 3, 4])
+        self.assertEquals(second, [6])
+        self.assertEquals(len(list(self.spool.rows())), 6)
+
+    def test_pages_lease_expired(self):
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        list(self.spool.pages(0, 'first', timedelta(seconds=-1)))
+
+        rows = list(self.spool.pages(0, 'second', timedelta(seconds=60)))
+
+        self.assertEquals(len(rows), 1)
+
+    def test_renew(self):
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.add('remote', 'DOWN', None, 'KO', 1)
+        list(self.spool.pages(0, 'first', timedelta(seconds=-1)))
+
+        self.assertEquals(
+            self.spool.renew('first', [1], timedelta(seconds=60)), 1)
+
+        # Only the row whose lease expired is claimed by another worker
+        self.assertEquals(
+            [row[0] for rows in self.spool.pages(0, 'second',
+                                                 timedelta(seconds=60))
+             for row in rows], [2])
+        self.assertEquals(
+            self.spool.renew('first', [1, 2], timedelta(seconds=60)), 1)
+
+    def test_renew_rollback(self):
+        self.spool.db = mock.MagicMock()
+        self.spool.db.execute.side_effect = sqlite3.OperationalError
+        with self.assertRaises(sqlite3.OperationalError):
+            self.spool.renew('first', [1], timedelta(seconds=60))
+        self.spool.db.rollback.assert_called_once_with()
+
+    def test_postpone(self):
+        lease = timedelta(seconds=60)
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.add('remote', 'DOWN', None, 'KO', 1)
+        self.spool.add('localhost', 'UP', None, 'OK', 1)
+
+        self.spool.postpone([1], lambda attempts: timedelta(
+            seconds=60 * attempts))
+        self.spool.postpone([1], lambda attempts: timedelta(
+            seconds=60 * attempts))
+
+        self.assertEquals(self.spool.db.execute(
+            'SELECT attempts FROM nagios2mantis ORDER BY id').fetchall(),
+            [(2,), (0,), (0,)])
+        pages = self.spool.pages(0, 'first', lease)
+        self.assertEquals([row[0] for rows in pages for row in rows], [2])
+
+    def test_postpone_dead(self):
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.add('remote', 'DOWN', 'apache2', 'KO', 1, 'support')
+
+        def retry(attempts):
+            return timedelta(seconds=60)
+
+        self.assertEquals(self.spool.postpone([1, 2], retry, u'Fault', 2),
+                          [])
+        self.assertEquals(self.spool.postpone([1], retry, u'Transient', 2,
+                                              True), [])
+        self.assertEquals(self.spool.postpone([1, 2], retry, u'Fault: é',
+                                              2), [1, 2])
+
+        self.assertEquals(list(self.spool.rows()), [])
+        dead = self.spool.get_dead()
+        self.assertEquals([row[2:] for row in dead], [
+            (u'localhost', u'', u'DOWN', 3, u'Fault: é'),
+            (u'remote', u'apache2', u'DOWN', 2, u'Fault: é')])
+        self.assertEquals(self.spool.db.execute(
+            'SELECT instance FROM nagios2mantis_dead ORDER BY id').fetchall(),
+            [(None,), (u'support',)])
+
+    def test_postpone_transient(self):
+        # After an outage, a row is given max_attempts permanent failures
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        def retry(attempts):
+            return timedelta(seconds=60)
+
+        for i in range(9):
+            self.assertEquals(self.spool.postpone([1], retry, u'error', 10,
+                                                  True), [])
+        for i in range(9):
+            self.assertEquals(self.spool.postpone([1], retry, u'Fault', 10),
+                              [])
+        self.assertEquals(self.spool.postpone([1], retry, u'Fault', 10), [1])
+
+        self.assertEquals([row[2:] for row in self.spool.get_dead()], [
+            (u'localhost', u'', u'DOWN', 19, u'Fault')])
+
+    def test_dead(self):
+        def retry(attempts):
+            return timedelta(seconds=60)
+        for hostname, service in [('localhost', None),
+                                  ('localhost', 'apache2'),
+                                  ('remote', None)]:
+            self.spool.add(hostname, 'DOWN', service, 'KO', 1)
+        self.spool.postpone([1, 2, 3], retry, u'Fault', 1)
+
+        self.assertEquals(
+            [row[0] for row in self.spool.get_dead('localhost')], [1, 2])
+        self.assertEquals(
+            [row[0] for row in self.spool.get_dead(None, 'apache2')], [2])
+        self.assertEquals(
+            [row[0] for row in self.spool.get_dead(ids=[1, 3])], [1, 3])
+
+        self.assertEquals(self.spool.requeue_dead('localhost'), 2)
+        self.assertEquals(list(self.spool.rows()), [
+            (1, u'localhost', u'DOWN', None, u'KO', 1),
+            (2, u'localhost', u'DOWN', u'apache2', u'KO', 1)])
+        self.assertEquals(self.spool.db.execute(
+            'SELECT attempts FROM nagios2mantis').fetchall(), [(0,), (0,)])
+
+        self.assertEquals(self.spool.purge_dead(ids=[1, 2]), 0)
+        self.assertEquals(self.spool.purge_dead(), 1)
+        self.assertEquals(self.spool.get_dead(), [])
+
+    def test_postpone_expired(self):
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.postpone([1], lambda attempts: timedelta(seconds=-1))
+
+        rows = list(self.spool.pages(0, 'first', timedelta(seconds=60)))
+
+        self.assertEquals(len(rows), 1)
+
+    def test_breaker(self):
+        now = datetime.now()
+        self.assertEquals(self.spool.get_breaker(now), (0, None))
+
+        self.spool.set_breaker(1, now + timedelta(seconds=60))
+
+        self.assertEquals(self.spool.get_breaker(now),
+                          (1, str(now + timedelta(seconds=60))))
+        self.assertEquals(
+            self.spool.get_breaker(now + timedelta(seconds=120)), (1, None))
+
+    def test_instances(self):
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        default = DbSpool(sqlite_file, instances=['support'])
+        support = DbSpool(sqlite_file, instance='support')
+        for instance in [None, 'support', 'gone']:
+            default.add('host-%s' % instance, 'DOWN', None, 'KO', 1,
+                        instance)
+
+        lease = timedelta(seconds=60)
+        self.assertEquals(
+            [row[1] for rows in default.pages(0, 'first', lease)
+             for row in rows],
+            ['host-None', 'host-gone'])
+        self.assertEquals(
+            [row[1] for rows in support.pages(0, 'second', lease)
+             for row in rows],
+            ['host-support'])
+
+    def test_instance_breaker(self):
+        support = DbSpool(':memory:', instance='support')
+        support.db = self.spool.db
+        now = datetime.now()
+        self.spool.set_breaker(2, now + timedelta(seconds=60))
+
+        self.assertEquals(support.get_breaker(now), (0, None))
+        support.set_breaker(1, now + timedelta(seconds=60))
+        support.set_breaker(3, now + timedelta(seconds=60))
+
+        self.assertEquals(self.spool.get_breaker(now)[0], 2)
+        self.assertEquals(support.get_breaker(now)[0], 3)
+        self.assertEquals(self.spool.db.execute(
+            'SELECT COUNT(*) FROM nagios2mantis_breaker').fetchone()[0], 2)
+
+    def test_take_token(self):
+        # One call per second, in bursts of two
+        self.assertEquals(self.spool.take_token(100, 1, 1, 2), 0)
+        self.assertEquals(self.spool.take_token(100, 1, 1, 2), 0)
+        self.assertEquals(self.spool.take_token(100, 1, 1, 2), 1)
+        self.assertEquals(self.spool.take_token(100.5, 1, 1, 2), 1.5)
+        # The bucket does not hold more than the burst
+        self.assertEquals(self.spool.take_token(110, 1, 1, 2), 0)
+        self.assertEquals(self.spool.get_limiter(), (1, 1))
+        # A lower rate applies at once
+        self.assertEquals(self.spool.take_token(110, 0.5, 0.5, 2), 0)
+        self.assertEquals(self.spool.take_token(110, 0.5, 0.5, 2), 2)
+
+        support = DbSpool(':memory:', instance='support')
+        support.db = self.spool.db
+        self.assertEquals(support.take_token(110, 1, 1, 2), 0)
+        self.assertEquals(self.spool.db.execute(
+            'SELECT COUNT(*) FROM nagios2mantis_limiter').fetchone()[0], 2)
+
+    def test_adapt_rate(self):
+        self.assertEquals(self.spool.adapt_rate(100, True, 1, 20, 20), 20)
+        self.spool.take_token(100, 1, 20, 20)
+
+        self.assertEquals(self.spool.adapt_rate(100, True, 1, 20, 20), 10)
+        self.assertEquals(self.spool.get_limiter(), (19, 10))
+        # Halved once a second at most
+        self.assertEquals(self.spool.adapt_rate(100.5, True, 1, 20, 20), 10)
+        self.assertEquals(self.spool.adapt_rate(101, True, 1, 20, 20), 5)
+        self.assertEquals(self.spool.adapt_rate(102, True, 1, 20, 20), 2.5)
+        self.assertEquals(self.spool.adapt_rate(103, True, 1, 20, 20), 1.25)
+        self.assertEquals(self.spool.adapt_rate(104, True, 1, 20, 20), 1)
+        self.assertEquals(self.spool.adapt_rate(104, False, 1, 20, 20), 2)
+        for _ in range(20):
+            rate = self.spool.adapt_rate(104, False, 1, 20, 20)
+        self.assertEquals(rate, 20)
+        # Refilled up to the burst in the meantime
+        self.assertEquals(self.spool.get_limiter()[0], 20)
+
+    def test_limiter_rollback(self):
+        self.spool.db = mock.MagicMock()
+        self.spool.db.execute.side_effect = sqlite3.OperationalError
+        with self.assertRaises(sqlite3.OperationalError):
+            self.spool.take_token(100, 1, 1, 1)
+        with self.assertRaises(sqlite3.OperationalError):
+            self.spool.adapt_rate(100, True, 1, 1, 1)
+        self.assertEquals(self.spool.db.rollback.call_count, 2)
+
+    def test_instance_relations(self):
+        support = DbSpool(':memory:', instance='support')
+        support.db = self.spool.db
+        self.spool.add_relation('localhost', None, 1, 1)
+        self.spool.add_relation('remote', None, 2, 1)
+        support.add_relation('other', None, 2, 1)
+        self.assertIsNone(support.get_issue_id('localhost', None))
+        self.assertEquals(len(support.get_relations(
+            datetime.now() + timedelta(seconds=1))), 1)
+
+        # The host moved to the support instance
+        support.add_relation('localhost', None, 3, 1)
+
+        self.assertIsNone(self.spool.get_issue_id('localhost', None))
+        self.assertEquals(support.get_issue_id('localhost', None), 3)
+        support.set_issue_status('other', None, 10)
+        self.spool.invalidate_issue_status(2)
+        self.assertEquals(support.get_issue_status(
+            'other', None, datetime.now() - timedelta(hours=1)), 10)
+
+    def test_supersede_drop(self):
+        spool = DbSpool(':memory:', supersede='drop')
+        for state in ['CRITICAL', 'WARNING', 'CRITICAL', 'OK']:
+            spool.add('localhost', state, 'apache2', state, 1)
+            spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        self.assertEquals(list(spool.rows()), [
+            (7, u'localhost', u'OK', u'apache2', u'OK', 1),
+            (8, u'localhost', u'DOWN', None, u'KO', 1)])
+        self.assertEquals(spool.get_transitions([7, 8]), {7: 4, 8: 4})
+
+    def test_supersede_fold(self):
+        spool = DbSpool(':memory:', supersede='fold')
+        spool.add('localhost', 'CRITICAL', 'apache2', 'KO', 1)
+        spool.db.execute('''UPDATE nagios2mantis
+        SET creation = '2013-01-01 00:00:00', attempts = 2, failures = 1,
+        next_attempt = '2013-01-01 00:10:00' ''')
+        spool.add_many(*[{
+            'hostname': u'localhost', 'state': state, 'service': u'apache2',
+            'plugin_output': state, 'project_id': 1, 'instance': None,
+        } for state in [u'WARNING', u'CRITICAL', u'OK']])
+
+        self.assertEquals(list(spool.rows()), [
+            (2, u'localhost', u'OK', u'apache2', u'OK', 1)])
+        self.assertEquals(spool.db.execute('''SELECT creation, transitions,
+        attempts, failures, next_attempt FROM nagios2mantis''').fetchall(), [
+            (u'2013-01-01 00:00:00', 4, 2, 1, u'2013-01-01 00:10:00')])
+
+    def test_supersede_leased(self):
+        spool = DbSpool(':memory:', supersede='drop')
+        spool.add('localhost', 'DOWN', None, 'KO', 1)
+        spool.add('localhost', 'UP', None, 'OK', 1)
+        list(spool.pages(0, 'first', timedelta(seconds=60)))
+
+        spool.add('localhost', 'DOWN', None, 'KO again', 1)
+        spool.add('localhost', 'UP', None, 'OK again', 1)
+
+        self.assertEquals([row[0] for row in spool.rows()], [2, 4])
+        self.assertEquals(spool.get_transitions([4]), {4: 2})
+
+    def test_depth(self):
+        self.assertEquals(self.spool.depth(), (0, None))
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        self.spool.add('localhost', 'UP', None, 'OK', 1)
+        self.spool.db.execute('''UPDATE nagios2mantis
+        SET creation = datetime('now', '-60 seconds') WHERE id = 1''')
+
+        self.assertEquals(self.spool.depth(), (2, 60))
+
+    def test_metrics(self):
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        with self.spool.batch():
+            self.spool.delete(1)
+        list(self.spool.pages(0, 'first', timedelta(seconds=60)))
+
+        for operation in ['write', 'commit', 'claim', 'page']:
+            self.assertEquals(self.spool.metrics.value(
+                'nagios2mantis_spool_seconds_count', operation=operation), 1)
+
+    def test_release(self):
+        lease = timedelta(seconds=60)
+        self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+        list(self.spool.pages(0, 'first', lease))
+        self.assertEquals(list(self.spool.pages(0, 'second', lease)), [])
+
+        self.spool.release('first')
+
+        self.assertEquals(len(list(self.spool.pages(0, 'second', lease))), 1)
+
     def test_delete_not_exist(self):
         self.spool.delete(1)
 
@@ -130,6 +744,71 @@ class DbSpoolTest(unittest.TestCase):
         result = self.spool.db.execute('SELECT * FROM nagios2mantis;')
         self.assertEquals(tuple(result), ())
 
+    def test_delete_many(self):
+        self.spool.add('localhost', 'DOWN', 'apache2', 'NOT OK', 1)
+        self.spool.add('localhost', 'OK', 'apache2', 'OK', 1)
+        self.spool.add('localhost', 'DOWN', None, 'NOT OK', 1)
+        self.spool.delete(1, 2)
+        result = self.spool.db.execute('SELECT id FROM nagios2mantis;')
+        self.assertEquals(tuple(result), ((3,),))
+
+    def test_journal_mode(self):
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        spool = DbSpool(sqlite_file, 'wal', 'normal')
+        self.assertEquals(
+            spool.db.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+        self.assertEquals(
+            spool.db.execute('PRAGMA synchronous').fetchone()[0], 1)
+        spool.close()
+
+    def test_journal_mode_unknown(self):
+        with self.assertRaises(ValueError):
+            DbSpool(':memory:', journal_mode='wal; DROP TABLE nagios2mantis')
+
+    def test_synchronous_unknown(self):
+        with self.assertRaises(ValueError):
+            DbSpool(':memory:', synchronous='sometimes')
+
+    def test_batch(self):
+        sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, sqlite_file)
+        spool = DbSpool(sqlite_file, commit_every=3)
+        reader = DbSpool(sqlite_file)
+        count = 'SELECT COUNT(*) FROM nagios2mantis'
+
+        with spool.batch():
+            spool.add('localhost', 'DOWN', None, 'KO', 1)
+            spool.add('localhost', 'UP', None, 'OK', 1)
+            self.assertEquals(reader.db.execute(count).fetchone()[0], 0)
+            spool.add('localhost', 'DOWN', None, 'KO', 1)
+            self.assertEquals(reader.db.execute(count).fetchone()[0], 3)
+            spool.delete(1, 2)
+            self.assertEquals(reader.db.execute(count).fetchone()[0], 3)
+
+        self.assertEquals(reader.db.execute(count).fetchone()[0], 1)
+        self.assertIsNone(spool.pending)
+        spool.add('localhost', 'UP', None, 'OK', 1)
+        self.assertEquals(reader.db.execute(count).fetchone()[0], 2)
+
+    def test_batch_integrity_error(self):
+        self.spool.add_relation('localhost', None, 1)
+        with mock.patch('logging.exception') as exc_mock:
+            with self.spool.batch():
+                self.spool.add_relation('localhost', None, 2)
+                self.spool.add_relation('localhost', 'apache2', 3)
+
+        self.assertTrue(exc_mock.called)
+        self.assertEquals(self.spool.get_issue_id('localhost', None), 1)
+        self.assertEquals(self.spool.get_issue_id('localhost', 'apache2'), 3)
+
+    def test_batch_error(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.spool.batch():
+                self.spool.add('localhost', 'DOWN', None, 'KO', 1)
+                self.spool.write('DELETE FROM unknown')
+        self.assertEquals(list(self.spool.rows()), [])
+
     def test_close(self):
         self.spool.db = mock.MagicMock()
 
@@ -204,6 +883,51 @@ class MainTest(unittest.TestCase):
             self.assertEquals(empty_mock.call_args[0][0].configuration_file,
                               '/tmp/test.ini')
 
+    def test_serve(self):
+        with mock.patch('nagios2mantis.serve') as serve_mock:
+            main(['serve'])
+            self.assertTrue(serve_mock.called)
+            self.assertEquals(serve_mock.call_args[0][0].configuration_file,
+                              '/etc/nagios2mantis.ini')
+
+    def test_import(self):
+        with mock.patch('nagios2mantis.import_files') as import_mock:
+            main(['import', '--format', 'csv', 'a.csv', 'b.csv'])
+            self.assertEquals(import_mock.call_args[0][0].files,
+                              ['a.csv', 'b.csv'])
+            self.assertEquals(import_mock.call_args[0][0].format, 'csv')
+            self.assertEquals(import_mock.call_args[0][0].encoding, 'utf-8')
+            self.assertEquals(import_mock.call_args[0][0].batch_size, 5000)
+
+    def test_import_stdin(self):
+        with mock.patch('nagios2mantis.import_files') as import_mock:
+            main(['import'])
+            self.assertEquals(import_mock.call_args[0][0].files, ['-'])
+            self.assertEquals(import_mock.call_args[0][0].format, 'nagios')
+
+    def test_stats(self):
+        with mock.patch('nagios2mantis.stats') as stats_mock:
+            main(['stats'])
+            self.assertTrue(stats_mock.called)
+            self.assertEquals(stats_mock.call_args[0][0].configuration_file,
+                              '/etc/nagios2mantis.ini')
+
+    def test_dead(self):
+        with mock.patch('nagios2mantis.dead') as dead_mock:
+            main(['dead', 'requeue', '--hostname', 'localhost', '--ids', '1',
+                  '2'])
+            self.assertEquals(dead_mock.call_args[0][0].action, 'requeue')
+            self.assertEquals(dead_mock.call_args[0][0].hostname,
+                              'localhost')
+            self.assertIsNone(dead_mock.call_args[0][0].service)
+            self.assertEquals(dead_mock.call_args[0][0].ids, [1, 2])
+
+    def test_dead_list(self):
+        with mock.patch('nagios2mantis.dead') as dead_mock:
+            main(['dead'])
+            self.assertEquals(dead_mock.call_args[0][0].action, 'list')
+            self.assertIsNone(dead_mock.call_args[0][0].ids)
+
     def test_clean(self):
         with mock.patch('nagios2mantis.clean') as clean_mock:
             main(['clean'])
@@ -214,6 +938,77 @@ class MainTest(unittest.TestCase):
                               clean_mock)
 
 
+class StartupTest(unittest.TestCase):
+    # nagios2mantis spool runs once per Nagios notification: it must not
+    # load the modules only needed to talk to Mantis
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        config = ConfigParser.RawConfigParser()
+        config.read('tests/nagios2mantis_test.ini')
+        config.set('Mantis2nagios', 'sqlite_file',
+                   os.path.join(self.directory, 'spool.sqlite'))
+        config.set('Mantis2nagios', 'inotify_file',
+                   os.path.join(self.directory, 'nagios2mantis.inotify'))
+        config.set('Mantis2nagios', 'spool_socket',
+                   os.path.join(self.directory, 'spool.socket'))
+        self.sqlite_file = os.path.join(self.directory, 'spool.sqlite')
+        self.configuration_file = os.path.join(self.directory, 'test.ini')
+        # Not the default one, which would keep the test password
+        self.config_snapshot = os.path.join(self.directory, 'config.json')
+        with open(self.configuration_file, 'w') as configuration_file:
+            config.write(configuration_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def loaded_modules(self, *args):
+        script = (
+            'import sys, nagios2mantis\n'
+            'nagios2mantis.main(sys.argv[1:])\n'
+            'print " ".join(sorted(name for name in ("SOAPpy", "yaml", '
+            '"urllib2", "httplib") if name in sys.modules))\n'
+        )
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        output = subprocess.check_output(
+            [sys.executable, '-c', script, '--configuration-file',
+             self.configuration_file, '--config-snapshot',
+             self.config_snapshot, 'spool', '--hostname', 'localhost',
+             '--service', 'apache2', '--plugin-output', 'OK', '--state',
+             'CRITICAL'] + list(args), cwd=root)
+        return output.split()
+
+    def test_spool(self):
+        self.assertEquals(self.loaded_modules(), [])
+        self.assertEquals(len(list(DbSpool(self.sqlite_file).rows())), 1)
+        self.assertTrue(os.path.exists(self.config_snapshot))
+
+    def test_spool_host_notes(self):
+        self.assertEquals(self.loaded_modules(
+            '--host-notes', 'mantis_project_id: 2'), [])
+        self.assertEquals(list(DbSpool(self.sqlite_file).rows()),
+                          [(1, 'localhost', 'CRITICAL', 'apache2', 'OK', 2)])
+
+    def test_spool_yaml_host_notes(self):
+        self.assertEquals(self.loaded_modules(
+            '--host-notes', 'mantis_project_id: 3\nowner: ops'), ['yaml'])
+        self.assertEquals(list(DbSpool(self.sqlite_file).rows()),
+                          [(1, 'localhost', 'CRITICAL', 'apache2', 'OK', 3)])
+
+    def test_spool_socket(self):
+        spool_socket = SpoolSocket(os.path.join(self.directory,
+                                                'spool.socket'))
+        spool_socket.bind()
+        try:
+            self.assertEquals(self.loaded_modules(), [])
+            self.assertEquals(spool_socket.receive(1), [{
+                'hostname': 'localhost', 'state': 'CRITICAL',
+                'service': 'apache2', 'plugin_output': 'OK',
+                'project_id': '1', 'instance': None}])
+        finally:
+            spool_socket.close()
+        self.assertFalse(os.path.exists(self.sqlite_file))
+
+
 class ConfigTest(unittest.TestCase):
     def test(self):
         config = Config('tests/nagios2mantis_test.ini')
@@ -231,11 +1026,236 @@ class ConfigTest(unittest.TestCase):
                           '/var/lib/nagios2mantis/spool.sqlite')
         self.assertEquals(config.inotify_file,
                           '/var/lib/nagios2mantis/nagios2mantis.inotify')
+        self.assertEquals(config.serve_interval, 60)
+        self.assertEquals(config.poll_interval, 1)
+        self.assertEquals(config.workers, 1)
+        self.assertFalse(config.prefetch_issues)
+        self.assertEquals(config.prefetch_page_size, 100)
+        self.assertEquals(config.issue_status_ttl, 0)
+        self.assertIsNone(config.journal_mode)
+        self.assertIsNone(config.synchronous)
+        self.assertEquals(config.commit_every, 100)
+        self.assertEquals(config.page_size, 500)
+        self.assertEquals(config.lease_time, 300)
+        self.assertIsNone(config.wsdl_cache_dir)
+        self.assertEquals(config.wsdl_max_age, 86400)
+        self.assertEquals(config.transport, 'soappy')
+        self.assertIsNone(config.spool_socket)
+        self.assertEquals(config.retry_backoff, 60)
+        self.assertEquals(config.max_backoff, 3600)
+        self.assertEquals(config.breaker_threshold, 5)
+        self.assertIsNone(config.metrics_file)
+        self.assertEquals(config.supersede, 'none')
+        self.assertEquals(config.pool_size, 4)
+        self.assertEquals(config.connect_timeout, 10)
+        self.assertEquals(config.read_timeout, 60)
+
+    def test_optional(self):
+        config = Config('tests/nagios2mantis_test.ini')
+        config.set('Mantis2nagios', 'serve_interval', '5')
+        self.assertEquals(
+            config.optional('Mantis2nagios', 'serve_interval', 60), '5')
+        self.assertEquals(
+            config.optional('Mantis2nagios', 'unknown', 60), 60)
+
+    def test_optional_boolean(self):
+        config = Config('tests/nagios2mantis_test.ini')
+        config.set('Mantis2nagios', 'prefetch_issues', 'yes')
+        self.assertTrue(config.optional_boolean(
+            'Mantis2nagios', 'prefetch_issues', False))
+        self.assertFalse(config.optional_boolean(
+            'Mantis2nagios', 'unknown', False))
 
     def test_fail(self):
         with self.assertRaises(ConfigParser.NoSectionError):
             Config('nagios2mantis_test_fail.ini')
 
+    def test_unknown_supersede(self):
+        with mock.patch.object(Config, 'optional',
+                               side_effect=lambda section, option, default:
+                               'squash' if option == 'supersede'
+                               else default):
+            with self.assertRaises(ValueError):
+                Config('tests/nagios2mantis_test.ini')
+
+    def test_instances(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        configuration_file = os.path.join(directory, 'nagios2mantis.ini')
+        shutil.copy('tests/nagios2mantis_test.ini', configuration_file)
+        with open(configuration_file, 'a') as output:
+            output.write('''
+[Mantis:support]
+wsdl = http://support.example.com/api/soap/mantisconnect.php?wsdl
+username = support_login
+password = support_password
+workers = 2
+
+[Mantis:lab]
+wsdl = http://lab.example.com/api/soap/mantisconnect.php?wsdl
+username = lab_login
+password = lab_password
+default_mantis_project_id = 7
+''')
+        snapshot_file = os.path.join(directory, 'config.json')
+        Config(configuration_file, snapshot_file)
+
+        with mock.patch.object(Config, 'read') as read_mock:
+            config = Config(configuration_file, snapshot_file)
+
+        self.assertFalse(read_mock.called)
+        self.assertEquals(config.instances, {
+            'support': {
+                'wsdl': 'http://support.example.com/api/soap/'
+                        'mantisconnect.php?wsdl',
+                'username': 'support_login',
+                'password': 'support_password',
+                'project_id': '1',
+                'workers': 2,
+            },
+            'lab': {
+                'wsdl': 'http://lab.example.com/api/soap/'
+                        'mantisconnect.php?wsdl',
+                'username': 'lab_login',
+                'password': 'lab_password',
+                'project_id': '7',
+                'workers': 1,
+            },
+        })
+        self.assertEquals(type(config.instances.keys()[0]), str)
+        self.assertEquals(type(config.instances['lab']['wsdl']), str)
+        self.assertIsNone(config.instance)
+
+        support = config.for_instance('support')
+
+        self.assertEquals(support.instance, 'support')
+        self.assertEquals(support.instances, {})
+        self.assertEquals(support.username, 'support_login')
+        self.assertEquals(support.workers, 2)
+        self.assertEquals(support.sqlite_file, config.sqlite_file)
+        self.assertEquals(config.username, 'mantis_login')
+
+    def test_route(self):
+        config = Config('tests/nagios2mantis_test.ini')
+        config.instances = {'lab': {'project_id': '7'}}
+
+        self.assertEquals(config.route(None, None), ('1', None))
+        self.assertEquals(config.route(3, None), (3, None))
+        self.assertEquals(config.route(None, 'lab'), ('7', 'lab'))
+        self.assertEquals(config.route(3, 'lab'), (3, 'lab'))
+        with mock.patch('logging.warning') as warning_mock:
+            self.assertEquals(config.route(3, 'gone'), (3, None))
+        self.assertTrue(warning_mock.called)
+
+    def test_unknown_transport(self):
+        with mock.patch.object(Config, 'optional',
+                               side_effect=lambda section, option, default:
+                               'carrier pigeon' if option == 'transport'
+                               else default):
+            with self.assertRaises(ValueError):
+                Config('tests/nagios2mantis_test.ini')
+
+
+class ConfigSnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.configuration_file = os.path.join(self.directory,
+                                               'nagios2mantis.ini')
+        shutil.copy('tests/nagios2mantis_test.ini', self.configuration_file)
+        self.snapshot_file = os.path.join(self.directory, 'config.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test(self):
+        config = Config(self.configuration_file, self.snapshot_file)
+        self.assertEquals(os.stat(self.snapshot_file).st_mode & 0o777, 0o600)
+
+        with mock.patch.object(Config, 'read') as read_mock:
+            snapshot = Config(self.configuration_file, self.snapshot_file)
+        self.assertFalse(read_mock.called)
+        for name, value in vars(config).items():
+            if not name.startswith('_'):
+                self.assertEquals(getattr(snapshot, name), value)
+        self.assertEquals(type(snapshot.wsdl), str)
+        self.assertEquals(type(snapshot.category_name), unicode)
+        self.assertEquals(snapshot.note_description.format(
+            state='DOWN', plugin_output=u'déjà'),
+            u'Nagios error detected. DOWN: déjà')
+
+    def test_modified(self):
+        Config(self.configuration_file, self.snapshot_file)
+        with open(self.configuration_file, 'a') as configuration_file:
+            configuration_file.write('workers = 3\n')
+
+        config = Config(self.configuration_file, self.snapshot_file)
+
+        self.assertEquals(config.workers, 3)
+        with mock.patch.object(Config, 'read') as read_mock:
+            self.assertEquals(
+                Config(self.configuration_file, self.snapshot_file).workers,
+                3)
+        self.assertFalse(read_mock.called)
+
+    def test_corrupted(self):
+        for content in ('{', '[]'):
+            with open(self.snapshot_file, 'w') as snapshot_file:
+                snapshot_file.write(content)
+
+            config = Config(self.configuration_file, self.snapshot_file)
+
+            self.assertEquals(config.workers, 1)
+
+    def test_unwritable(self):
+        snapshot_file = os.path.join(self.directory, 'missing', 'config.json')
+
+        config = Config(self.configuration_file, snapshot_file)
+
+        self.assertEquals(config.workers, 1)
+        self.assertFalse(os.path.exists(snapshot_file))
+
+    def test_missing(self):
+        with self.assertRaises(ConfigParser.NoSectionError):
+            Config(os.path.join(self.directory, 'missing.ini'),
+                   self.snapshot_file)
+        self.assertFalse(os.path.exists(self.snapshot_file))
+
+
+class TemplateTest(unittest.TestCase):
+    def test(self):
+        template = Template(u'{state}: {plugin_output!r:>8} {{}}',
+                            ('state', 'plugin_output'))
+
+        self.assertEquals(template, u'{state}: {plugin_output!r:>8} {{}}')
+        self.assertEquals(template.format(state=u'DOWN', plugin_output='KO'),
+                          u"DOWN:     'KO' {}")
+        self.assertEquals(template.format(state=None, plugin_output=u'é'),
+                          u"None:  u'\\xe9' {}")
+
+    def test_same_as_format(self):
+        for template in (u'', u'Nagios error detected: {plugin_output}',
+                         u'{plugin_output:.3} {plugin_output!s}',
+                         u'déjà {plugin_output:^9}'):
+            self.assertEquals(
+                Template(template, ('plugin_output',)).format(
+                    plugin_output=u'Connection refusée'),
+                template.format(plugin_output=u'Connection refusée'))
+
+    def test_invalid(self):
+        for template in (u'{hostname}', u'{}', u'{0}', u'{state.upper}',
+                         u'{state', u'state}', u'{state:{plugin_output}}',
+                         u'{state!x}'):
+            with self.assertRaises(ValueError):
+                Template(template, ('state', 'plugin_output'))
+
+    def test_config(self):
+        with mock.patch.object(Config, 'get',
+                               side_effect=lambda section, option:
+                               '{hostname}' if option == 'issue_description'
+                               else 'value'):
+            with self.assertRaises(ValueError):
+                Config('tests/nagios2mantis_test.ini')
+
 
 class Nagios2MantisTest(unittest.TestCase):
     def setUp(self):
@@ -264,7 +1284,7 @@ class Nagios2MantisTest(unittest.TestCase):
         nagios2mantis.spool('localhost', 'UP', None, 'OK', 1)
 
         nagios2mantis.db_spool.add.assert_called_once_with(
-            'localhost', 'UP', None, 'OK', 1)
+            'localhost', 'UP', None, 'OK', 1, None)
         nagios2mantis.db_spool.close.assert_called_once_with()
         after_time = os.path.getctime(self.config.inotify_file)
         self.assertNotEquals(before_time, after_time)
@@ -280,7 +1300,7 @@ class Nagios2MantisTest(unittest.TestCase):
             'plugin_output:%s ; project_id:%d',
             'localhost', 'UP', None, 'OK', 1)
         nagios2mantis.db_spool.add.assert_called_once_with(
-            'localhost', 'UP', None, 'OK', 1)
+            'localhost', 'UP', None, 'OK', 1, None)
 
     def test_mantis(self):
         nagios2mantis = Nagios2Mantis(self.config)
@@ -288,7 +1308,29 @@ class Nagios2MantisTest(unittest.TestCase):
             mantis_ws = nagios2mantis.mantis
             ws_mock.assert_called_once_with(
                 'http://your-mantis.com/api/soap/mantisconnect.php?wsdl')
-            self.assertEquals(mantis_ws, nagios2mantis._mantis)
+            self.assertEquals(mantis_ws, nagios2mantis._local.mantis)
+
+    def test_mantis_unreachable(self):
+        self.config.wsdl = 'http://127.0.0.1:1/mantisconnect.php?wsdl'
+        self.config.max_attempts = 1
+        self.config.breaker_threshold = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        with self.assertRaises(IOError):
+            nagios2mantis.mantis
+        with mock.patch('logging.warning') as warning_mock:
+            nagios2mantis.empty_group(
+                [(1, 'localhost', 'DOWN', None, 'KO', 1)])
+
+        self.assertTrue(warning_mock.called)
+
+        # Postponed, not dead
+        self.assertTrue(nagios2mantis.tripped)
+        self.assertEquals(nagios2mantis.db_spool.get_dead(), [])
+        self.assertEquals(nagios2mantis.db_spool.db.execute(
+            'SELECT attempts, failures FROM nagios2mantis').fetchall(),
+            [(1, 0)])
 
     def test_mantis_twice(self):
         nagios2mantis = Nagios2Mantis(self.config)
@@ -304,7 +1346,7 @@ class Nagios2MantisTest(unittest.TestCase):
         nagios2mantis = Nagios2Mantis(self.config)
         nagios2mantis.db_spool.delete = mock.MagicMock()
         with mock.patch('SOAPpy.WSDL.Proxy'):
-            nagios2mantis.add_note(1, 'test', 1)
+            nagios2mantis.add_note(1, 'test', [1])
             nagios2mantis.mantis.mc_issue_note_add.assert_called_once_with(
                 'mantis_login', 'mantis_password', 1, {'text': 'test'})
             nagios2mantis.db_spool.delete.assert_called_once_with(1)
@@ -315,26 +1357,39 @@ class Nagios2MantisTest(unittest.TestCase):
         with mock.patch('SOAPpy.WSDL.Proxy'):
             nagios2mantis.mantis.mc_issue_note_add.side_effect = faultType
 
-            nagios2mantis.add_note(1, 'test', 1)
+            nagios2mantis.add_note(1, 'test', [1])
 
             nagios2mantis.mantis.mc_issue_note_add.assert_called_once_with(
                 'mantis_login', 'mantis_password', 1, {'text': 'test'})
             self.assertFalse(nagios2mantis.db_spool.delete.called)
 
+    def test_add_note_failed_invalidates(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.invalidate_issue_status = mock.MagicMock()
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            nagios2mantis.mantis.mc_issue_note_add.side_effect = faultType
+
+            nagios2mantis.add_note(1, 'test', [1])
+
+        nagios2mantis.db_spool.invalidate_issue_status.assert_called_once_with(
+            1)
+
     def test_add_issue(self):
         nagios2mantis = Nagios2Mantis(self.config)
         nagios2mantis.db_spool.delete = mock.MagicMock()
         nagios2mantis.db_spool.add_relation = mock.MagicMock()
         with mock.patch('SOAPpy.WSDL.Proxy'):
             nagios2mantis.mantis.mc_issue_add.return_value = 2
-            nagios2mantis.add_issue('localhost', 'apache2',
-                                    {'summary': 'test'}, 1)
+            issue = {'summary': 'test', 'project': {'id': 3}}
+            issue_id = nagios2mantis.add_issue('localhost', 'apache2',
+                                               issue, [1])
 
+            self.assertEquals(issue_id, 2)
             nagios2mantis.mantis.mc_issue_add.assert_called_once_with(
-                'mantis_login', 'mantis_password', {'summary': 'test'})
+                'mantis_login', 'mantis_password', issue)
             nagios2mantis.db_spool.delete.assert_called_once_with(1)
             nagios2mantis.db_spool.add_relation.assert_called_once_with(
-                'localhost', 'apache2', 2)
+                'localhost', 'apache2', 2, 3)
 
     def test_add_issue_failed(self):
         nagios2mantis = Nagios2Mantis(self.config)
@@ -342,9 +1397,10 @@ class Nagios2MantisTest(unittest.TestCase):
         nagios2mantis.db_spool.add_relation = mock.MagicMock()
         with mock.patch('SOAPpy.WSDL.Proxy'):
             nagios2mantis.mantis.mc_issue_add.side_effect = faultType
-            nagios2mantis.add_issue('localhost', 'apache2',
-                                    {'summary': 'test'}, 1)
+            issue_id = nagios2mantis.add_issue('localhost', 'apache2',
+                                               {'summary': 'test'}, [1])
 
+            self.assertIsNone(issue_id)
             nagios2mantis.mantis.mc_issue_add.assert_called_once_with(
                 'mantis_login', 'mantis_password', {'summary': 'test'})
             self.assertFalse(nagios2mantis.db_spool.delete.called)
@@ -367,6 +1423,13 @@ class Nagios2MantisTest(unittest.TestCase):
             nagios2mantis.mantis.mc_issue_get.assert_called_once_with(
                 'mantis_login', 'mantis_password', 1)
 
+    def test_find_issue_no_relation(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as proxy_mock:
+            self.assertIsNone(nagios2mantis.find_issue('localhost', None))
+
+        self.assertFalse(proxy_mock.called)
+
     def test_find_issue_fault(self):
         nagios2mantis = Nagios2Mantis(self.config)
         nagios2mantis.db_spool.get_issue_id = mock.MagicMock(return_value=1)
@@ -419,6 +1482,264 @@ class Nagios2MantisTest(unittest.TestCase):
             nagios2mantis.db_spool.del_relation.assert_called_once_with(
                 'localhost', 'apache2')
 
+    def test_find_issue_cached(self):
+        self.config.issue_status_ttl = 60
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add_relation('localhost', 'apache2', 1)
+        nagios2mantis.db_spool.set_issue_status('localhost', 'apache2', 50)
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            result = nagios2mantis.find_issue('localhost', 'apache2')
+
+            self.assertEquals(result, {'id': 1, 'status': {'id': 50}})
+            self.assertFalse(nagios2mantis.mantis.mc_issue_get.called)
+
+    def test_find_issue_cache_expired(self):
+        self.config.issue_status_ttl = 60
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add_relation('localhost', 'apache2', 1)
+        with mock.patch('nagios2mantis.datetime') as datetime_mock:
+            datetime_mock.now.return_value = datetime.now() - timedelta(
+                seconds=61)
+            nagios2mantis.db_spool.set_issue_status('localhost', 'apache2', 50)
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            nagios2mantis.mantis.mc_issue_get.return_value = {
+                'id': 1, 'status': {'id': 10}}
+
+            result = nagios2mantis.find_issue('localhost', 'apache2')
+
+            self.assertEquals(result, {'id': 1, 'status': {'id': 10}})
+            nagios2mantis.mantis.mc_issue_get.assert_called_once_with(
+                'mantis_login', 'mantis_password', 1)
+        self.assertEquals(nagios2mantis.db_spool.get_issue_status(
+            'localhost', 'apache2', datetime.now() - timedelta(seconds=1)),
+            10)
+
+    def test_find_issue_prefetched_cached(self):
+        self.config.issue_status_ttl = 60
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add_relation('localhost', None, 1)
+        nagios2mantis.issue_statuses = {1: 50}
+
+        result = nagios2mantis.find_issue('localhost', None)
+
+        self.assertEquals(result, {'id': 1, 'status': {'id': 50}})
+        self.assertEquals(nagios2mantis.db_spool.get_issue_status(
+            'localhost', None, datetime.now() - timedelta(seconds=1)), 50)
+
+    def test_find_issue_prefetched(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.get_issue_id = mock.MagicMock(return_value=1)
+        nagios2mantis.db_spool.del_relation = mock.MagicMock()
+        nagios2mantis.issue_statuses = {1: 10}
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            result = nagios2mantis.find_issue('localhost', 'apache2')
+
+            self.assertEquals(result, {'id': 1, 'status': {'id': 10}})
+            self.assertFalse(nagios2mantis.mantis.mc_issue_get.called)
+            self.assertFalse(nagios2mantis.db_spool.del_relation.called)
+
+    def test_find_issue_prefetched_closed(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.get_issue_id = mock.MagicMock(return_value=1)
+        nagios2mantis.db_spool.del_relation = mock.MagicMock()
+        nagios2mantis.issue_statuses = {1: 90}
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            result = nagios2mantis.find_issue('localhost', 'apache2')
+
+            self.assertIsNone(result)
+            self.assertFalse(nagios2mantis.mantis.mc_issue_get.called)
+            nagios2mantis.db_spool.del_relation.assert_called_once_with(
+                'localhost', 'apache2')
+
+    def test_find_issue_not_prefetched(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.get_issue_id = mock.MagicMock(return_value=2)
+        nagios2mantis.issue_statuses = {1: 10}
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            nagios2mantis.mantis.mc_issue_get.return_value = {
+                'id': 2, 'status': {'id': 10}}
+
+            result = nagios2mantis.find_issue('localhost', 'apache2')
+
+            self.assertEquals(result, {'id': 2, 'status': {'id': 10}})
+            nagios2mantis.mantis.mc_issue_get.assert_called_once_with(
+                'mantis_login', 'mantis_password', 2)
+
+    def test_prefetch_issues(self):
+        self.config.prefetch_page_size = 2
+        nagios2mantis = Nagios2Mantis(self.config)
+        pages = {
+            (1, 1): [{'id': 1, 'status': 10}, {'id': 2, 'status': 80}],
+            (1, 2): [{'id': 3, 'status': 50}],
+            (2, 1): [{'id': 4, 'status': 10}, {'id': 5, 'status': 10}],
+            (2, 2): [{'id': 4, 'status': 10}, {'id': 5, 'status': 10}],
+        }
+        with mock.patch('SOAPpy.WSDL.Proxy'):
+            nagios2mantis.mantis.mc_project_get_issue_headers.side_effect = \
+                lambda username, password, project_id, page, size: \
+                pages[(project_id, page)]
+
+            nagios2mantis.prefetch_issues([1, 2])
+
+            self.assertEquals(
+                nagios2mantis.mantis.mc_project_get_issue_headers.call_count,
+                4)
+            nagios2mantis.mantis.mc_project_get_issue_headers \
+                .assert_any_call('mantis_login', 'mantis_password', 1, 1, 2)
+        self.assertEquals(nagios2mantis.issue_statuses,
+                          {1: 10, 2: 80, 3: 50, 4: 10, 5: 10})
+
+    def test_prefetch_issues_fault(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy'), \
+                mock.patch('logging.exception') as exc_mock:
+            nagios2mantis.mantis.mc_project_get_issue_headers.side_effect = \
+                faultType
+
+            nagios2mantis.prefetch_issues([1])
+
+        self.assertTrue(exc_mock.called)
+        self.assertEquals(nagios2mantis.issue_statuses, {})
+
+    def metrics_file(self):
+        # Next to the textfile is the file locked while it is written
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return os.path.join(directory, 'nagios2mantis.prom')
+
+    def test_clean(self):
+        self.config.metrics_file = self.metrics_file()
+        nagios2mantis = Nagios2Mantis(self.config)
+        db_spool = nagios2mantis.db_spool
+        db_spool.add_relation('localhost', None, 1, 1)
+        db_spool.add_relation('remote', None, 2, 1)
+        db_spool.db.execute('''UPDATE nagios_mantis_relation
+        SET creation = :creation WHERE hostname = 'remote';''', {
+            'creation': datetime.now() - timedelta(days=8)})
+        self.config.relation_max_age = 7
+        db_spool.vacuum = mock.MagicMock()
+
+        with mock.patch('SOAPpy.WSDL.Proxy') as proxy_mock:
+            nagios2mantis.clean()
+
+        self.assertFalse(proxy_mock.called)
+        self.assertEquals(db_spool.get_issue_id('localhost', None), 1)
+        self.assertIsNone(db_spool.get_issue_id('remote', None))
+        db_spool.vacuum.assert_called_once_with()
+        with open(self.config.metrics_file) as metrics_file:
+            self.assertIn('nagios2mantis_relations_removed_total'
+                          '{reason="age"} 1', metrics_file.read())
+
+    def test_clean_verify(self):
+        self.config.verify_relations = True
+        nagios2mantis = Nagios2Mantis(self.config)
+        db_spool = nagios2mantis.db_spool
+        # Project 1 lists issues 1 and 2 only, project 2 cannot be loaded
+        for issue_id, project_id in [(1, 1), (2, 1), (3, 1), (4, 2),
+                                     (5, None), (7, 1)]:
+            db_spool.add_relation('host%d' % issue_id, None, issue_id,
+                                  project_id)
+        pages = {1: [{'id': 1, 'status': 50}, {'id': 2, 'status': 80}]}
+        # Issue 3 was deleted, 4 is open, and 7 was updated meanwhile
+        statuses = {4: 50, 7: 10}
+
+        def get_issue(username, password, issue_id):
+            if issue_id not in statuses:
+                raise faultType
+            return {'id': issue_id, 'status': {'id': statuses[issue_id]}}
+
+        def get_issue_headers(username, password, project_id, page, size):
+            if project_id not in pages:
+                raise faultType
+            # Made while the issues are loaded
+            db_spool.add_relation('host6', None, 6, 1)
+            return pages[project_id]
+
+        with mock.patch('SOAPpy.WSDL.Proxy'), mock.patch('logging.exception'):
+            nagios2mantis.mantis.mc_project_get_issue_headers.side_effect = \
+                get_issue_headers
+            nagios2mantis.mantis.mc_issue_get.side_effect = get_issue
+
+            nagios2mantis.clean()
+
+            self.assertEquals(
+                nagios2mantis.mantis.mc_project_get_issue_headers.call_count,
+                2)
+            self.assertEquals(
+                [call[0][2] for call in
+                 nagios2mantis.mantis.mc_issue_get.call_args_list],
+                [3, 4, 7])
+        self.assertEquals(
+            [db_spool.get_issue_id('host%d' % issue_id, None)
+             for issue_id in range(1, 8)],
+            [1, None, None, 4, 5, 6, 7])
+        self.assertIsNone(nagios2mantis.issue_statuses)
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_relations_removed_total', reason='closed'), 2)
+
+    def test_clean_verify_instances(self):
+        self.config.verify_relations = True
+        self.config.instances = {'lab': {'project_id': '7'}}
+        nagios2mantis = Nagios2Mantis(self.config)
+
+        with mock.patch.object(Nagios2Mantis,
+                               'verify_relations') as verify_mock:
+            nagios2mantis.clean()
+
+        self.assertEquals(verify_mock.call_count, 2)
+
+    def test_stop_instances(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.instance_drainers['lab'] = mock.MagicMock(running=True)
+
+        nagios2mantis.stop()
+
+        self.assertFalse(nagios2mantis.running)
+        self.assertFalse(nagios2mantis.instance_drainers['lab'].running)
+
+    def test_drain_prefetch(self):
+        self.config.prefetch_issues = True
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.renew = mock.MagicMock(
+            side_effect=lambda worker, ids, lease: len(ids))
+        nagios2mantis.db_spool.pages = mock.MagicMock(return_value=[[
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'DOWN', 'apache2', 'KO', 3),
+        ]])
+        nagios2mantis.prefetch_issues = mock.MagicMock()
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=lambda rows: setattr(nagios2mantis, 'seen',
+                                             nagios2mantis.issue_statuses))
+        nagios2mantis.issue_statuses = {}
+
+        nagios2mantis.drain()
+
+        nagios2mantis.prefetch_issues.assert_called_once_with(set([1, 3]))
+        self.assertEquals(nagios2mantis.seen, {})
+        self.assertIsNone(nagios2mantis.issue_statuses)
+
+    def test_drain_prefetch_unreachable(self):
+        # The issues are looked up one by one, and the failure counts toward
+        # the breaker
+        self.config.prefetch_issues = True
+        self.config.breaker_threshold = 2
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.prefetch_issues = mock.MagicMock(
+            side_effect=socket.error('Connection refused'))
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=socket.error('Connection refused'))
+
+        with mock.patch('logging.warning') as warning_mock:
+            nagios2mantis.drain()
+
+        warning_mock.assert_any_call(
+            'Could not reach Mantis to load the issues: %s',
+            nagios2mantis.prefetch_issues.side_effect)
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 1)
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now())[0], 1)
+
     def test_empty_row_not_found(self):
         nagios2mantis = Nagios2Mantis(self.config)
         nagios2mantis.find_issue = mock.MagicMock(return_value=None)
@@ -436,7 +1757,7 @@ class Nagios2MantisTest(unittest.TestCase):
             'summary': 'apache2 is DOWN on host localhost'
         }
         nagios2mantis.add_issue.assert_called_once_with('localhost', 'apache2',
-                                                        expected_issue, 1)
+                                                        expected_issue, [1])
         self.assertFalse(nagios2mantis.add_note.called)
 
     def test_empty_row_not_found_state_up(self):
@@ -444,6 +1765,7 @@ class Nagios2MantisTest(unittest.TestCase):
         nagios2mantis.find_issue = mock.MagicMock(return_value=None)
         nagios2mantis.add_issue = mock.MagicMock()
         nagios2mantis.add_note = mock.MagicMock()
+        nagios2mantis.db_spool.add('localhost', 'UP', 'apache2', 'OK', 1)
 
         nagios2mantis.empty_row((1, 'localhost', 'UP', 'apache2', 'OK', 1))
 
@@ -451,6 +1773,7 @@ class Nagios2MantisTest(unittest.TestCase):
             'localhost', 'apache2')
         self.assertFalse(nagios2mantis.add_issue.called)
         self.assertFalse(nagios2mantis.add_note.called)
+        self.assertEquals(list(nagios2mantis.db_spool.rows()), [])
 
     def test_empty_row_found(self):
         nagios2mantis = Nagios2Mantis(self.config)
@@ -463,40 +1786,250 @@ class Nagios2MantisTest(unittest.TestCase):
         nagios2mantis.find_issue.assert_called_once_with(
             'localhost', 'apache2')
         nagios2mantis.add_note.assert_called_once_with(
-            1, u'Nagios error detected. UP: OK', 1)
+            1, u'Nagios error detected. UP: OK', [1])
         self.assertFalse(nagios2mantis.add_issue.called)
 
+    def test_serve(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.wait = mock.MagicMock()
+        nagios2mantis.db_spool.close = mock.MagicMock()
+        drains = []
+
+        def drain():
+            drains.append(None)
+            if len(drains) == 1:
+                raise sqlite3.OperationalError('database is locked')
+            if len(drains) == 2:
+                os.kill(os.getpid(), signal.SIGTERM)
+        nagios2mantis.drain = drain
+
+        try:
+            with mock.patch('logging.exception') as exception_mock:
+                nagios2mantis.serve()
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        # The failed drain did not stop serve
+        exception_mock.assert_called_once_with('Draining spool %s failed',
+                                               self.config.sqlite_file)
+        self.assertEquals(len(drains), 2)
+        self.assertEquals(nagios2mantis.wait.call_count, 2)
+        nagios2mantis.wait.assert_called_with(
+            os.path.getmtime(self.config.inotify_file))
+        nagios2mantis.db_spool.close.assert_called_once_with()
+
+    def test_serve_socket(self):
+        self.config.spool_socket = os.path.join(
+            os.path.dirname(self.config.inotify_file), 'test-%d.socket' %
+            os.getpid())
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.close = mock.MagicMock()
+
+        def drain():
+            # Events sent during the last drain
+            for state in ['DOWN', 'UP', 'DOWN']:
+                self.assertTrue(SpoolSocket(self.config.spool_socket).send(
+                    'localhost', state, None, 'KO', 1))
+
+        def wait(notified):
+            self.assertTrue(os.path.exists(self.config.spool_socket))
+            nagios2mantis.stop()
+        nagios2mantis.wait = wait
+        nagios2mantis.drain = mock.MagicMock(side_effect=drain)
+
+        try:
+            nagios2mantis.serve()
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+
+        self.assertIsNone(nagios2mantis.spool_socket)
+        self.assertFalse(os.path.exists(self.config.spool_socket))
+        self.assertEquals([row[2] for row in nagios2mantis.db_spool.rows()],
+                          ['DOWN', 'UP', 'DOWN'])
+
+    def test_wait_socket(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.running = True
+        nagios2mantis.spool_socket = mock.MagicMock()
+        nagios2mantis.spool_socket.receive.side_effect = [[], [{
+            'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+            'plugin_output': u'KO', 'project_id': 1, 'instance': None}]]
+        with mock.patch('time.sleep') as sleep_mock:
+            nagios2mantis.wait(nagios2mantis.notified())
+        self.assertFalse(sleep_mock.called)
+        nagios2mantis.spool_socket.receive.assert_called_with(
+            self.config.poll_interval)
+        self.assertEquals(list(nagios2mantis.db_spool.rows()),
+                          [(1, u'localhost', u'DOWN', None, u'KO', 1)])
+
+    def test_notified_missing(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('os.stat', side_effect=OSError):
+            self.assertIsNone(nagios2mantis.notified())
+
+    def test_wait_notified(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.running = True
+        self.config.poll_interval = 0
+        notified = nagios2mantis.notified()
+        with mock.patch('time.sleep', side_effect=lambda delay: os.utime(
+                self.config.inotify_file, (1, 1))) as sleep_mock:
+            nagios2mantis.wait(notified)
+        sleep_mock.assert_called_once_with(0)
+
+    def test_wait_timeout(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.running = True
+        self.config.serve_interval = 0.01
+        self.config.poll_interval = 0.005
+        with mock.patch('time.sleep') as sleep_mock:
+            nagios2mantis.wait(nagios2mantis.notified())
+        self.assertTrue(sleep_mock.called)
+
+    def test_wait_stopped(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.stop()
+        with mock.patch('time.sleep') as sleep_mock:
+            nagios2mantis.wait(nagios2mantis.notified())
+        self.assertFalse(sleep_mock.called)
+
+    def test_drain(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+
+        nagios2mantis.db_spool.renew = mock.MagicMock(
+            side_effect=lambda worker, ids, lease: len(ids))
+        nagios2mantis.db_spool.pages = mock.MagicMock(return_value=[[
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'DOWN', 'apache2', 'KO', 1),
+        ]])
+        nagios2mantis.empty_rows = mock.MagicMock()
+        nagios2mantis.db_spool.close = mock.MagicMock()
+
+        nagios2mantis.drain()
+
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 2)
+        self.assertFalse(nagios2mantis.db_spool.close.called)
+
+    def test_drain_pages(self):
+        self.config.page_size = 2
+        self.config.prefetch_issues = True
+        nagios2mantis = Nagios2Mantis(self.config)
+        for i in range(5):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', i % 2)
+        nagios2mantis.prefetch_issues = mock.MagicMock()
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=lambda rows: nagios2mantis.db_spool.delete(rows[0][0]))
+
+        self.assertEquals(nagios2mantis.drain(), 5)
+
+        nagios2mantis.prefetch_issues.assert_called_once_with(set([0, 1]))
+        self.assertEquals(list(nagios2mantis.db_spool.rows()), [])
+
+    def test_drain_leased(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('remote', 'DOWN', None, 'KO', 1)
+        list(nagios2mantis.db_spool.pages(0, 'other', timedelta(seconds=60)))
+        nagios2mantis.db_spool.add('localhost', 'UP', None, 'OK', 1)
+        nagios2mantis.db_spool.add('other', 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock()
+
+        nagios2mantis.drain()
+
+        nagios2mantis.empty_rows.assert_called_once_with(
+            [(4, u'other', u'DOWN', None, u'KO', 1)])
+        self.assertEquals(nagios2mantis.db_spool.db.execute(
+            'SELECT COUNT(*) FROM nagios2mantis WHERE worker IS NOT NULL'
+        ).fetchone()[0], 2)
+
+    def test_drain_lease_lost(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('remote', 'DOWN', None, 'KO', 1)
+
+        def empty_rows(rows):
+            # The lease on the next rows expires and another worker claims
+            # them
+            nagios2mantis.db_spool.db.execute('''UPDATE nagios2mantis
+            SET worker = 'other' WHERE id = 2''')
+            nagios2mantis.db_spool.db.commit()
+        nagios2mantis.empty_rows = mock.MagicMock(side_effect=empty_rows)
+
+        with mock.patch('logging.warning') as warning_mock:
+            nagios2mantis.drain()
+
+        nagios2mantis.empty_rows.assert_called_once_with(
+            [(1, u'localhost', u'DOWN', None, u'KO', 1)])
+        warning_mock.assert_called_once_with(
+            'Rows whose ids are %s are not leased anymore, they are skipped',
+            '2')
+
+    def test_drain_stopped(self):
+        self.config.page_size = 2
+        nagios2mantis = Nagios2Mantis(self.config)
+        for i in range(5):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=lambda rows: nagios2mantis.stop())
+
+        self.assertEquals(nagios2mantis.drain(), 2)
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 2)
+
+        nagios2mantis.running = True
+        self.assertEquals(nagios2mantis.drain(2), 4)
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 4)
+
     def test_empty_cache(self):
         nagios2mantis = Nagios2Mantis(self.config)
 
-        nagios2mantis.db_spool.rows = mock.MagicMock(return_value=[1, 2])
-        nagios2mantis.empty_row = mock.MagicMock()
+        nagios2mantis.db_spool.renew = mock.MagicMock(
+            side_effect=lambda worker, ids, lease: len(ids))
+        nagios2mantis.db_spool.pages = mock.MagicMock(return_value=[[
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'DOWN', 'apache2', 'KO', 1),
+            (3, 'localhost', 'UP', None, 'OK', 1),
+        ]])
+        nagios2mantis.empty_rows = mock.MagicMock()
         nagios2mantis.db_spool.close = mock.MagicMock()
 
         nagios2mantis.empty_cache()
 
-        nagios2mantis.db_spool.rows.assert_called_once_with()
-        self.assertEquals(nagios2mantis.empty_row.call_count, 2)
+        nagios2mantis.db_spool.pages.assert_called_once_with(
+            0, nagios2mantis.worker, timedelta(seconds=300))
+        self.assertEquals(nagios2mantis.empty_rows.call_args_list, [
+            mock.call([(1, 'localhost', 'DOWN', None, 'KO', 1),
+                       (3, 'localhost', 'UP', None, 'OK', 1)]),
+            mock.call([(2, 'localhost', 'DOWN', 'apache2', 'KO', 1)]),
+        ])
         nagios2mantis.db_spool.close.assert_called_once_with()
 
     def test_empty_cache_none(self):
         nagios2mantis = Nagios2Mantis(self.config)
 
-        nagios2mantis.db_spool.rows = mock.MagicMock(return_value=[])
-        nagios2mantis.empty_row = mock.MagicMock()
+        nagios2mantis.db_spool.pages = mock.MagicMock(return_value=[])
+        nagios2mantis.empty_rows = mock.MagicMock()
         nagios2mantis.db_spool.close = mock.MagicMock()
 
         nagios2mantis.empty_cache()
 
-        nagios2mantis.db_spool.rows.assert_called_once_with()
-        self.assertFalse(nagios2mantis.empty_row.called)
+        nagios2mantis.db_spool.pages.assert_called_once_with(
+            0, nagios2mantis.worker, timedelta(seconds=300))
+        self.assertFalse(nagios2mantis.empty_rows.called)
         nagios2mantis.db_spool.close.assert_called_once_with()
 
     def test_empty_cache_fail(self):
         nagios2mantis = Nagios2Mantis(self.config)
 
-        nagios2mantis.db_spool.rows = mock.MagicMock(return_value=[[1], [2]])
-        nagios2mantis.empty_row = mock.MagicMock(
+        nagios2mantis.db_spool.renew = mock.MagicMock(
+            side_effect=lambda worker, ids, lease: len(ids))
+        nagios2mantis.db_spool.pages = mock.MagicMock(return_value=[[
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'DOWN', 'apache2', 'KO', 1),
+            (3, 'localhost', 'OK', 'apache2', 'OK', 1),
+        ]])
+        nagios2mantis.empty_rows = mock.MagicMock(
             side_effect=[None, AssertionError])
         nagios2mantis.db_spool.close = mock.MagicMock()
 
@@ -504,25 +2037,1592 @@ class Nagios2MantisTest(unittest.TestCase):
             nagios2mantis.empty_cache()
 
         exc_mock.assert_called_once_with(
-            'Treating row whose id is %d failed', 2)
-        nagios2mantis.db_spool.rows.assert_called_once_with()
-        self.assertEquals(nagios2mantis.empty_row.call_count, 2)
+            'Treating rows whose ids are %s failed', '2, 3')
+        nagios2mantis.db_spool.pages.assert_called_once_with(
+            0, nagios2mantis.worker, timedelta(seconds=300))
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 2)
         nagios2mantis.db_spool.close.assert_called_once_with()
 
+    def test_mantis_wsdl_cache(self):
+        self.config.wsdl_cache_dir = '/var/cache/test'
+        nagios2mantis = Nagios2Mantis(self.config)
+        proxies = []
+        with mock.patch('nagios2mantis.WsdlCache') as cache_mock:
+            self.assertEquals(nagios2mantis.mantis,
+                              cache_mock.return_value.proxy.return_value)
+            # Shared by the workers
+            thread = threading.Thread(
+                target=lambda: proxies.append(nagios2mantis.mantis))
+            thread.start()
+            thread.join()
+        self.assertIs(proxies[0], nagios2mantis.mantis)
+        cache_mock.assert_called_once_with(
+            'http://your-mantis.com/api/soap/mantisconnect.php?wsdl',
+            '/var/cache/test', 86400)
+
+    def test_mantis_keepalive(self):
+        self.config.transport = 'keepalive'
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            nagios2mantis.mantis
+
+        transport = ws_mock.call_args[1]['transport']()
+        self.assertIsInstance(transport, KeepAliveTransport)
+        self.assertEquals(transport.pool.read_timeout, 60)
+        self.assertIs(transport.pool,
+                      ws_mock.call_args[1]['transport']().pool)
+
+    def test_mantis_per_thread(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        proxies = []
+        with mock.patch('SOAPpy.WSDL.Proxy',
+                        side_effect=lambda wsdl: object()):
+            thread = threading.Thread(
+                target=lambda: proxies.append(nagios2mantis.mantis))
+            thread.start()
+            thread.join()
+            self.assertIsNot(nagios2mantis.mantis, proxies[0])
+
+    def test_dispatch_workers(self):
+        self.config.workers = 3
+        nagios2mantis = Nagios2Mantis(self.config)
+        for i in range(10):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+            nagios2mantis.db_spool.add('host%d' % i, 'UP', None, 'OK', 1)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            ws_mock.return_value.mc_issue_get.side_effect = faultType
+            ws_mock.return_value.mc_issue_add.side_effect = range(100, 110)
+
+            nagios2mantis.drain()
+            nagios2mantis.drain()
+
+            self.assertEquals(ws_mock.return_value.mc_issue_add.call_count,
+                              10)
+            self.assertEquals(
+                ws_mock.return_value.mc_issue_note_add.call_count, 10)
+        self.assertEquals(list(nagios2mantis.db_spool.rows()), [])
+        self.assertIsInstance(nagios2mantis.db_spool, DbSpool)
+        self.assertEquals(
+            nagios2mantis.db_spool.db.execute(
+                'SELECT COUNT(*) FROM nagios_mantis_relation').fetchone(),
+            (10,))
+
+    def test_empty_group(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.empty_rows = mock.MagicMock()
+
+        nagios2mantis.empty_group([(1, 'localhost', 'DOWN', None, 'KO', 1)])
+
+        nagios2mantis.empty_rows.assert_called_once_with(
+            [(1, 'localhost', 'DOWN', None, 'KO', 1)])
+        self.assertTrue(nagios2mantis.reached)
+
+    def test_empty_group_error(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(side_effect=KeyError)
+
+        with mock.patch('logging.exception') as exception_mock:
+            nagios2mantis.empty_group(
+                [(1, 'localhost', 'DOWN', None, 'KO', 1)])
+
+        exception_mock.assert_called_once_with(
+            'Treating rows whose ids are %s failed', '1')
+        self.assertEquals(nagios2mantis.failures, 0)
+        self.assertEquals(nagios2mantis.db_spool.db.execute(
+            'SELECT attempts FROM nagios2mantis').fetchall(), [(1,)])
+
+    def test_empty_group_dead(self):
+        self.config.max_attempts = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('remote', 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=[UnicodeDecodeError('ascii', '\xe9', 0, 1, 'no'),
+                         socket.error('Connection refused')])
+
+        with mock.patch('logging.exception'), \
+                mock.patch('logging.warning'), \
+                mock.patch('logging.error') as error_mock:
+            nagios2mantis.empty_group(
+                [(1, 'localhost', 'DOWN', None, 'KO', 1)])
+            nagios2mantis.empty_group([(2, 'remote', 'DOWN', None, 'KO', 1)])
+
+        error_mock.assert_called_once_with(
+            'Rows whose ids are %s failed %d times, they are moved to the '
+            'dead letters', '1', 1)
+        self.assertEquals([row[1] for row in nagios2mantis.db_spool.rows()],
+                          ['remote'])
+        self.assertEquals(nagios2mantis.db_spool.get_dead()[0][6],
+                          u"UnicodeDecodeError: 'ascii' codec can't decode "
+                          u"byte 0xe9 in position 0: no")
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_dead_total'), 1)
+
+    def test_dead_letters(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.notify = mock.MagicMock()
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', 'apache2', 'KO', 1)
+        nagios2mantis.db_spool.postpone(
+            [1, 2], lambda attempts: timedelta(0), u'Fault: é', 1)
+        nagios2mantis.db_spool.db.execute(
+            "UPDATE nagios2mantis_dead SET died = '2013-01-01 00:00:00'")
+
+        self.assertEquals(
+            nagios2mantis.dead_letters('list'),
+            u'1\t2013-01-01 00:00:00\tlocalhost\t\tDOWN\t1\tFault: é\n'
+            u'2\t2013-01-01 00:00:00\tlocalhost\tapache2\tDOWN\t1\t'
+            u'Fault: é\n')
+        self.assertEquals(nagios2mantis.dead_letters('requeue', ids=[3]),
+                          u'0 rows requeued\n')
+        self.assertFalse(nagios2mantis.notify.called)
+        self.assertEquals(nagios2mantis.dead_letters('requeue', ids=[1]),
+                          u'1 rows requeued\n')
+        nagios2mantis.notify.assert_called_once_with()
+        self.assertEquals(nagios2mantis.dead_letters('purge'),
+                          u'1 rows purged\n')
+        self.assertEquals(nagios2mantis.dead_letters('list'), u'')
+
+    def test_empty_group_tripped(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.empty_rows = mock.MagicMock()
+        nagios2mantis.tripped = True
+
+        nagios2mantis.empty_group([(1, 'localhost', 'DOWN', None, 'KO', 1)])
+
+        self.assertFalse(nagios2mantis.empty_rows.called)
+
+    def test_call(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            ws_mock.return_value.mc_issue_get.side_effect = [
+                {'id': 1}, faultType, socket.error]
+            self.assertEquals(nagios2mantis.call('mc_issue_get', 'login',
+                                                 'password', 1), {'id': 1})
+            with self.assertRaises(faultType):
+                nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+            with self.assertRaises(socket.error):
+                nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+
+        ws_mock.return_value.mc_issue_get.assert_called_with(
+            'login', 'password', 1)
+        for outcome in ['ok', 'fault', 'error']:
+            self.assertEquals(nagios2mantis.metrics.value(
+                'nagios2mantis_mantis_calls_total', method='mc_issue_get',
+                outcome=outcome), 1)
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_mantis_call_seconds_count',
+            method='mc_issue_get'), 3)
+
+    def test_call_rate_limit(self):
+        self.config.rate_limit = 1
+        self.config.rate_burst = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock, \
+                mock.patch('time.sleep') as sleep_mock:
+            nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+            self.assertFalse(sleep_mock.called)
+            nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+
+        self.assertEquals(ws_mock.return_value.mc_issue_get.call_count, 2)
+        wait = sleep_mock.call_args[0][0]
+        self.assertTrue(0 < wait <= 1)
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rate_limited_seconds_total'), wait)
+        self.assertIsNone(nagios2mantis.metrics.value(
+            'nagios2mantis_rate_limit_calls_per_second'))
+
+    def test_call_adaptive_rate(self):
+        self.config.rate_limit = 20
+        self.config.rate_burst = 20
+        self.config.adaptive_rate = True
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock, \
+                mock.patch('logging.info') as info_mock:
+            ws_mock.return_value.mc_issue_get.side_effect = [
+                {'id': 1}, socket.error, faultType]
+            nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+            self.assertEquals(nagios2mantis.metrics.value(
+                'nagios2mantis_rate_limit_calls_per_second'), 20)
+            with self.assertRaises(socket.error):
+                nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+            self.assertEquals(nagios2mantis.metrics.value(
+                'nagios2mantis_rate_limit_calls_per_second'), 10)
+            # Mantis answered
+            with self.assertRaises(faultType):
+                nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+            self.assertEquals(nagios2mantis.metrics.value(
+                'nagios2mantis_rate_limit_calls_per_second'), 11)
+
+        info_mock.assert_called_once_with(
+            'Mantis is overloaded, sending at most %.2f calls per second',
+            10)
+
+    def test_call_slow(self):
+        self.config.rate_limit = 20
+        self.config.adaptive_rate = True
+        self.config.latency_target = 0
+        nagios2mantis = Nagios2Mantis(self.config)
+        with mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            ws_mock.return_value.mc_issue_get.side_effect = \
+                lambda *args: time.sleep(0.01)
+            nagios2mantis.call('mc_issue_get', 'login', 'password', 1)
+
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rate_limit_calls_per_second'), 10)
+
+    def test_drain_metrics_file(self):
+        self.config.metrics_file = self.metrics_file()
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('remote', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('other', 'DOWN', None, 'KO', 1)
+        nagios2mantis.add_issue = mock.MagicMock(
+            side_effect=lambda hostname, service, issue, row_ids:
+            nagios2mantis.metrics.inc('nagios2mantis_rows_sent_total',
+                                      len(row_ids)))
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.db_spool.set_breaker(2, datetime.now())
+
+        nagios2mantis.drain()
+        nagios2mantis.drain()
+
+        with open(self.config.metrics_file) as metrics_file:
+            metrics = metrics_file.read()
+        self.assertIn('# TYPE nagios2mantis_rows_sent_total counter\n'
+                      'nagios2mantis_rows_sent_total 6.0\n', metrics)
+        self.assertIn('nagios2mantis_spool_rows 3.0\n', metrics)
+        self.assertIn('nagios2mantis_breaker_opened 0.0\n', metrics)
+        self.assertIn('nagios2mantis_drain_seconds_count 2.0\n', metrics)
+        self.assertIsNone(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_sent_total'))
+
+        nagios2mantis = Nagios2Mantis(self.config)
+        self.assertIsNone(nagios2mantis.metrics.value(
+            'nagios2mantis_drain_seconds_count'))
+        nagios2mantis.db_spool.close = mock.MagicMock()
+        nagios2mantis.empty_cache()
+        with open(self.config.metrics_file) as metrics_file:
+            self.assertIn('nagios2mantis_drain_seconds_count 3.0\n',
+                          metrics_file.read())
+
+    def test_metrics_file_concurrently(self):
+        # serve and the cron runs write the textfile at the same time: none
+        # of them loses the counts of the others
+        self.config.metrics_file = self.metrics_file()
+        written = []
+
+        def write():
+            nagios2mantis = Nagios2Mantis(self.config)
+            for i in range(10):
+                nagios2mantis.metrics.inc('nagios2mantis_rows_sent_total')
+                nagios2mantis.write_metrics()
+            written.append(nagios2mantis)
+
+        threads = [threading.Thread(target=write) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(len(written), 4)
+        self.assertIn('nagios2mantis_rows_sent_total 40.0\n',
+                      Nagios2Mantis(self.config).stats())
+
+    def test_stats(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        stats = nagios2mantis.stats()
+
+        self.assertIn('# TYPE nagios2mantis_spool_rows gauge\n'
+                      'nagios2mantis_spool_rows 1.0\n', stats)
+        self.assertIn('nagios2mantis_spool_oldest_row_age_seconds ', stats)
+
+    def test_stats_metrics_file(self):
+        self.config.metrics_file = self.metrics_file()
+        with open(self.config.metrics_file, 'w') as metrics_file:
+            metrics_file.write('# TYPE nagios2mantis_rows_sent_total counter\n'
+                               'nagios2mantis_rows_sent_total 2.0\n'
+                               '# TYPE nagios2mantis_spool_rows gauge\n'
+                               'nagios2mantis_spool_rows 5.0\n')
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.metrics.inc('nagios2mantis_rows_sent_total')
+
+        stats = nagios2mantis.stats()
+
+        self.assertIn('nagios2mantis_rows_sent_total 3.0\n', stats)
+        self.assertIn('nagios2mantis_spool_rows 0.0\n', stats)
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_sent_total'), 1)
+
+    def test_drain_tripped(self):
+        self.config.breaker_threshold = 2
+        nagios2mantis = Nagios2Mantis(self.config)
+        for i in range(3):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(side_effect=socket.error(
+            'Connection refused'))
+
+        with mock.patch('logging.warning') as warning_mock:
+            self.assertEquals(nagios2mantis.drain(), 3)
+
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 2)
+        self.assertEquals(warning_mock.call_count, 3)
+        self.assertEquals(nagios2mantis.db_spool.db.execute(
+            'SELECT attempts FROM nagios2mantis ORDER BY id').fetchall(),
+            [(1,), (1,), (0,)])
+        opened, open_until = nagios2mantis.db_spool.get_breaker(
+            datetime.now())
+        self.assertEquals(opened, 1)
+        self.assertIsNotNone(open_until)
+
+        nagios2mantis.empty_rows.reset_mock()
+        self.assertEquals(nagios2mantis.drain(), 0)
+        self.assertFalse(nagios2mantis.empty_rows.called)
+
+    def test_drain_half_open(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.set_breaker(1, datetime.now())
+        for i in range(3):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(
+            side_effect=httplib.BadStatusLine(''))
+
+        with mock.patch('logging.warning'):
+            nagios2mantis.drain()
+
+        nagios2mantis.empty_rows.assert_called_once_with(
+            [(1, u'host0', u'DOWN', None, u'KO', 1)])
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now())[0], 2)
+
+    def test_drain_recovered(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.set_breaker(2, datetime.now())
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock()
+
+        nagios2mantis.drain()
+
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now()), (0, None))
+
+    def test_drain_breaker_disabled(self):
+        self.config.breaker_threshold = 0
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.set_breaker(1, datetime.now())
+        for i in range(3):
+            nagios2mantis.db_spool.add('host%d' % i, 'DOWN', None, 'KO', 1)
+        nagios2mantis.empty_rows = mock.MagicMock(side_effect=HTTPError(
+            503, 'Service Unavailable'))
+
+        with mock.patch('logging.warning'):
+            nagios2mantis.drain()
+
+        self.assertEquals(nagios2mantis.empty_rows.call_count, 3)
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now())[0], 1)
+
+    def test_empty_rows_not_found(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_issue = mock.MagicMock(return_value=2)
+        nagios2mantis.add_note = mock.MagicMock()
+        nagios2mantis.db_spool.delete = mock.MagicMock()
+
+        nagios2mantis.empty_rows([
+            (1, 'localhost', 'UP', None, 'OK', 1),
+            (2, 'localhost', 'DOWN', None, 'KO', 1),
+            (3, 'localhost', 'UP', None, 'OK', 1),
+            (4, 'localhost', 'DOWN', None, 'KO again', 1),
+        ])
+
+        nagios2mantis.find_issue.assert_called_once_with('localhost', None)
+        # The leading recovery is dropped
+        nagios2mantis.db_spool.delete.assert_called_once_with(1)
+        nagios2mantis.add_issue.assert_called_once_with('localhost', None, {
+            'category': u'General',
+            'project': {'id': 1},
+            'description': u'Nagios error detected: KO',
+            'summary': 'localhost is DOWN'
+        }, [2])
+        nagios2mantis.add_note.assert_called_once_with(
+            2, u'Nagios error detected. UP: OK\n'
+            u'Nagios error detected. DOWN: KO again', [3, 4])
+
+    def test_empty_rows_folded(self):
+        self.config.supersede = 'fold'
+        nagios2mantis = Nagios2Mantis(self.config)
+        for state in ['DOWN', 'UP', 'DOWN']:
+            nagios2mantis.db_spool.add('localhost', state, None, 'KO', 1)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', 'apache2', 'KO', 1)
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_issue = mock.MagicMock(return_value=2)
+        nagios2mantis.add_note = mock.MagicMock()
+
+        nagios2mantis.empty_rows(list(nagios2mantis.db_spool.rows())[:1])
+        nagios2mantis.find_issue.return_value = {'id': 2}
+        nagios2mantis.empty_rows(list(nagios2mantis.db_spool.rows())[1:])
+
+        self.assertEquals(
+            nagios2mantis.add_issue.call_args[0][2]['description'],
+            u'Nagios error detected: KO (last of 3 notifications)')
+        nagios2mantis.add_note.assert_called_once_with(
+            2, u'Nagios error detected. DOWN: KO', [4])
+
+    def test_empty_rows_services(self):
+        self.config.supersede = 'fold'
+        nagios2mantis = Nagios2Mantis(self.config)
+        for row in [('localhost', 'DOWN', None, 'KO'),
+                    ('localhost', 'CRITICAL', 'apache2', 'KO'),
+                    ('localhost', 'CRITICAL', 'mysql', 'KO'),
+                    ('localhost', 'CRITICAL', 'apache2', 'Still KO')]:
+            nagios2mantis.db_spool.add(*(row + (1,)))
+        nagios2mantis.db_spool.add_relation('localhost', 'mysql', 3, 1)
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_issue = mock.MagicMock(return_value=2)
+        nagios2mantis.add_note = mock.MagicMock(return_value=True)
+
+        nagios2mantis.empty_rows(
+            correlate(coalesce(list(nagios2mantis.db_spool.rows())))[0])
+
+        nagios2mantis.find_issue.assert_called_once_with('localhost', None)
+        self.assertEquals(nagios2mantis.add_issue.call_args[0][3], [1])
+        nagios2mantis.add_note.assert_called_once_with(
+            2, u'mysql: Nagios error detected. CRITICAL: KO\n'
+            u'apache2: Nagios error detected. CRITICAL: Still KO '
+            u'(last of 2 notifications)', [3, 4])
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_suppressed_total'), 2)
+        # The next events of apache2 do not go to the host issue
+        self.assertIsNone(
+            nagios2mantis.db_spool.get_issue_id('localhost', 'apache2'))
+        self.assertEquals(
+            nagios2mantis.db_spool.get_issue_id('localhost', 'mysql'), 3)
+
+    def test_empty_rows_services_note_failed(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.find_issue = mock.MagicMock(return_value={'id': 2})
+        nagios2mantis.add_note = mock.MagicMock(return_value=None)
+
+        nagios2mantis.empty_rows([
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'CRITICAL', 'apache2', 'KO', 1),
+        ])
+
+        self.assertEquals(nagios2mantis.add_note.call_count, 2)
+        self.assertIsNone(
+            nagios2mantis.db_spool.get_issue_id('localhost', 'apache2'))
+        self.assertIsNone(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_suppressed_total'))
+
+    def test_empty_rows_services_no_host_issue(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_issue = mock.MagicMock(side_effect=[None, 3, 4])
+
+        nagios2mantis.empty_rows([
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'CRITICAL', 'apache2', 'KO', 1),
+            (3, 'localhost', 'CRITICAL', 'mysql', 'KO', 1),
+        ])
+
+        # Sent on their own
+        self.assertEquals(
+            [call[0][:2] for call in nagios2mantis.add_issue.call_args_list],
+            [('localhost', None), ('localhost', 'apache2'),
+             ('localhost', 'mysql')])
+
+    def test_drain_suppress_services(self):
+        self.config.suppress_services = True
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('localhost', 'CRITICAL', 'apache2', 'KO',
+                                   1)
+        nagios2mantis.empty_rows = mock.MagicMock()
+
+        nagios2mantis.drain()
+
+        nagios2mantis.empty_rows.assert_called_once_with([
+            (1, u'localhost', u'DOWN', None, u'KO', 1),
+            (2, u'localhost', u'CRITICAL', u'apache2', u'KO', 1),
+        ])
+
+    def test_empty_rows_not_found_add_issue_failed(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.find_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_issue = mock.MagicMock(return_value=None)
+        nagios2mantis.add_note = mock.MagicMock()
+
+        nagios2mantis.empty_rows([
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'UP', None, 'OK', 1),
+        ])
+
+        self.assertTrue(nagios2mantis.add_issue.called)
+        self.assertFalse(nagios2mantis.add_note.called)
+
+    def test_empty_rows_found(self):
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.find_issue = mock.MagicMock(return_value={'id': 1})
+        nagios2mantis.add_issue = mock.MagicMock()
+        nagios2mantis.add_note = mock.MagicMock()
+
+        nagios2mantis.empty_rows([
+            (1, 'localhost', 'CRITICAL', 'apache2', 'KO', 1),
+            (2, 'localhost', 'OK', 'apache2', 'OK', 1),
+        ])
+
+        nagios2mantis.find_issue.assert_called_once_with(
+            'localhost', 'apache2')
+        nagios2mantis.add_note.assert_called_once_with(
+            1, u'Nagios error detected. CRITICAL: KO\n'
+            u'Nagios error detected. OK: OK', [1, 2])
+        self.assertFalse(nagios2mantis.add_issue.called)
+
+
+class MantisProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.proxy = MantisProxy({
+            'mc_issue_get': ('http://mantis/soap', 'urn:mantis', 'get'),
+        })
+
+    def test_call(self):
+        with mock.patch('SOAPpy.SOAPProxy') as soap_mock:
+            self.proxy.mc_issue_get('login', 'password', 1)
+
+        soap_mock.assert_called_once_with('http://mantis/soap',
+                                          namespace='urn:mantis',
+                                          soapaction='get',
+                                          transport=HTTPTransport)
+        soap_mock.return_value.mc_issue_get.assert_called_once_with(
+            'login', 'password', 1)
+
+    def test_unknown(self):
+        with self.assertRaises(AttributeError):
+            self.proxy.mc_unknown
+
+
+class SoapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        status, body, headers = self.server.responses.pop(0)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', len(body))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+        # Without telling the client, as idle connections are closed
+        if self.server.close_silently:
+            self.close_connection = 1
+
+    def log_message(self, *args):
+        pass
+
+
+class SoapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           SoapHandler)
+        self.connections = 0
+        self.responses = []
+        self.close_silently = False
+        thread = threading.Thread(target=self.serve_forever, args=(0.01,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/soap' % self.server_address[1]
+
+    def respond(self, result, status=200, headers=()):
+        self.responses.append((status, SOAPpy.buildSOAP(
+            kw={'return': result}, method='mc_issue_addResponse',
+            namespace='urn:mantis'), headers))
+
+    def fault(self):
+        self.responses.append((500, SOAPpy.buildSOAP(
+            faultType('SOAP-ENV:Client', 'Issue does not exist')), ()))
+
+    def handle_error(self, request, client_address):
+        # The tests drop connections on purpose
+        pass
+
+
+class FakeMantisTest(unittest.TestCase):
+    def setUp(self):
+        self.config = Config('tests/nagios2mantis_test.ini')
+        self.config.sqlite_file = ':memory:'
+        self.config.inotify_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, self.config.inotify_file)
+
+    def serve(self, *args):
+        server = FakeMantis(*args)
+        self.addCleanup(server.stop)
+        self.config.wsdl = server.wsdl
+        return server
+
+    def test_empty_cache(self):
+        server = self.serve()
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('localhost', 'UP', None, 'OK', 1)
+        nagios2mantis.db_spool.add('localhost', 'CRITICAL', 'apache2', 'KO',
+                                   2)
+
+        nagios2mantis.empty_cache()
+
+        self.assertEquals(sorted(
+            (issue['summary'], issue['project']['id'], issue['notes'])
+            for issue in server.issues.values()), [
+                ('apache2 is CRITICAL on host localhost', 2, []),
+                ('localhost is DOWN', 1,
+                 ['Nagios error detected. UP: OK'])])
+        self.assertEquals(server.calls['mc_issue_add'], 2)
+
+    def test_known_issue(self):
+        server = self.serve()
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.drain()
+        nagios2mantis.db_spool.add('localhost', 'UP', None, 'OK', 1)
+
+        nagios2mantis.drain()
+
+        self.assertEquals(server.issues[1]['notes'],
+                          ['Nagios error detected. UP: OK'])
+
+    def test_prefetch(self):
+        server = self.serve()
+        self.config.prefetch_issues = True
+        self.config.prefetch_page_size = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        for hostname in ['host1', 'host2', 'host3']:
+            nagios2mantis.db_spool.add(hostname, 'DOWN', None, 'KO', 1)
+        nagios2mantis.drain()
+        for hostname in ['host1', 'host2', 'host3']:
+            nagios2mantis.db_spool.add(hostname, 'UP', None, 'OK', 1)
+        server.calls.clear()
+
+        nagios2mantis.drain()
+
+        self.assertEquals(server.calls['mc_issue_get'], 0)
+        self.assertEquals(server.calls['mc_project_get_issue_headers'], 4)
+        self.assertEquals(server.calls['mc_issue_note_add'], 3)
+
+    def test_prefetch_new_issues(self):
+        # The issues opened by a drain are not looked up by its next pages
+        server = self.serve()
+        self.config.prefetch_issues = True
+        self.config.page_size = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('localhost', 'UP', None, 'OK', 1)
+
+        nagios2mantis.drain()
+
+        self.assertEquals(server.calls['mc_issue_get'], 0)
+        self.assertEquals(server.calls['mc_issue_add'], 1)
+        self.assertEquals(server.issues[1]['notes'],
+                          ['Nagios error detected. UP: OK'])
+
+    def test_fault(self):
+        self.serve(0, 1)
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        nagios2mantis.drain()
+
+        self.assertEquals(nagios2mantis.db_spool.db.execute(
+            'SELECT attempts FROM nagios2mantis').fetchall(), [(1,)])
+
+    def test_error(self):
+        self.serve(0, 0, 1)
+        self.config.breaker_threshold = 1
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        nagios2mantis.drain()
+
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now())[0], 1)
+
+    def test_dead(self):
+        server = self.serve(0, 1)
+        self.config.max_attempts = 2
+        self.config.retry_backoff = 0
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+
+        with mock.patch('logging.exception'), mock.patch('logging.error'):
+            nagios2mantis.drain()
+            nagios2mantis.drain()
+
+        self.assertEquals(list(nagios2mantis.db_spool.rows()), [])
+        self.assertEquals(server.calls['mc_issue_add'], 2)
+        self.assertEquals(nagios2mantis.db_spool.get_dead()[0][6],
+                          u'faultType: <Fault SOAP-ENV:Server: Injected '
+                          u'fault>')
+
+        server.fault_rate = 0
+        nagios2mantis.dead_letters('requeue')
+        nagios2mantis.drain()
+
+        self.assertEquals([issue['summary'] for issue in
+                           server.issues.values()], ['localhost is DOWN'])
+
+    def test_instances(self):
+        server = self.serve()
+        support = FakeMantis()
+        self.addCleanup(support.stop)
+        # Down
+        lab = FakeMantis(0, 0, 1)
+        self.addCleanup(lab.stop)
+        self.config.sqlite_file = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, self.config.sqlite_file)
+        self.config.breaker_threshold = 1
+        self.config.instances = {
+            'support': {'wsdl': support.wsdl, 'username': 'support',
+                        'password': 'support', 'project_id': 5,
+                        'workers': 2},
+            'lab': {'wsdl': lab.wsdl, 'username': 'lab', 'password': 'lab',
+                    'project_id': 1, 'workers': 1},
+        }
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.db_spool.add('localhost', 'DOWN', None, 'KO', 1)
+        nagios2mantis.db_spool.add('remote', 'DOWN', None, 'KO', 5,
+                                   'support')
+        nagios2mantis.db_spool.add('lab', 'DOWN', None, 'KO', 1, 'lab')
+
+        nagios2mantis.drain()
+        self.wait_instances(nagios2mantis)
+
+        self.assertEquals([issue['summary'] for issue in
+                           server.issues.values()], ['localhost is DOWN'])
+        self.assertEquals([issue['summary'] for issue in
+                           support.issues.values()], ['remote is DOWN'])
+        self.assertEquals(sum(lab.calls.values()), 1)
+        self.assertEquals([row[1] for row in nagios2mantis.db_spool.rows()],
+                          ['lab'])
+        self.assertEquals(nagios2mantis.db_spool.get_breaker(
+            datetime.now())[0], 0)
+        self.assertEquals(DbSpool(self.config.sqlite_file, instance='lab')
+                          .get_breaker(datetime.now())[0], 1)
+        self.assertIsNone(nagios2mantis.db_spool.get_issue_id('remote',
+                                                              None))
+        drainer = nagios2mantis.instance_drainers['support']
+
+        nagios2mantis.db_spool.add('remote', 'UP', None, 'OK', 5, 'support')
+        nagios2mantis.drain()
+        self.wait_instances(nagios2mantis)
+
+        self.assertIs(nagios2mantis.instance_drainers['support'], drainer)
+        self.assertEquals(support.issues[1]['notes'],
+                          ['Nagios error detected. UP: OK'])
+        self.assertEquals(support.calls['mc_issue_add'], 1)
+        self.assertEquals(nagios2mantis.metrics.value(
+            'nagios2mantis_rows_sent_total'), 3)
+
+        threads = drainer.pool.threads + [
+            thread for pool in nagios2mantis.instance_pools.values()
+            for thread in pool.threads]
+
+        nagios2mantis.close()
+
+        self.assertEquals(nagios2mantis.instance_pools, {})
+        self.assertEquals(nagios2mantis.instance_drainers, {})
+        self.assertEquals(nagios2mantis.instance_drains, {})
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+
+    def wait_instances(self, nagios2mantis):
+        for queued in nagios2mantis.instance_drains.values():
+            for event in queued:
+                event.wait()
+
+    def test_instances_independent(self):
+        # A slow instance holds back neither the drains of this one, nor
+        # those of the other instances
+        self.config.instances = {'lab': {}, 'support': {}}
+        nagios2mantis = Nagios2Mantis(self.config)
+        nagios2mantis.drain_pages = mock.MagicMock(return_value=0)
+        release = threading.Event()
+        drained = []
+
+        def drain_instance(name):
+            if name == 'lab':
+                release.wait()
+            drained.append(name)
+
+        nagios2mantis.drain_instance = drain_instance
+        for i in range(4):
+            nagios2mantis.drain()
+            for event in nagios2mantis.instance_drains['support']:
+                event.wait()
+
+        self.assertEquals(nagios2mantis.drain_pages.call_count, 4)
+        self.assertEquals(drained, ['support'] * 4)
+        self.assertEquals(len(nagios2mantis.instance_drains['lab']), 2)
+
+        release.set()
+        nagios2mantis.close()
+
+        self.assertEquals(drained, ['support'] * 4 + ['lab'] * 2)
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run(self):
+        results = benchmark.run(rows=20, hosts=2, services=2)
+
+        self.assertEquals(results['sent'], 20)
+        self.assertEquals(results['calls']['mc_issue_add'], 4)
+        self.assertEquals(results['calls']['mc_issue_note_add'], 4)
+        self.assertTrue(results['p50'] <= results['p99'] <=
+                        results['seconds'])
+
+    def test_percentile(self):
+        self.assertIsNone(benchmark.percentile([], 0.5))
+        self.assertEquals(benchmark.percentile(range(100), 0.5), 50)
+        self.assertEquals(benchmark.percentile(range(100), 0.99), 99)
+        self.assertEquals(benchmark.percentile([1], 0.99), 1)
+
+
+class KeepAliveTransportTest(unittest.TestCase):
+    def setUp(self):
+        self.server = SoapServer()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.pool = ConnectionPool(2, 5, 5)
+        self.proxy = MantisProxy(
+            {'mc_issue_add': (self.server.url, 'urn:mantis', 'add')},
+            lambda: KeepAliveTransport(self.pool))
+
+    def test_keep_alive(self):
+        self.server.respond(1)
+        self.server.respond(2)
+
+        self.assertEquals(self.proxy.mc_issue_add('login', 'password', {}), 1)
+        self.assertEquals(self.proxy.mc_issue_add('login', 'password', {}), 2)
+
+        self.assertEquals(self.server.connections, 1)
+
+    def test_fault(self):
+        self.server.fault()
+        with self.assertRaises(faultType):
+            self.proxy.mc_issue_add('login', 'password', {})
+
+    def test_http_error(self):
+        self.server.responses.append((404, 'Not found', ()))
+        self.server.responses.append((500, '', ()))
+        for _ in range(2):
+            with self.assertRaises(HTTPError):
+                self.proxy.mc_issue_add('login', 'password', {})
+
+    def test_connection_close(self):
+        self.server.respond(1, headers=[('Connection', 'close')])
+        self.server.respond(2)
+
+        self.proxy.mc_issue_add('login', 'password', {})
+        self.proxy.mc_issue_add('login', 'password', {})
+
+        self.assertEquals(self.server.connections, 2)
+
+    def idle(self):
+        return self.pool.idle[('http', self.server.server_address[0] +
+                               ':%d' % self.server.server_address[1])]
+
+    def test_stale_connection(self):
+        self.server.close_silently = True
+        self.server.respond(1)
+        self.server.respond(2)
+        self.proxy.mc_issue_add('login', 'password', {})
+        select.select([self.idle()[0].sock], [], [], 5)
+
+        with mock.patch('httplib.HTTPConnection.request',
+                        autospec=True,
+                        side_effect=httplib.HTTPConnection.request) \
+                as request_mock:
+            self.assertEquals(
+                self.proxy.mc_issue_add('login', 'password', {}), 2)
+
+        # Not even tried on the closed connection
+        self.assertEquals(request_mock.call_count, 1)
+        self.assertEquals(self.server.connections, 2)
+
+    def fail_once(self, method, error):
+        # Fails the next call of the method of HTTPConnection
+        original = getattr(httplib.HTTPConnection, method)
+        errors = [error]
+
+        def fail(connection, *args, **kw):
+            if errors:
+                raise errors.pop()
+            return original(connection, *args, **kw)
+        return mock.patch('httplib.HTTPConnection.' + method, autospec=True,
+                          side_effect=fail)
+
+    def test_retry_unsent(self):
+        for error in [socket.error(errno.EPIPE, 'Broken pipe'),
+                      socket.error(errno.ECONNRESET, 'Connection reset')]:
+            self.server.respond(1)
+            self.server.respond(2)
+            self.proxy.mc_issue_add('login', 'password', {})
+            with self.fail_once('request', error):
+                self.assertEquals(
+                    self.proxy.mc_issue_add('login', 'password', {}), 2)
+
+    def test_retry_closed(self):
+        self.server.respond(1)
+        # Answered, but dropped as if the server had closed the connection
+        self.server.respond(3)
+        self.server.respond(2)
+        self.proxy.mc_issue_add('login', 'password', {})
+        with self.fail_once('getresponse', httplib.BadStatusLine('')):
+            self.assertEquals(
+                self.proxy.mc_issue_add('login', 'password', {}), 2)
+
+    def test_no_retry(self):
+        # The request may have reached Mantis
+        for method, error in [
+                ('request', socket.timeout('timed out')),
+                ('request', socket.error(errno.EBADF, 'Bad file')),
+                ('getresponse', socket.timeout('timed out')),
+                ('getresponse', socket.error(errno.ECONNRESET, 'Reset')),
+                ('getresponse', httplib.BadStatusLine('HTTP/1.1 abc'))]:
+            # One for the failed request too, if it reaches the server
+            self.server.respond(1)
+            self.server.respond(1)
+            self.proxy.mc_issue_add('login', 'password', {})
+            with self.fail_once(method, error) as method_mock:
+                with self.assertRaises(type(error)):
+                    self.proxy.mc_issue_add('login', 'password', {})
+            self.assertEquals(method_mock.call_count, 1)
+            self.assertEquals(self.idle(), [])
+
+    def test_connect_error(self):
+        self.server.server_close()
+        transport = KeepAliveTransport(self.pool)
+        for _ in range(3):
+            with self.assertRaises(socket.error):
+                transport.call(self.server.url, '', 'urn:mantis')
+
+    def test_request_error(self):
+        transport = KeepAliveTransport(self.pool)
+        with mock.patch('httplib.HTTPConnection.getresponse',
+                        side_effect=httplib.BadStatusLine('')):
+            for _ in range(3):
+                with self.assertRaises(httplib.BadStatusLine):
+                    transport.call(self.server.url, '', 'urn:mantis')
+
+    def test_no_namespace(self):
+        self.server.respond(1)
+        transport = KeepAliveTransport(self.pool)
+
+        data, namespace = transport.call(self.server.url, '', None,
+                                         encoding='UTF-8')
+
+        self.assertIn('mc_issue_addResponse', data)
+        self.assertIsNone(namespace)
+
+    def test_extended_namespace(self):
+        transport = KeepAliveTransport(self.pool)
+        body = '<ns1:r xmlns:ns1="urn:mantis:1.2"/>'
+
+        self.assertEquals(transport.getNS('urn:mantis', body),
+                          'urn:mantis:1.2')
+        self.assertEquals(transport.getNS('urn:other', body), 'urn:other')
+        self.assertEquals(transport.getNS(u'urn:mantis', body), u'urn:mantis')
+
+    def test_https(self):
+        with mock.patch('httplib.HTTPSConnection') as https_mock:
+            connection, reused = self.pool.get('https', 'mantis')
+
+        https_mock.assert_called_once_with('mantis', timeout=5)
+        self.assertIs(connection, https_mock.return_value)
+        connection.sock.settimeout.assert_called_once_with(5)
+        self.assertFalse(reused)
+
+
+class SpoolSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool_socket = SpoolSocket(os.path.join(self.directory,
+                                                     'spool.socket'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_not_listening(self):
+        self.assertFalse(self.spool_socket.send('localhost', 'DOWN', None,
+                                                'KO', 1))
+
+    def test_send(self):
+        self.spool_socket.bind()
+        self.assertTrue(self.spool_socket.send('localhost', 'DOWN', None,
+                                               'é', 1))
+        self.assertTrue(self.spool_socket.send('localhost', 'UP', None,
+                                               'OK', 1))
+        self.assertEquals(self.spool_socket.receive(1), [
+            {'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+             'plugin_output': u'é', 'project_id': 1, 'instance': None},
+            {'hostname': u'localhost', 'state': u'UP', 'service': None,
+             'plugin_output': u'OK', 'project_id': 1, 'instance': None}])
+        self.assertEquals(self.spool_socket.close(), [])
+        self.assertFalse(os.path.exists(self.spool_socket.path))
+
+    def test_send_too_large(self):
+        # Spooled in SQLite instead of being truncated
+        self.spool_socket.bind()
+        self.assertFalse(self.spool_socket.send('localhost', 'DOWN', None,
+                                                'K' * 70000, 1))
+        self.assertTrue(self.spool_socket.send('localhost', 'DOWN', None,
+                                               'K' * 65000, 1))
+        self.assertEquals(
+            len(self.spool_socket.receive(1)[0]['plugin_output']), 65000)
+        self.spool_socket.close()
+
+    def test_close_pending(self):
+        self.spool_socket.bind()
+        self.spool_socket.send('localhost', 'DOWN', None, 'KO', 1)
+
+        self.assertEquals(self.spool_socket.close(), [
+            {'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+             'plugin_output': u'KO', 'project_id': 1, 'instance': None}])
+        self.assertFalse(self.spool_socket.send('localhost', 'UP', None,
+                                                'OK', 1))
+
+    def test_receive_timeout(self):
+        self.spool_socket.bind()
+        self.assertEquals(self.spool_socket.receive(0), [])
+
+    def test_receive_malformed(self):
+        self.spool_socket.bind()
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.sendto('not json', self.spool_socket.path)
+        sender.sendto('[]', self.spool_socket.path)
+        sender.sendto('{"hostname": "localhost"}', self.spool_socket.path)
+        sender.close()
+        with mock.patch('logging.warning') as warning_mock:
+            self.assertEquals(self.spool_socket.receive(1), [{
+                'hostname': u'localhost', 'state': None, 'service': None,
+                'plugin_output': None, 'project_id': None,
+                'instance': None}])
+        self.assertEquals(warning_mock.call_count, 2)
+
+    def test_receive_error(self):
+        self.spool_socket.bind()
+        self.spool_socket.socket = mock.MagicMock()
+        self.spool_socket.socket.recv.side_effect = socket.error(
+            errno.EBADF, 'Bad file descriptor')
+        with mock.patch('select.select', return_value=([True], [], [])):
+            with self.assertRaises(socket.error):
+                self.spool_socket.receive(0)
+
+    def test_bind_stale(self):
+        open(self.spool_socket.path, 'w').close()
+        self.spool_socket.bind()
+        self.assertTrue(self.spool_socket.send('localhost', 'UP', None,
+                                               'OK', 1))
+
+    def test_bind_error(self):
+        with mock.patch('os.remove', side_effect=OSError(errno.EACCES, '')):
+            with self.assertRaises(OSError):
+                self.spool_socket.bind()
+
+
+class WsdlCacheTest(unittest.TestCase):
+    url = 'http://mantis.example.com/api/soap/mantisconnect.php?wsdl'
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = WsdlCache(self.url, self.directory, 60)
+        with open('tests/mantisconnect.wsdl') as wsdl:
+            self.wsdl = wsdl.read()
+
+    def response(self, headers=''):
+        return urllib.addinfourl(StringIO(self.wsdl),
+                                 mimetools.Message(StringIO(headers)),
+                                 self.url)
+
+    def test_save_concurrently(self):
+        errors = []
+
+        def save():
+            try:
+                for _ in range(50):
+                    self.cache.save({'fetched': 0})
+            except Exception as error:
+                errors.append(error)
+        threads = [threading.Thread(target=save) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEquals(errors, [])
+        self.assertEquals(self.cache.load(), {'fetched': 0})
+        self.assertEquals(os.listdir(self.directory),
+                          [os.path.basename(self.cache.metadata_file)])
+
+    def test_download(self):
+        with mock.patch('urllib2.urlopen', return_value=self.response(
+                'ETag: "1"\nLast-Modified: Fri, 16 Oct 2026\n\n')):
+            proxy = self.cache.proxy()
+
+        self.assertEquals(proxy.methods['mc_issue_get'], (
+            'http://mantis.example.com/api/soap/mantisconnect.php',
+            'http://futureware.biz/mantisconnect',
+            'http://www.mantisbt.org/bugs/api/soap/mantisconnect.php/'
+            'mc_issue_get'))
+        self.assertIsInstance(proxy.methods['mc_issue_get'][0], str)
+        metadata = self.cache.load()
+        self.assertEquals(metadata['etag'], '"1"')
+        self.assertEquals(metadata['last_modified'], 'Fri, 16 Oct 2026')
+        with open(self.cache.wsdl_file) as wsdl:
+            self.assertEquals(wsdl.read(), self.wsdl)
+
+    def test_cached(self):
+        with mock.patch('urllib2.urlopen', return_value=self.response()):
+            self.cache.proxy()
+        with mock.patch('urllib2.urlopen') as urlopen_mock, \
+                mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            proxy = WsdlCache(self.url, self.directory, 60).proxy()
+
+        self.assertFalse(urlopen_mock.called)
+        self.assertFalse(ws_mock.called)
+        self.assertEquals(len(proxy.methods), 4)
+
+    def test_not_modified(self):
+        with mock.patch('urllib2.urlopen', return_value=self.response(
+                'ETag: "1"\nLast-Modified: Fri, 16 Oct 2026\n\n')):
+            self.cache.proxy()
+        self.cache.max_age = -1
+        not_modified = urllib2.HTTPError(self.url, 304, 'Not Modified', None,
+                                         None)
+        with mock.patch('urllib2.urlopen',
+                        side_effect=not_modified) as urlopen_mock, \
+                mock.patch('SOAPpy.WSDL.Proxy') as ws_mock:
+            proxy = self.cache.proxy()
+
+        request = urlopen_mock.call_args[0][0]
+        self.assertEquals(request.get_header('If-none-match'), '"1"')
+        self.assertEquals(request.get_header('If-modified-since'),
+                          'Fri, 16 Oct 2026')
+        self.assertFalse(ws_mock.called)
+        self.assertEquals(len(proxy.methods), 4)
+
+    def test_modified(self):
+        with mock.patch('urllib2.urlopen', return_value=self.response()):
+            self.cache.proxy()
+        self.cache.max_age = -1
+        self.wsdl = self.wsdl.replace('mantis.example.com', 'mantis.local')
+        with mock.patch('urllib2.urlopen', return_value=self.response()):
+            proxy = self.cache.proxy()
+
+        self.assertEquals(
+            proxy.methods['mc_issue_add'][0],
+            'http://mantis.local/api/soap/mantisconnect.php')
+
+    def test_unreachable(self):
+        with mock.patch('urllib2.urlopen', return_value=self.response()):
+            self.cache.proxy()
+        self.cache.max_age = -1
+        with mock.patch('urllib2.urlopen',
+                        side_effect=urllib2.URLError('down')), \
+                mock.patch('logging.warning') as warning_mock:
+            proxy = self.cache.proxy()
+
+        self.assertTrue(warning_mock.called)
+        self.assertEquals(len(proxy.methods), 4)
+
+    def test_unreachable_not_cached(self):
+        with mock.patch('urllib2.urlopen',
+                        side_effect=urllib2.URLError('down')):
+            with self.assertRaises(urllib2.URLError):
+                self.cache.proxy()
+
+    def test_http_error(self):
+        error = urllib2.HTTPError(self.url, 500, 'Error', None, None)
+        with mock.patch('urllib2.urlopen', side_effect=error):
+            with self.assertRaises(urllib2.HTTPError):
+                self.cache.proxy()
+
+    def test_corrupted(self):
+        with open(self.cache.metadata_file, 'w') as metadata_file:
+            metadata_file.write('{')
+        self.assertIsNone(self.cache.load())
+
+
+class WorkerPoolTest(unittest.TestCase):
+    def test_map(self):
+        pool = WorkerPool(2)
+        results = []
+
+        self.assertTrue(pool.map(results.append, range(5)).wait(5))
+        self.assertEquals(sorted(results), range(5))
+
+    def test_map_empty(self):
+        pool = WorkerPool(1)
+        self.assertTrue(pool.map(None, []).is_set())
+
+    def test_map_fail(self):
+        pool = WorkerPool(1)
+        with mock.patch('logging.exception') as exc_mock:
+            self.assertTrue(pool.map(lambda item: 1 / item, [0, 1]).wait(5))
+        exc_mock.assert_called_once_with('A worker failed')
+
+
+class SpoolWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.writer = SpoolWriter(DbSpool(':memory:'))
+        self.done = threading.Event()
+
+    def run_worker(self, func):
+        result = []
+
+        def worker():
+            try:
+                result.append(func())
+            except Exception as exception:
+                result.append(exception)
+            finally:
+                self.done.set()
+        threading.Thread(target=worker).start()
+        self.writer.serve(self.done)
+        return result[0]
+
+    def test_call(self):
+        self.writer.db_spool.add_relation('localhost', None, 1)
+        self.assertEquals(self.run_worker(
+            lambda: self.writer.get_issue_id('localhost', None)), 1)
+
+    def test_call_raises(self):
+        self.writer.db_spool.add_relation('localhost', None, 1)
+        self.assertIsInstance(self.run_worker(
+            lambda: self.writer.add_relation('localhost', None, 1)),
+            sqlite3.IntegrityError)
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_counter(self):
+        self.metrics.inc('calls_total', method='b')
+        self.metrics.inc('calls_total', 2, method='a')
+        self.metrics.inc('calls_total', method='b')
+
+        self.assertEquals(self.metrics.render(),
+                          '# TYPE calls_total counter\n'
+                          'calls_total{method="b"} 2.0\n'
+                          'calls_total{method="a"} 2.0\n')
+
+    def test_gauge(self):
+        self.metrics.set('rows', 3)
+        self.metrics.set('rows', 1)
+
+        self.assertEquals(self.metrics.render(),
+                          '# TYPE rows gauge\nrows 1.0\n')
+
+    def test_histogram(self):
+        self.metrics.BUCKETS = (0.1, 1)
+        self.metrics.observe('seconds', 0.5, method='a')
+        self.metrics.observe('seconds', 2, method='a')
+
+        self.assertEquals(self.metrics.render(),
+                          '# TYPE seconds histogram\n'
+                          'seconds_bucket{le="0.1",method="a"} 0.0\n'
+                          'seconds_bucket{le="1",method="a"} 1.0\n'
+                          'seconds_bucket{le="+Inf",method="a"} 2.0\n'
+                          'seconds_sum{method="a"} 2.5\n'
+                          'seconds_count{method="a"} 2.0\n')
+
+    def test_timer(self):
+        with self.assertRaises(KeyError):
+            with self.metrics.timer('seconds'):
+                raise KeyError
+        self.assertEquals(self.metrics.value('seconds_count'), 1)
+        self.assertIsNone(self.metrics.value('seconds_count', method='a'))
+
+    def test_load(self):
+        textfile = tempfile.mkstemp()[1]
+        self.addCleanup(os.remove, textfile)
+        self.metrics.inc('calls_total', method='a')
+        self.metrics.observe('seconds', 0.5)
+        self.metrics.set('rows', 1)
+        with open(textfile, 'w') as output:
+            output.write('ignored 1\n' + self.metrics.render() + '# HELP\n')
+
+        metrics = Metrics()
+        metrics.load(textfile)
+        metrics.inc('calls_total', method='a')
+
+        self.assertEquals(metrics.value('calls_total', method='a'), 2)
+        self.assertEquals(metrics.value('seconds_count'), 1)
+        self.assertEquals(metrics.value('rows'), 1)
+
+    def test_merge(self):
+        self.metrics.inc('calls_total', method='a')
+        self.metrics.observe('seconds', 0.5)
+        self.metrics.set('rows', 3)
+        other = Metrics()
+        other.inc('calls_total', 2, method='a')
+        other.observe('seconds', 2)
+        other.set('rows', 1)
+
+        self.assertIs(self.metrics.merge(other), self.metrics)
+        self.assertEquals(self.metrics.value('calls_total', method='a'), 3)
+        self.assertEquals(self.metrics.value('seconds_sum'), 2.5)
+        self.assertEquals(self.metrics.value('seconds_count'), 2)
+        self.assertEquals(self.metrics.value('rows'), 1)
+
+    def test_take(self):
+        self.metrics.inc('calls_total')
+
+        taken = self.metrics.take()
+        self.metrics.inc('calls_total', 2)
+
+        self.assertEquals(taken.render(),
+                          '# TYPE calls_total counter\ncalls_total 1.0\n')
+        self.assertEquals(self.metrics.value('calls_total'), 2)
+
+    def test_load_missing(self):
+        self.metrics.load('/nonexistent/nagios2mantis.prom')
+        self.assertEquals(self.metrics.render(), '')
+
+
+class BackoffTest(unittest.TestCase):
+    def test_exponential(self):
+        for attempts, delay in [(1, 60), (2, 120), (3, 240)]:
+            seconds = backoff(60, 3600, attempts).total_seconds()
+            self.assertTrue(delay / 2 <= seconds <= delay)
+
+    def test_maximum(self):
+        seconds = backoff(60, 3600, 20).total_seconds()
+        self.assertTrue(1800 <= seconds <= 3600)
+
+
+class CoalesceTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEquals(coalesce([]), [])
+
+    def test_groups(self):
+        rows = [
+            (1, 'localhost', 'DOWN', 'apache2', 'KO', 1),
+            (2, 'localhost', 'DOWN', None, 'KO', 1),
+            (3, 'remote', 'DOWN', 'apache2', 'KO', 1),
+            (4, 'localhost', 'OK', 'apache2', 'OK', 1),
+        ]
+        self.assertEquals(coalesce(rows), [
+            [rows[0], rows[3]],
+            [rows[1]],
+            [rows[2]],
+        ])
+
+
+class CorrelateTest(unittest.TestCase):
+    def test_empty(self):
+        self.assertEquals(correlate([]), [])
+
+    def test_host_down(self):
+        rows = [
+            (1, 'localhost', 'CRITICAL', 'apache2', 'KO', 1),
+            (2, 'localhost', 'DOWN', None, 'KO', 1),
+            (3, 'remote', 'CRITICAL', 'apache2', 'KO', 1),
+            (4, 'localhost', 'CRITICAL', 'mysql', 'KO', 1),
+            (5, 'remote', 'UP', None, 'OK', 1),
+        ]
+        self.assertEquals(correlate(coalesce(rows)), [
+            [rows[1], rows[0], rows[3]],
+            [rows[2]],
+            [rows[4]],
+        ])
+
+    def test_host_up(self):
+        rows = [
+            (1, 'localhost', 'DOWN', None, 'KO', 1),
+            (2, 'localhost', 'CRITICAL', 'apache2', 'KO', 1),
+            (3, 'localhost', 'UP', None, 'OK', 1),
+        ]
+        self.assertEquals(correlate(coalesce(rows)),
+                          [[rows[0], rows[2]], [rows[1]]])
+
+
+class ImportTest(unittest.TestCase):
+    def test_nagios_log(self):
+        lines = [
+            '[1380000000] SERVICE NOTIFICATION: alice;localhost;apache2;'
+            'CRITICAL;notify-service-by-email;Connection refused; port 80\n',
+            '[1380000000] SERVICE NOTIFICATION: bob;localhost;apache2;'
+            'CRITICAL;notify-service-by-email;Connection refused; port 80\n',
+            '[1380000060] SERVICE ALERT: localhost;apache2;OK;HARD;1;OK\n',
+            '[1380000060] SERVICE NOTIFICATION: alice;localhost;apache2;'
+            'ACKNOWLEDGEMENT (CRITICAL);notify-service-by-email;Down\n',
+            '[1380000120] HOST NOTIFICATION: alice;remote;DOWN;'
+            'notify-host-by-email;PING CRITICAL - d\xc3\xa9j\xc3\xa0\n',
+            '[1380000180] HOST NOTIFICATION: alice;remote;UNREACHABLE;'
+            'notify-host-by-email;Unreachable\n',
+            '[1380000240] HOST NOTIFICATION: alice;remote;UP\n',
+            '[1380000300] SERVICE NOTIFICATION: alice;localhost;apache2;'
+            'OK;notify-service-by-email;HTTP OK\r\n',
+        ]
+
+        self.assertEquals(list(read_nagios_log(lines)), [{
+            'hostname': u'localhost', 'state': u'CRITICAL',
+            'service': u'apache2',
+            'plugin_output': u'Connection refused; port 80',
+            'host_notes': None,
+        }, {
+            'hostname': u'remote', 'state': u'DOWN', 'service': None,
+            'plugin_output': u'PING CRITICAL - déjà', 'host_notes': None,
+        }, {
+            'hostname': u'localhost', 'state': u'OK', 'service': u'apache2',
+            'plugin_output': u'HTTP OK', 'host_notes': None,
+        }])
+
+    def test_csv(self):
+        lines = [
+            'hostname,state,service,plugin_output\n',
+            'localhost,DOWN,,"KO, d\xc3\xa9j\xc3\xa0"\n',
+            'localhost,DOWNTIMESTART,,KO\n',
+            'localhost,CRITICAL,apache2,KO\n',
+        ]
+
+        self.assertEquals(list(read_csv(lines)), [{
+            'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+            'plugin_output': u'KO, déjà', 'host_notes': None,
+        }, {
+            'hostname': u'localhost', 'state': u'CRITICAL',
+            'service': u'apache2', 'plugin_output': u'KO',
+            'host_notes': None,
+        }])
+
+    def test_jsonl(self):
+        lines = [
+            '{"hostname": "localhost", "state": "DOWN", "plugin_output": '
+            '"d\\u00e9j\\u00e0", "host_notes": "mantis_project_id: 2"}\n',
+            '\n',
+            '{"hostname": "localhost", "state": "BROKEN"}\n',
+        ]
+
+        self.assertEquals(list(read_jsonl(lines)), [{
+            'hostname': u'localhost', 'state': u'DOWN', 'service': None,
+            'plugin_output': u'déjà', 'host_notes': u'mantis_project_id: 2',
+        }])
+
+    def test_import_events(self):
+        config = Config('tests/nagios2mantis_test.ini')
+        config.sqlite_file = ':memory:'
+        nagios2mantis = Nagios2Mantis(config)
+        nagios2mantis.notify = mock.MagicMock()
+        events = [{
+            'hostname': u'host%d' % i, 'state': u'DOWN', 'service': None,
+            'plugin_output': u'KO',
+            'host_notes': [None, u'mantis_project_id: 2',
+                           u'owner: ops\nmantis_project_id: 3'][i % 3],
+        } for i in range(5)]
+
+        with mock.patch('nagios2mantis.parse_host_notes',
+                        wraps=parse_host_notes) as parse_host_notes_mock:
+            self.assertEquals(nagios2mantis.import_events(iter(events), 2),
+                              5)
+
+        self.assertEquals(parse_host_notes_mock.call_count, 3)
+        self.assertEquals([row[5] for row in nagios2mantis.db_spool.rows()],
+                          [1, 2, 3, 1, 2])
+        nagios2mantis.notify.assert_called_once_with()
+
+    def test_import_nothing(self):
+        config = Config('tests/nagios2mantis_test.ini')
+        config.sqlite_file = ':memory:'
+        nagios2mantis = Nagios2Mantis(config)
+        nagios2mantis.notify = mock.MagicMock()
+
+        self.assertEquals(nagios2mantis.import_events(iter([])), 0)
+
+        self.assertFalse(nagios2mantis.notify.called)
+
 
-class GetProjectIdTest(unittest.TestCase):
+class ParseHostNotesTest(unittest.TestCase):
     def test_none(self):
-        result = get_project_id(None)
-        self.assertIsNone(result)
+        result = parse_host_notes(None)
+        self.assertEquals(result, (None, None))
 
     def test_empty(self):
-        result = get_project_id('')
-        self.assertIsNone(result)
+        result = parse_host_notes('')
+        self.assertEquals(result, (None, None))
 
     def test_not_yaml(self):
-        result = get_project_id('test')
-        self.assertIsNone(result)
+        result = parse_host_notes('test')
+        self.assertEquals(result, (None, None))
 
     def test_normal(self):
-        result = get_project_id('mantis_project_id: 1')
-        self.assertEquals(result, 1)
+        result = parse_host_notes('mantis_project_id: 1')
+        self.assertEquals(result, (1, None))
+
+    def test_fast_path(self):
+        with mock.patch('yaml.safe_load') as safe_load_mock:
+            self.assertEquals(
+                parse_host_notes(' mantis_project_id : 12 \n'), (12, None))
+        self.assertFalse(safe_load_mock.called)
+
+    def test_yaml(self):
+        self.assertEquals(parse_host_notes('{mantis_project_id: 3, a: b}'),
+                          (3, None))
+        self.assertEquals(parse_host_notes('owner: ops'), (None, None))
+
+    def test_instance(self):
+        self.assertEquals(parse_host_notes(
+            'mantis_instance: support\nmantis_project_id: 3'),
+            (3, 'support'))
+        self.assertEquals(parse_host_notes('mantis_instance: 2'),
+                          (None, '2'))
+
+    def test_not_dict(self):
+        self.assertEquals(parse_host_notes('- mantis_project_id'),
+                          (None, None))
+        self.assertEquals(parse_host_notes('42'), (None, None))
+
+    def test_invalid_yaml(self):
+        with mock.patch('logging.warning') as warning_mock:
+            self.assertEquals(parse_host_notes('mantis_project_id: [1'),
+                              (None, None))
+        self.assertTrue(warning_mock.called)
+
+    def test_unsafe_yaml(self):
+        with mock.patch('logging.warning'), \
+                mock.patch('os.getpid') as getpid_mock:
+            self.assertEquals(parse_host_notes(
+                '!!python/object/apply:os.getpid []'), (None, None))
+        self.assertFalse(getpid_mock.called)
+
+    def test_memoized(self):
+        db_spool = DbSpool(':memory:')
+        notes = 'owner: ops\nmantis_project_id: 4'
+        support = 'owner: ops\nmantis_instance: support'
+        self.assertEquals(parse_host_notes(notes, db_spool), (4, None))
+        self.assertEquals(parse_host_notes(support, db_spool),
+                          (None, 'support'))
+        self.assertEquals(parse_host_notes('owner: ops', db_spool),
+                          (None, None))
+
+        with mock.patch('yaml.safe_load') as safe_load_mock:
+            self.assertEquals(parse_host_notes(notes, db_spool), (4, None))
+            self.assertEquals(parse_host_notes(support, db_spool),
+                              (None, 'support'))
+            self.assertEquals(parse_host_notes('owner: ops', db_spool),
+                              (None, None))
+
+        self.assertFalse(safe_load_mock.called)